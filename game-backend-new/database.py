@@ -1,7 +1,13 @@
+import asyncio
+import logging
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from metrics import TimedQueuePool, TimedAsyncAdaptedQueuePool
+
+logger = logging.getLogger(__name__)
 
 # Define the path for the database file inside a 'data' subdirectory
 DB_PATH = "./data/game.db"
@@ -10,11 +16,152 @@ DB_PATH = "./data/game.db"
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
 SQLALCHEMY_DATABASE_URL = f"sqlite:///{DB_PATH}"
+ASYNC_SQLALCHEMY_DATABASE_URL = f"sqlite+aiosqlite:///{DB_PATH}"
+# Same file opened read-only through an SQLite URI
+ASYNC_READ_ONLY_DATABASE_URL = f"sqlite+aiosqlite:///file:{os.path.abspath(DB_PATH)}?mode=ro&uri=true"
 
 
+# The Timed* pools report how long checkouts wait to /metrics, labelled by pool_logging_name
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}, poolclass=TimedQueuePool, pool_logging_name="sync"
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# SQLite storage profile applied to every new connection; each setting can be overridden from the environment.
+# WAL lets readers run alongside the writer, and with synchronous=NORMAL a commit only appends to the WAL
+# instead of fsyncing the main database file.
+SQLITE_PRAGMAS = {
+    "auto_vacuum": os.getenv("SQLITE_AUTO_VACUUM", "INCREMENTAL"), # Only takes effect on a new database file
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", -64000)), # Negative values are in KiB
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000)),
+    "temp_store": os.getenv("SQLITE_TEMP_STORE", "MEMORY"),
+}
+SQLITE_MAINTENANCE_INTERVAL_SECONDS = int(os.getenv("SQLITE_MAINTENANCE_INTERVAL_SECONDS", 3600)) # 0 disables it
+SQLITE_INCREMENTAL_VACUUM_PAGES = int(os.getenv("SQLITE_INCREMENTAL_VACUUM_PAGES", 1000))
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+# Read-only connections can't change the journal mode or vacuum settings; they only get the per-connection tuning
+SQLITE_READ_ONLY_PRAGMAS = {
+    "query_only": "ON",
+    **{name: value for name, value in SQLITE_PRAGMAS.items() if name not in ("auto_vacuum", "journal_mode")},
+}
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", 10))
+
+def apply_sqlite_read_only_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_READ_ONLY_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+def add_missing_columns(bind, metadata):
+    """`create_all` never alters existing tables, so columns added to a model since a database file was
+    created are added here (they must be nullable or have a server default)."""
+    inspector = inspect(bind)
+    with bind.begin() as connection:
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=connection.dialect)
+                default = f" DEFAULT {column.server_default.arg}" if column.server_default is not None else ""
+                connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}{default}")
+                logger.info(f"Added missing column {table.name}.{column.name}.")
+
+def _has_unique_key(inspector, table_name: str, columns: list) -> bool:
+    unique_keys = [constraint["column_names"] for constraint in inspector.get_unique_constraints(table_name)]
+    unique_keys += [index["column_names"] for index in inspector.get_indexes(table_name) if index["unique"]]
+    return columns in unique_keys
+
+def migrate_per_player_unique_keys(bind):
+    """Moves databases created before saves were per player onto the per-player unique keys.
+
+    Vineyard names used to be unique globally (ix_vineyards_name), so a second player's starting
+    "Home Block" failed, and nothing stopped a player from having several game_state rows. SQLite
+    can't add constraints to an existing table, so unique indexes stand in for them; duplicates are
+    resolved first so they can be built. Runs before `create_missing_indexes`.
+    """
+    inspector = inspect(bind)
+    with bind.begin() as connection:
+        if inspector.has_table("vineyards"):
+            if any(index["name"] == "ix_vineyards_name" for index in inspector.get_indexes("vineyards")):
+                connection.exec_driver_sql("DROP INDEX ix_vineyards_name")
+                logger.info("Dropped the global unique index on vineyards.name.")
+            if not _has_unique_key(inspector, "vineyards", ["player_id", "name"]):
+                # A player's oldest vineyard keeps its name; later ones with the same name get their id appended
+                renamed = connection.exec_driver_sql(
+                    "UPDATE vineyards SET name = name || ' (' || id || ')' "
+                    "WHERE id NOT IN (SELECT MIN(id) FROM vineyards GROUP BY player_id, name)"
+                ).rowcount
+                connection.exec_driver_sql("CREATE UNIQUE INDEX uq_vineyards_player_name ON vineyards (player_id, name)")
+                logger.info(f"Made vineyard names unique per player ({renamed} duplicates renamed).")
+        if inspector.has_table("game_state") and not _has_unique_key(inspector, "game_state", ["player_id"]):
+            if any(index["name"] == "ix_game_state_player_id" for index in inspector.get_indexes("game_state")):
+                connection.exec_driver_sql("DROP INDEX ix_game_state_player_id") # Rebuilt as a unique index below
+            # Game used to pick the first save, so that's the one each player keeps
+            deleted = connection.exec_driver_sql(
+                "DELETE FROM game_state WHERE player_id IS NOT NULL "
+                "AND id NOT IN (SELECT MIN(id) FROM game_state GROUP BY player_id)"
+            ).rowcount
+            connection.exec_driver_sql("CREATE UNIQUE INDEX ix_game_state_player_id ON game_state (player_id)")
+            logger.info(f"Made game_state.player_id unique ({deleted} extra saves removed).")
+
+def create_missing_indexes(bind, metadata):
+    """Like `add_missing_columns`, for indexes added to tables that already exist."""
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+
+def run_sqlite_maintenance(connection, analyze: bool = False):
+    """Refreshes planner statistics and hands free pages back to the filesystem.
+
+    `PRAGMA optimize` only re-analyzes tables whose statistics look stale, so it's cheap enough to run
+    periodically; a full ANALYZE is only worth it once, e.g. at startup.
+    """
+    connection.exec_driver_sql("ANALYZE" if analyze else "PRAGMA optimize")
+    connection.exec_driver_sql(f"PRAGMA incremental_vacuum({SQLITE_INCREMENTAL_VACUUM_PAGES})")
+    connection.exec_driver_sql("PRAGMA wal_checkpoint(PASSIVE)")
+    connection.commit()
+
+event.listen(engine, "connect", apply_sqlite_pragmas)
+
+# Async engine used by the FastAPI handlers so a slow commit doesn't block the event loop.
+# The sync engine above stays available for scripts, tests and the offline CLI.
+# Objects aren't expired on commit: a request keeps using the player aggregate it loaded for auth
+# after its action commits instead of reloading it for the response.
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, poolclass=TimedAsyncAdaptedQueuePool, pool_logging_name="write")
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+event.listen(async_engine.sync_engine, "connect", apply_sqlite_pragmas)
+
+# Read-only engine with its own pool for the GET endpoints. Under WAL its connections read from a
+# snapshot and never wait on the writer's lock, so reads don't queue behind game actions.
+async_read_engine = create_async_engine(ASYNC_READ_ONLY_DATABASE_URL, pool_size=SQLITE_READ_POOL_SIZE, poolclass=TimedAsyncAdaptedQueuePool, pool_logging_name="read")
+AsyncReadSessionLocal = async_sessionmaker(bind=async_read_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+event.listen(async_read_engine.sync_engine, "connect", apply_sqlite_read_only_pragmas)
+
+async def sqlite_maintenance_loop(interval_seconds: int = SQLITE_MAINTENANCE_INTERVAL_SECONDS):
+    """Background task started from the app lifespan; runs until cancelled."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            async with async_engine.connect() as connection:
+                await connection.run_sync(run_sqlite_maintenance)
+            logger.info("SQLite maintenance completed.")
+        except Exception as e:
+            logger.error(f"SQLite maintenance failed: {e}")
+
 Base = declarative_base()
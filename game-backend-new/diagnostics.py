@@ -0,0 +1,158 @@
+import gc
+import hmac
+import os
+import threading
+import tracemalloc
+from collections import Counter, OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from sqlalchemy.orm import Session
+
+from database import Base
+
+try:
+    import resource
+except ImportError: # Unix only: on Windows max_rss_kb is reported as None
+    resource = None
+
+# Memory diagnostics under /debug/memory, for tracking down RSS growth in a running worker. The
+# endpoints return 404 unless DIAGNOSTICS_TOKEN is set and sent in `X-Diagnostics-Token`.
+DIAGNOSTICS_TOKEN = os.getenv("DIAGNOSTICS_TOKEN", "")
+# Snapshots are large; only the most recent ones are kept for diffing
+MAX_SNAPSHOTS = int(os.getenv("DIAGNOSTICS_MAX_SNAPSHOTS", 5))
+SNAPSHOT_KEY_TYPES = ("lineno", "filename", "traceback")
+
+# Allocations made by the tracer and the import system are noise when hunting a leak
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+class SnapshotStore:
+    """Numbered tracemalloc snapshots, oldest dropped beyond `max_snapshots`."""
+    def __init__(self, max_snapshots: int = MAX_SNAPSHOTS):
+        self.max_snapshots = max_snapshots
+        self._snapshots: "OrderedDict[int, Tuple[datetime, tracemalloc.Snapshot]]" = OrderedDict()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def take(self) -> int:
+        snapshot = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+        with self._lock:
+            snapshot_id = self._next_id
+            self._next_id += 1
+            self._snapshots[snapshot_id] = (datetime.now(), snapshot)
+            while len(self._snapshots) > self.max_snapshots:
+                self._snapshots.popitem(last=False)
+        return snapshot_id
+
+    def get(self, snapshot_id: int) -> Optional[tracemalloc.Snapshot]:
+        entry = self._snapshots.get(snapshot_id)
+        return entry[1] if entry else None
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [{"id": snapshot_id, "taken_at": taken_at.isoformat(), "traces": len(snapshot.traces)} for snapshot_id, (taken_at, snapshot) in self._snapshots.items()]
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+snapshots = SnapshotStore()
+
+def memory_status() -> Dict[str, Any]:
+    status = {
+        "tracing": tracemalloc.is_tracing(),
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None, # KiB on Linux
+        "gc_counts": gc.get_count(),
+        "snapshots": snapshots.list(),
+    }
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        status.update(traced_bytes=current, traced_peak_bytes=peak, traceback_limit=tracemalloc.get_traceback_limit())
+    return status
+
+def snapshot_diff(old: tracemalloc.Snapshot, new: tracemalloc.Snapshot, key_type: str = "lineno", limit: int = 20) -> List[Dict[str, Any]]:
+    """Allocation sites ordered by how much their memory grew between the two snapshots."""
+    diffs = []
+    for stat in new.compare_to(old, key_type)[:limit]:
+        diffs.append({
+            "site": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+            "size_diff": stat.size_diff,
+            "size": stat.size,
+            "count_diff": stat.count_diff,
+            "count": stat.count,
+        })
+    return diffs
+
+def orm_instance_counts() -> Dict[str, Any]:
+    """Live objects of each mapped class, plus the sessions holding them in identity maps.
+
+    Walks every object the garbage collector tracks, so it costs a pause proportional to the heap;
+    it's meant for occasional inspection, not for scraping.
+    """
+    mapped_classes = {mapper.class_: mapper.class_.__name__ for mapper in Base.registry.mappers}
+    instances: Counter = Counter()
+    sessions = 0
+    identity_map_entries = 0
+    for obj in gc.get_objects():
+        cls = type(obj)
+        if cls in mapped_classes:
+            instances[mapped_classes[cls]] += 1
+        elif isinstance(obj, Session):
+            sessions += 1
+            identity_map_entries += len(obj.identity_map)
+    return {
+        "instances": {name: instances.get(name, 0) for name in sorted(mapped_classes.values())},
+        "sessions": sessions,
+        "identity_map_entries": identity_map_entries,
+    }
+
+def require_diagnostics_token(x_diagnostics_token: str = Header("")):
+    if not DIAGNOSTICS_TOKEN or not hmac.compare_digest(x_diagnostics_token, DIAGNOSTICS_TOKEN):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+diagnostics_router = APIRouter(prefix="/debug/memory", dependencies=[Depends(require_diagnostics_token)], include_in_schema=False)
+
+@diagnostics_router.get("")
+async def get_memory_status():
+    return memory_status()
+
+@diagnostics_router.post("/tracemalloc/start")
+async def start_tracemalloc(frames: int = 1):
+    # More frames per trace make diffs attributable to callers, at a higher tracing cost
+    if frames < 1:
+        raise HTTPException(status_code=400, detail="frames must be at least 1.")
+    if tracemalloc.is_tracing():
+        tracemalloc.stop() # Restart so a new frame count takes effect
+    tracemalloc.start(frames)
+    return memory_status()
+
+@diagnostics_router.post("/tracemalloc/stop")
+async def stop_tracemalloc():
+    tracemalloc.stop()
+    snapshots.clear() # Traces from different sessions can't be compared meaningfully
+    return memory_status()
+
+@diagnostics_router.post("/snapshots")
+async def take_snapshot():
+    if not tracemalloc.is_tracing():
+        raise HTTPException(status_code=400, detail="tracemalloc is not running.")
+    return {"id": snapshots.take()}
+
+@diagnostics_router.get("/snapshots/{old_id}/diff/{new_id}")
+async def get_snapshot_diff(old_id: int, new_id: int, key_type: str = "lineno", limit: int = 20):
+    old, new = snapshots.get(old_id), snapshots.get(new_id)
+    if old is None or new is None:
+        raise HTTPException(status_code=404, detail="Snapshot not found.")
+    if key_type not in SNAPSHOT_KEY_TYPES:
+        raise HTTPException(status_code=400, detail=f"key_type must be one of {', '.join(SNAPSHOT_KEY_TYPES)}.")
+    return snapshot_diff(old, new, key_type, limit)
+
+@diagnostics_router.get("/orm")
+async def get_orm_instance_counts():
+    return orm_instance_counts()
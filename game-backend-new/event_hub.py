@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List
+
+logger = logging.getLogger(__name__)
+
+# Messages buffered per connection; a client that falls further behind loses the oldest ones and can
+# catch up through the delta endpoint using the last state_version it saw.
+SUBSCRIBER_QUEUE_SIZE = 100
+
+class EventHub:
+    """In-process pub/sub of committed game changes, keyed by player.
+
+    Game publishes from whatever thread and event loop its session runs on, so messages are handed to
+    each subscriber's own loop.
+    """
+    def __init__(self, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers: Dict[int, Dict[asyncio.Queue, asyncio.AbstractEventLoop]] = defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def subscribe(self, player_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers[player_id][queue] = asyncio.get_running_loop()
+        return queue
+
+    def unsubscribe(self, player_id: int, queue: asyncio.Queue):
+        with self._lock:
+            self._subscribers[player_id].pop(queue, None)
+            if not self._subscribers[player_id]:
+                del self._subscribers[player_id]
+
+    def subscriber_count(self, player_id: int) -> int:
+        with self._lock:
+            return len(self._subscribers.get(player_id, {}))
+
+    def publish(self, player_id: int, messages: List[Dict[str, Any]]):
+        with self._lock:
+            subscribers = list(self._subscribers.get(player_id, {}).items())
+        if not subscribers:
+            return
+        try:
+            current_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            current_loop = None
+        for queue, loop in subscribers:
+            if loop is current_loop:
+                self._put(queue, messages)
+                continue
+            try:
+                loop.call_soon_threadsafe(self._put, queue, messages)
+            except RuntimeError: # The subscriber's loop is gone
+                logger.warning(f"Dropping event subscriber for player {player_id}: its event loop is closed.")
+                self.unsubscribe(player_id, queue)
+
+    @staticmethod
+    def _put(queue: asyncio.Queue, messages: List[Dict[str, Any]]):
+        for message in messages:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+hub = EventHub()
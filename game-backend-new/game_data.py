@@ -0,0 +1,47 @@
+# --- Game Data (Constants) ---
+# Shared by Game and the in-memory simulation core in simulation.py
+
+REGIONS = {
+    "Willamette Valley": {
+        "climate": "cool",
+        "soil_types": ["volcanic", "sedimentary"],
+        "grape_varietals": ["Pinot Noir", "Chardonnay", "Pinot Gris"],
+        "base_cost": 50000
+    },
+    "Jura": {
+        "climate": "cool",
+        "soil_types": ["marl", "limestone"],
+        "grape_varietals": ["Savagnin", "Poulsard", "Trousseau", "Chardonnay", "Pinot Noir"],
+        "base_cost": 40000
+    },
+    "Northern Rhône": {
+        "climate": "continental",
+        "soil_types": ["granite", "schist"],
+        "grape_varietals": ["Syrah", "Viognier"],
+        "base_cost": 60000
+    }
+}
+
+GRAPE_CHARACTERISTICS = {
+    "Pinot Noir": {"color": "red", "ripening_month": 9, "base_quality": 70},
+    "Chardonnay": {"color": "white", "ripening_month": 9, "base_quality": 65},
+    "Pinot Gris": {"color": "white", "ripening_month": 9, "base_quality": 60},
+    "Savagnin": {"color": "white", "ripening_month": 10, "base_quality": 75},
+    "Poulsard": {"color": "red", "ripening_month": 9, "base_quality": 68},
+    "Trousseau": {"color": "red", "ripening_month": 9, "base_quality": 68},
+    "Syrah": {"color": "red", "ripening_month": 9, "base_quality": 72},
+    "Viognier": {"color": "white", "ripening_month": 9, "base_quality": 70},
+}
+
+VESSEL_TYPES = {
+    "Stainless Steel Tank": {"capacity": 5000, "cost": 10000, "type": "fermentation/aging"},
+    "Open Top Fermenter": {"capacity": 1000, "cost": 2000, "type": "fermentation"},
+    "Neutral Oak Barrel (225L)": {"capacity": 225, "cost": 500, "type": "aging"},
+    "Concrete Egg": {"capacity": 1500, "cost": 7000, "type": "fermentation/aging"},
+    "Amphora (500L)": {"capacity": 500, "cost": 3000, "type": "fermentation/aging"}
+}
+
+# Upper bound for a single fast-forward request
+MAX_ADVANCE_MONTHS = 120
+# Default horizon for "advance until something happens"
+DEFAULT_EVENT_HORIZON_MONTHS = 24
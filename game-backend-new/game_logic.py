@@ -1,121 +1,575 @@
+import base64
+import itertools
+import json
 import random
-from typing import List, Dict, Any, Optional
-from sqlalchemy.orm import Session
+from typing import List, Dict, Any, Optional, Tuple
+from sqlalchemy import inspect, select, update, insert, case, bindparam, event, tuple_
+from sqlalchemy.orm import Session, joinedload, selectinload, object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.ext.asyncio import AsyncSession
 from game_models import (
     GrapeCharacteristics, RegionData, VesselTypeData,
     Grape, Must, WineInProduction, Wine, Vineyard, WineryVessel, Winery, Player, GameState,
+    GameEvent, AdvanceMonthsResult, GameStateDelta, DeletedEntity, ActionCommand, ActionResult, ActionsResult, InventoryQuery, MONTHS,
     DBGrapeCharacteristics, DBRegionData, DBVesselTypeData,
-    DBGrape, DBMust, DBWineInProduction, DBWine, DBVineyard, DBWineryVessel, DBWinery, DBPlayer, DBGameState
+    DBGrape, DBMust, DBWineInProduction, DBWine, DBVineyard, DBWineryVessel, DBWinery, DBPlayer, DBGameState,
+    VersionedEntity, DBTombstone
 )
 from database import SessionLocal, engine, Base
+from event_hub import hub
+from metrics import timed_game_method
+from game_data import REGIONS, GRAPE_CHARACTERISTICS, VESSEL_TYPES, MAX_ADVANCE_MONTHS, DEFAULT_EVENT_HORIZON_MONTHS
+from simulation import Simulation, SimEntity, SimGameState, SimPlayer, SimWinery, SimVineyard, SimGrape, SimWine, SimVessel, SimMust, SimWineInProduction, SIMULATION_FIELDS
 import logging
 
 logger = logging.getLogger(__name__)
 
-# --- Game Data (Constants) ---
-REGIONS = {
-    "Willamette Valley": {
-        "climate": "cool",
-        "soil_types": ["volcanic", "sedimentary"],
-        "grape_varietals": ["Pinot Noir", "Chardonnay", "Pinot Gris"],
-        "base_cost": 50000
-    },
-    "Jura": {
-        "climate": "cool",
-        "soil_types": ["marl", "limestone"],
-        "grape_varietals": ["Savagnin", "Poulsard", "Trousseau", "Chardonnay", "Pinot Noir"],
-        "base_cost": 40000
-    },
-    "Northern Rhône": {
-        "climate": "continental",
-        "soil_types": ["granite", "schist"],
-        "grape_varietals": ["Syrah", "Viognier"],
-        "base_cost": 60000
-    }
+# Upper bound for the number of commands in one /actions batch
+MAX_BATCH_COMMANDS = 50
+# Largest page the inventory and cellar listings serve (the default is InventoryQuery.limit)
+MAX_PAGE_SIZE = 1000
+# Keyset cursors compare (sort value, id) row values, so sort columns must be NOT NULL
+INVENTORY_SORT_COLUMNS = ("id", "quality", "vintage")
+# How many state versions of deletions are kept for deltas; older clients get a full resync
+DELTA_HISTORY_VERSIONS = 1000
+# Most statements one call may run, however large the player's estate. Tests run with these enforced
+# (see query_stats.enforce_query_budgets), so a lazy load added inside a loop fails there first.
+# Methods that repeat others per month or per command are covered by the budgets of what they call.
+QUERY_BUDGETS = {
+    "get_game_state": 7,
+    "get_state_delta": 12,
+    "list_grapes_inventory": 2,
+    "list_bottled_wines": 2,
+    "next_event_in_months": 7,
+    "advance_month": 20,
+    "buy_vineyard": 5,
+    "tend_vineyard": 7,
+    "harvest_grapes": 8,
+    "buy_vessel": 7,
+    "process_grapes": 9,
+    "start_fermentation": 11,
+    "perform_maceration_action": 7,
+    "start_aging": 8,
+    "bottle_wine": 14,
 }
 
-GRAPE_CHARACTERISTICS = {
-    "Pinot Noir": {"color": "red", "ripening_month": 9, "base_quality": 70},
-    "Chardonnay": {"color": "white", "ripening_month": 9, "base_quality": 65},
-    "Pinot Gris": {"color": "white", "ripening_month": 9, "base_quality": 60},
-    "Savagnin": {"color": "white", "ripening_month": 10, "base_quality": 75},
-    "Poulsard": {"color": "red", "ripening_month": 9, "base_quality": 68},
-    "Trousseau": {"color": "red", "ripening_month": 9, "base_quality": 68},
-    "Syrah": {"color": "red", "ripening_month": 9, "base_quality": 72},
-    "Viognier": {"color": "white", "ripening_month": 9, "base_quality": 70},
-}
 
-VESSEL_TYPES = {
-    "Stainless Steel Tank": {"capacity": 5000, "cost": 10000, "type": "fermentation/aging"},
-    "Open Top Fermenter": {"capacity": 1000, "cost": 2000, "type": "fermentation"},
-    "Neutral Oak Barrel (225L)": {"capacity": 225, "cost": 500, "type": "aging"},
-    "Concrete Egg": {"capacity": 1500, "cost": 7000, "type": "fermentation/aging"},
-    "Amphora (500L)": {"capacity": 500, "cost": 3000, "type": "fermentation/aging"}
-}
+# Loader strategy for the whole GameState aggregate: the game state, player and winery rows come
+# back in one joined query, and each collection is fetched with one SELECT ... IN, so the number
+# of queries stays fixed however many vineyards, lots and wines a player owns.
+GAME_STATE_LOADER_OPTIONS = (
+    joinedload(DBGameState.player).options(
+        selectinload(DBPlayer.vineyards),
+        selectinload(DBPlayer.grapes_inventory),
+        selectinload(DBPlayer.bottled_wines),
+        joinedload(DBPlayer.winery).options(
+            selectinload(DBWinery.vessels),
+            selectinload(DBWinery.must_in_production),
+            selectinload(DBWinery.wines_in_production),
+        ),
+    ),
+)
+
+def partition_wines_in_production(db_winery: DBWinery):
+    """Fills the stage-filtered collections from the already loaded `wines_in_production`,
+    instead of letting `wines_fermenting` and `wines_aging` each query the same table."""
+    winery_state = inspect(db_winery)
+    if "wines_in_production" in winery_state.unloaded:
+        return
+    if "wines_fermenting" in winery_state.unloaded:
+        set_committed_value(db_winery, "wines_fermenting", [w for w in db_winery.wines_in_production if w.stage == "fermenting"])
+    if "wines_aging" in winery_state.unloaded:
+        set_committed_value(db_winery, "wines_aging", [w for w in db_winery.wines_in_production if w.stage == "aging"])
+
+# Versioned entities served by deltas, by owner, with the response model for each
+PLAYER_VERSIONED_ENTITIES = {DBVineyard: Vineyard, DBGrape: Grape, DBWine: Wine}
+WINERY_VERSIONED_ENTITIES = {DBMust: Must, DBWineInProduction: WineInProduction, DBWineryVessel: WineryVessel}
+
+@event.listens_for(Session, "before_flush")
+def stamp_versioned_entities(session, flush_context, instances):
+    """Stamps rows created or changed in this flush with the state version set by `Game._bump_state_version`."""
+    state_version = session.info.get("state_version")
+    if state_version is None:
+        return
+    for obj in itertools.chain(session.new, session.dirty):
+        if isinstance(obj, VersionedEntity):
+            obj.version = state_version
+
+@event.listens_for(VersionedEntity, "after_delete", propagate=True)
+def record_tombstone(mapper, connection, target):
+    # Also fires for delete-orphan cascades, which never show up in session.deleted
+    session = object_session(target)
+    if session is None or session.info.get("state_version") is None:
+        return
+    connection.execute(insert(DBTombstone.__table__).values(
+        player_id=session.info["player_id"],
+        entity_type=mapper.local_table.name,
+        entity_id=target.id,
+        version=session.info["state_version"],
+    ))
+
+@event.listens_for(Session, "after_commit")
+def publish_committed_changes(session):
+    """Pushes what the transaction changed to the player's subscribers once it's durable."""
+    player_id = session.info.pop("player_id", None)
+    session.info.pop("state_version", None)
+    messages = session.info.pop("pending_messages", [])
+    if player_id is not None and messages:
+        hub.publish(player_id, messages)
+
+@event.listens_for(Session, "after_rollback")
+def discard_uncommitted_changes(session):
+    for key in ("player_id", "state_version", "pending_messages"):
+        session.info.pop(key, None)
+
+def encode_cursor(values: List[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def _is_cursor_value(value: Any, value_type: type) -> bool:
+    # bool is an int subclass, but no sort column holds one
+    return isinstance(value, value_type) and not isinstance(value, bool)
+
+def decode_cursor(cursor: str, sort_type: type = int) -> Optional[List[Any]]:
+    """The (sort value, id) pair of a cursor, or None unless both have the types of their columns."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not (isinstance(values, list) and len(values) == 2):
+        return None
+    sort_value, row_id = values
+    # Sort columns are NOT NULL; a None here would make the row-value comparison match nothing
+    return values if _is_cursor_value(sort_value, sort_type) and _is_cursor_value(row_id, int) else None
+
+def create_new_game(db: Session, player_name: str = "Winemaker") -> DBGameState:
+    """Creates a player with the starting winery, vessels and vineyard, and their game state."""
+    player = DBPlayer(name=player_name, money=100000, reputation=50)
+    db.add(player)
+    db.flush()
+
+    initial_vessels = [
+        DBWineryVessel(type="Stainless Steel Tank", capacity=5000, in_use=False),
+        DBWineryVessel(type="Open Top Fermenter", capacity=1000, in_use=False),
+        DBWineryVessel(type="Neutral Oak Barrel (225L)", capacity=225, in_use=False),
+        DBWineryVessel(type="Neutral Oak Barrel (225L)", capacity=225, in_use=False),
+        DBWineryVessel(type="Neutral Oak Barrel (225L)", capacity=225, in_use=False),
+    ]
+    winery = DBWinery(name="Main Winery", player_id=player.id, vessels=initial_vessels)
+    db.add(winery)
+    db.flush()
+    player.winery = winery
+
+    starting_vineyard = DBVineyard(name="Home Block", varietal="Pinot Noir", region="Willamette Valley", size_acres=5, player_id=player.id)
+    db.add(starting_vineyard)
+
+    game_state = DBGameState(player_id=player.id, current_year=2025, current_month_index=0)
+    db.add(game_state)
+    db.commit()
+    return game_state
+
+def move_wine_to_stage_collection(db_winery: DBWinery, wine_prod: DBWineInProduction):
+    """Keeps the loaded stage collections in step after `wine_prod.stage` changed.
+
+    The row itself is written through the `stage` column; the collections are only views over it, so
+    they're updated as committed state rather than through the delete-orphan cascades.
+    """
+    winery_state = inspect(db_winery)
+    for attribute, stage in (("wines_fermenting", "fermenting"), ("wines_aging", "aging")):
+        if attribute in winery_state.unloaded:
+            continue
+        wines = [w for w in getattr(db_winery, attribute) if w is not wine_prod]
+        if wine_prod.stage == stage:
+            wines.append(wine_prod)
+            wines.sort(key=lambda w: w.id)
+        set_committed_value(db_winery, attribute, wines)
+
+# The player's one-to-one rows, resolved together with the player in a single joined query
+PLAYER_CONTEXT_LOADER_OPTIONS = (
+    joinedload(DBPlayer.game_state),
+    joinedload(DBPlayer.winery),
+)
+
+class PlayerContext:
+    """The player aggregate for one request.
+
+    Loaded once (usually by the auth dependency) and shared with `Game` and the response builders,
+    so none of them has to look up the game state, player or winery again. The id and name are kept
+    as plain values so they stay readable after a commit expires the ORM objects.
+    """
+    # True for the in-memory contexts of write_behind.py, which run `AsyncGame` calls themselves
+    cached = False
+
+    def __init__(self, db: Session, player: DBPlayer):
+        self.db = db
+        self.player = player
+        self.player_id = player.id
+        self.player_name = player.name
+        self.state_version = player.state_version
+
+    @property
+    def game_state(self) -> DBGameState:
+        return self.player.game_state
+
+    @property
+    def winery(self) -> DBWinery:
+        return self.player.winery
+
+def load_player_context(db: Session, player_id: int, refresh: bool = False) -> Optional[PlayerContext]:
+    # `refresh` reloads rows already in the session, e.g. ones read before another request committed
+    player = db.get(DBPlayer, player_id, options=PLAYER_CONTEXT_LOADER_OPTIONS, populate_existing=refresh)
+    return PlayerContext(db, player) if player else None
 
 class Game:
-    def __init__(self, db: Session):
+    """Game rules for one player's save.
+
+    With a `player_id` every lookup goes through that player's indexed foreign keys, so many players
+    can share one database. Without one the game falls back to the first saved game, which is what the
+    single-save offline tools expect.
+    """
+    def __init__(self, db: Session, player_id: Optional[int] = None, context: Optional[PlayerContext] = None):
         self.db = db
+        self.context = context
+        self.player_id = context.player_id if context else player_id
+        # Cleared while `execute_actions` runs a batch, so the actions only flush and the batch commits once
+        self.autocommit = True
 
+    def _commit(self):
+        if self.autocommit:
+            self.db.commit()
+        else:
+            self.db.flush()
 
+    def _game_state_query(self):
+        query = self.db.query(DBGameState)
+        if self.player_id is not None:
+            query = query.filter(DBGameState.player_id == self.player_id)
+        return query
+
+    def _get_game_state_row(self) -> Optional[DBGameState]:
+        if self.context:
+            return self.context.game_state
+        return self._game_state_query().first()
+
+    def _get_player(self) -> Optional[DBPlayer]:
+        if self.context:
+            return self.context.player
+        if self.player_id is not None:
+            return self.db.get(DBPlayer, self.player_id) # Primary key lookup, served from the identity map when already loaded
+        return self._get_game_state_row().player
+
+    def _bump_state_version(self):
+        """Marks the pending changes as a new version of the player's state (see the ETag handling in main.py).
+
+        Rows flushed until the commit are stamped with the new version and deletions leave a tombstone,
+        which is what `get_state_delta` reads back.
+        """
+        db_player = self._get_player()
+        db_player.state_version += 1
+        self.db.info["state_version"] = db_player.state_version
+        self.db.info["player_id"] = db_player.id
+        self._queue_messages([{
+            "type": "state_changed",
+            "state_version": db_player.state_version,
+            "money": db_player.money,
+            "reputation": db_player.reputation,
+        }])
+        if db_player.state_version % DELTA_HISTORY_VERSIONS == 0:
+            self.db.query(DBTombstone).filter(
+                DBTombstone.player_id == db_player.id,
+                DBTombstone.version <= db_player.state_version - DELTA_HISTORY_VERSIONS,
+            ).delete(synchronize_session=False)
+
+    def _queue_messages(self, messages: List[Dict[str, Any]]):
+        """Queues push messages for the player's subscribers; they're only published if the transaction commits."""
+        self.db.info.setdefault("pending_messages", []).extend(messages)
+
+    def _queue_events(self, events: List[GameEvent]):
+        self._queue_messages([event.model_dump() for event in events])
+
+    def _load_game_state(self) -> Optional[DBGameState]:
+        db_game_state = self._game_state_query().options(*GAME_STATE_LOADER_OPTIONS).first()
+        if db_game_state and db_game_state.player and db_game_state.player.winery:
+            partition_wines_in_production(db_game_state.player.winery)
+        return db_game_state
+
+    def _require_game_state(self) -> DBGameState:
+        """`_load_game_state` for the month advances, which have nothing to return without a save."""
+        db_game_state = self._load_game_state()
+        if db_game_state is None:
+            raise ValueError(f"Game state not found for player {self.player_id}.")
+        return db_game_state
+
+    @timed_game_method
     def get_game_state(self) -> GameState:
-        db_game_state = self.db.query(DBGameState).first()
+        db_game_state = self._load_game_state()
         if not db_game_state:
             logger.error("Game state not found during retrieval. This indicates an initialization issue.")
             raise Exception("Game state not found. This should not happen after initialization.")
         return GameState.model_validate(db_game_state)
 
-    def advance_month(self):
-        db_game_state = self.db.query(DBGameState).first()
-        db_player = self.db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
+    @timed_game_method
+    def get_state_delta(self, since_version: int) -> GameStateDelta:
+        """Entities created, updated or deleted after `since_version`.
+
+        Clients should apply `deleted` before the updated entities: SQLite can hand a deleted row's id
+        to a new row, and in that case both show up.
+        """
+        db_player = self._get_player()
+        db_game_state = self._get_game_state_row()
+        current_version = db_player.state_version
+        delta = dict(
+            since_version=since_version,
+            state_version=current_version,
+            current_year=db_game_state.current_year,
+            current_month_index=db_game_state.current_month_index,
+            money=db_player.money,
+            reputation=db_player.reputation,
+        )
+        if not 0 <= since_version <= current_version or current_version - since_version > DELTA_HISTORY_VERSIONS:
+            logger.info(f"Full resync for player {db_player.id}: version {since_version} is unknown or too old (current {current_version}).")
+            return GameStateDelta(**delta, full_resync=True, game_state=self.get_game_state())
+
+        for db_class, model in PLAYER_VERSIONED_ENTITIES.items():
+            rows = self.db.query(db_class).filter(db_class.player_id == db_player.id, db_class.version > since_version).order_by(db_class.id)
+            delta[db_class.__tablename__] = [model.model_validate(row) for row in rows]
+        for db_class, model in WINERY_VERSIONED_ENTITIES.items():
+            rows = self.db.query(db_class).filter(db_class.winery_id == db_player.winery.id, db_class.version > since_version).order_by(db_class.id)
+            delta[db_class.__tablename__] = [model.model_validate(row) for row in rows]
+        tombstones = self.db.query(DBTombstone).filter(
+            DBTombstone.player_id == db_player.id, DBTombstone.version > since_version
+        ).order_by(DBTombstone.id)
+        delta["deleted"] = [DeletedEntity(entity_type=t.entity_type, id=t.entity_id) for t in tombstones]
+        return GameStateDelta(**delta)
+
+    def _inventory_page(self, db_class, model, query: InventoryQuery) -> Optional[Tuple[List[Any], Optional[str]]]:
+        """One keyset page of the player's rows of `db_class`, and the cursor for the next page if any.
+
+        The cursor holds the (sort value, id) of the page's last row, so each page is a range scan
+        on a (player_id, sort column, id) index no matter how deep the client pages.
+        """
+        sort_name = query.sort.lstrip("-")
+        descending = query.sort.startswith("-")
+        if sort_name not in INVENTORY_SORT_COLUMNS or getattr(db_class, sort_name).nullable or not 1 <= query.limit <= MAX_PAGE_SIZE:
+            logger.warning(f"Invalid listing query: sort '{query.sort}', limit {query.limit}.")
+            return None
+        sort_column = getattr(db_class, sort_name)
+
+        rows = self.db.query(db_class).filter(db_class.player_id == self._get_player().id)
+        if query.varietal is not None:
+            rows = rows.filter(db_class.varietal == query.varietal)
+        if query.vintage is not None:
+            rows = rows.filter(db_class.vintage == query.vintage)
+        if query.min_quality is not None:
+            rows = rows.filter(db_class.quality >= query.min_quality)
+        if query.cursor is not None:
+            after = decode_cursor(query.cursor, sort_column.type.python_type)
+            if after is None:
+                logger.warning(f"Invalid listing cursor '{query.cursor}'.")
+                return None
+            key = tuple_(sort_column, db_class.id)
+            rows = rows.filter(key < tuple_(*after) if descending else key > tuple_(*after))
+        if descending:
+            rows = rows.order_by(sort_column.desc(), db_class.id.desc())
+        else:
+            rows = rows.order_by(sort_column, db_class.id)
+
+        rows = rows.limit(query.limit + 1).all()
+        next_cursor = None
+        if len(rows) > query.limit:
+            rows = rows[:query.limit]
+            next_cursor = encode_cursor([getattr(rows[-1], sort_name), rows[-1].id])
+        return [model.model_validate(row) for row in rows], next_cursor
+
+    @timed_game_method
+    def list_grapes_inventory(self, query: InventoryQuery) -> Optional[Tuple[List[Grape], Optional[str]]]:
+        return self._inventory_page(DBGrape, Grape, query)
+
+    @timed_game_method
+    def list_bottled_wines(self, query: InventoryQuery) -> Optional[Tuple[List[Wine], Optional[str]]]:
+        return self._inventory_page(DBWine, Wine, query)
+
+    def _event(self, event_type: str, db_game_state: DBGameState, subject: str, subject_id: Optional[int]) -> GameEvent:
+        return GameEvent(
+            type=event_type,
+            year=db_game_state.current_year,
+            month=db_game_state.months[db_game_state.current_month_index],
+            subject=subject,
+            subject_id=subject_id,
+        )
+
+    def _simulate(self, method_name: str, *args) -> Tuple[Any, Simulation]:
+        """Runs one rule of the in-memory `Simulation` against the player's save and writes the result back.
+
+        Only for the month advances, which touch every vineyard and wine anyway: the save is loaded with
+        the fixed query plan of `get_game_state`, and nothing is written when the rule refuses (None/False).
+        Returns the rule's result and the simulation it ran on; raises ValueError if the save is missing.
+        """
+        db_game_state = self._require_game_state()
+        simulation = _simulation_from_rows(db_game_state)
+        result = getattr(simulation, method_name)(*args)
+        if result is not None and result is not False:
+            _write_simulation_to_rows(self, db_game_state, simulation)
+            self._commit()
+        return result, simulation
+
+    @timed_game_method
+    def advance_month(self, bulk: bool = False) -> List[GameEvent]:
+        if bulk:
+            return self._advance_month_bulk()
+
+        events, simulation = self._simulate("advance_month")
+        state = simulation.state
+        logger.info(f"Advanced to {state.months[state.current_month_index]}, {state.current_year}.")
+        return events
+
+    @timed_game_method
+    def advance_months(self, months: int) -> Optional[AdvanceMonthsResult]:
+        """Fast-forwards `months` months in memory and commits once at the end."""
+        events, simulation = self._simulate("advance_months", months)
+        if events is None:
+            logger.warning(f"Failed to advance {months} months: must be between 1 and {MAX_ADVANCE_MONTHS}.")
+            return None
+        result = AdvanceMonthsResult(game_state=GameState.model_validate(simulation.state), events=events, months_advanced=months)
+        logger.info(f"Advanced {months} months to {result.game_state.months[result.game_state.current_month_index]}, {result.game_state.current_year}. {len(events)} events.")
+        return result
+
+    @timed_game_method
+    def next_event_in_months(self) -> Optional[int]:
+        """Number of months until the next ripening, fermentation or aging event, if any is pending."""
+        return _simulation_from_rows(self._require_game_state()).next_event_in_months()
+
+    @timed_game_method
+    def advance_until_next_event(self, max_months: int = DEFAULT_EVENT_HORIZON_MONTHS) -> Optional[AdvanceMonthsResult]:
+        """Jumps straight to the next month in which something happens, within `max_months`.
+
+        Idle months are skipped in one batch (see `Simulation.advance_until_next_event`) and the whole
+        jump is committed once.
+        """
+        advanced, simulation = self._simulate("advance_until_next_event", max_months)
+        if advanced is None:
+            logger.warning(f"Failed to advance until next event: horizon {max_months} must be between 1 and {MAX_ADVANCE_MONTHS}.")
+            return None
+        events, months_advanced = advanced
+        result = AdvanceMonthsResult(game_state=GameState.model_validate(simulation.state), events=events, months_advanced=months_advanced)
+        logger.info(f"Advanced {months_advanced} months to the next event: {[e.type for e in events]}.")
+        return result
+
+    def _advance_month_bulk(self) -> List[GameEvent]:
+        """The rules of `Simulation.advance_month`, pushed down as a handful of set-based UPDATE statements.
+
+        No vineyard or wine is loaded as an ORM object: per-row random draws are generated in one
+        batch (in the same order as the simulation, so a seeded run gives identical results) and sent
+        as a single executemany, so the cost grows with the number of statements, not rows.
+        """
+        db_game_state = self._get_game_state_row()
+        if db_game_state is None:
+            raise ValueError(f"Game state not found for player {self.player_id}.")
+        player_id = db_game_state.player_id
+        vineyards = DBVineyard.__table__
+        wines = DBWineInProduction.__table__
+        winery_ids = select(DBWinery.id).where(DBWinery.player_id == player_id).scalar_subquery()
+        events = []
+        # UPDATE ... RETURNING needs SQLite 3.35+; older builds (the Docker image ships 3.27) select the
+        # affected rows first instead, within the same transaction
+        returning = self.db.get_bind().dialect.update_returning
+        # Versions have to be known up front: the Core UPDATEs stamp rows themselves, bypassing before_flush
+        self._bump_state_version()
+        state_version = self.db.info["state_version"]
 
         db_game_state.current_month_index += 1
         if db_game_state.current_month_index >= len(db_game_state.months):
             db_game_state.current_month_index = 0
             db_game_state.current_year += 1
             logger.info(f"New year: {db_game_state.current_year}. Resetting vineyard harvest status.")
-            # Reset for new year
-            for vineyard in db_player.vineyards:
-                vineyard.harvested_this_year = False
-                vineyard.grapes_ready = False # Will be set to True again when ripe
-
-        # Monthly updates for vineyards
-        current_month_num = db_game_state.current_month_index + 1 # 1-indexed for comparison with ripening_month
-        for vineyard in db_player.vineyards:
-            # Health decay if not tended
-            if random.random() < 0.2: # 20% chance of health decay each month
-                vineyard.health = max(0, vineyard.health - random.randint(1, 3))
-                logger.debug(f"Vineyard {vineyard.name} health decayed to {vineyard.health}.")
-
-            # Check for grape ripening
-            ripening_month = GRAPE_CHARACTERISTICS[vineyard.varietal]["ripening_month"]
-            if current_month_num == ripening_month and not vineyard.harvested_this_year:
-                vineyard.grapes_ready = True
-                logger.info(f"Grapes in {vineyard.name} ({vineyard.varietal}) are now ready for harvest.")
-
-        # Monthly updates for winery production
-        db_winery = self.db.query(DBWinery).filter(DBWinery.player_id == db_player.id).first()
-        if db_winery:
-            for wine_prod in list(db_winery.wines_fermenting): # Iterate over a copy to allow modification
-                if wine_prod.fermentation_progress < 100:
-                    # Simulate fermentation progress (faster for smaller batches, higher quality grapes)
-                    progress_gain = random.randint(10, 25) + int(wine_prod.quality / 10)
-                    wine_prod.fermentation_progress = min(100, wine_prod.fermentation_progress + progress_gain)
-                    logger.debug(f"Fermentation progress for {wine_prod.varietal}: {wine_prod.fermentation_progress}%")
-
-            for wine_prod in list(db_winery.wines_aging): # Iterate over a copy
-                if wine_prod.aging_progress < wine_prod.aging_duration:
-                    wine_prod.aging_progress += 1
-                    logger.debug(f"Aging progress for {wine_prod.varietal}: {wine_prod.aging_progress}/{wine_prod.aging_duration} months.")
-        
-        self.db.commit()
-        self.db.refresh(db_game_state)
-        self.db.refresh(db_player)
-        logger.info(f"Advanced to {db_game_state.months[db_game_state.current_month_index]}, {db_game_state.current_year}.")
+            self.db.execute(
+                update(vineyards).where(vineyards.c.player_id == player_id)
+                .values(harvested_this_year=False, grapes_ready=False, version=state_version)
+            )
+
+        # Health decay: one draw per vineyard, only the decayed rows are written
+        vineyard_ids = self.db.execute(
+            select(vineyards.c.id).where(vineyards.c.player_id == player_id).order_by(vineyards.c.id)
+        ).scalars().all()
+        decays = [{"vineyard_id": vineyard_id, "decay": random.randint(1, 3)} for vineyard_id in vineyard_ids if random.random() < 0.2]
+        if decays:
+            decayed_health = vineyards.c.health - bindparam("decay")
+            self.db.execute(
+                update(vineyards).where(vineyards.c.id == bindparam("vineyard_id"))
+                .values(health=case((decayed_health < 0, 0), else_=decayed_health), version=state_version),
+                decays,
+            )
+
+        # Grape ripening
+        current_month_num = db_game_state.current_month_index + 1
+        ripening_varietals = [varietal for varietal, data in GRAPE_CHARACTERISTICS.items() if data["ripening_month"] == current_month_num]
+        if ripening_varietals:
+            ripening = (
+                vineyards.c.player_id == player_id,
+                vineyards.c.harvested_this_year == False,
+                vineyards.c.grapes_ready == False,
+                vineyards.c.varietal.in_(ripening_varietals),
+            )
+            ripen = update(vineyards).where(*ripening).values(grapes_ready=True, version=state_version)
+            if returning:
+                ripened = self.db.execute(ripen.returning(vineyards.c.id, vineyards.c.name)).all()
+            else:
+                ripened = self.db.execute(select(vineyards.c.id, vineyards.c.name).where(*ripening)).all()
+                self.db.execute(ripen)
+            events.extend(self._event("grapes_ready", db_game_state, name, vineyard_id) for vineyard_id, name in ripened)
+
+        # Fermentation progress: one gain draw per unfinished lot
+        fermenting = self.db.execute(
+            select(wines.c.id, wines.c.varietal, wines.c.fermentation_progress, wines.c.quality).where(
+                wines.c.winery_id == winery_ids,
+                wines.c.stage == "fermenting",
+                wines.c.fermentation_progress < 100,
+            ).order_by(wines.c.id)
+        ).all()
+        if fermenting:
+            gains = [{"wine_id": row.id, "gain": random.randint(10, 25)} for row in fermenting]
+            fermented = wines.c.fermentation_progress + bindparam("gain") + wines.c.quality // 10
+            self.db.execute(
+                update(wines).where(wines.c.id == bindparam("wine_id"))
+                .values(fermentation_progress=case((fermented > 100, 100), else_=fermented), version=state_version),
+                gains,
+            )
+            events.extend(
+                self._event("fermentation_complete", db_game_state, row.varietal, row.id)
+                for row, gain in zip(fermenting, gains)
+                if row.fermentation_progress + gain["gain"] + row.quality // 10 >= 100
+            )
+
+        # Aging progress
+        aging = (
+            wines.c.winery_id == winery_ids,
+            wines.c.stage == "aging",
+            wines.c.aging_progress < wines.c.aging_duration,
+        )
+        age = update(wines).where(*aging).values(aging_progress=wines.c.aging_progress + 1, version=state_version)
+        if returning:
+            aged = self.db.execute(age.returning(wines.c.id, wines.c.varietal, wines.c.aging_progress, wines.c.aging_duration)).all()
+        else:
+            # The same rows as RETURNING would give, with the progress they're about to have
+            aged = self.db.execute(
+                select(wines.c.id, wines.c.varietal, (wines.c.aging_progress + 1).label("aging_progress"), wines.c.aging_duration).where(*aging)
+            ).all()
+            self.db.execute(age)
+        events.extend(
+            self._event("aging_complete", db_game_state, row.varietal, row.id)
+            for row in aged if row.aging_progress >= row.aging_duration
+        )
+
+        advanced_to = f"{db_game_state.months[db_game_state.current_month_index]}, {db_game_state.current_year}"
+        self._queue_events(events)
+        self._commit()
+        # The UPDATEs above went around the identity map; drop anything already loaded for this request
+        self.db.expire_all()
+        logger.info(f"Advanced to {advanced_to} (bulk).")
+        return events
 
+    @timed_game_method
     def buy_vineyard(self, vineyard_data: Dict[str, Any], vineyard_name: str) -> Optional[Vineyard]:
-        db_game_state = self.db.query(DBGameState).first()
-        db_player = self.db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
+        db_player = self._get_player()
 
         cost = vineyard_data["cost"]
         logger.info(f"Attempting to buy vineyard '{vineyard_name}' for ${cost}. Player money: ${db_player.money}")
@@ -129,20 +583,21 @@ class Game:
                 soil_type=random.choice(REGIONS[vineyard_data["region"]]["soil_types"]),
                 player_id=db_player.id
             )
-            self.db.add(new_vineyard)
+            db_player.vineyards.append(new_vineyard)
             db_player.money -= cost
             db_player.reputation += 2
-            self.db.commit()
-            self.db.refresh(new_vineyard)
-            self.db.refresh(db_player)
+            self._bump_state_version()
+            self.db.flush()
+            purchased_vineyard = Vineyard.model_validate(new_vineyard)
+            self._commit()
             logger.info(f"Successfully purchased vineyard '{vineyard_name}'. New money: ${db_player.money}")
-            return Vineyard.model_validate(new_vineyard)
+            return purchased_vineyard
         logger.warning(f"Failed to buy vineyard '{vineyard_name}': Not enough money.")
         return None
 
+    @timed_game_method
     def tend_vineyard(self, vineyard_name: str) -> bool:
-        db_game_state = self.db.query(DBGameState).first()
-        db_player = self.db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
+        db_player = self._get_player()
 
         cost = 500
         logger.info(f"Attempting to tend vineyard '{vineyard_name}' for ${cost}. Player money: ${db_player.money}")
@@ -151,9 +606,8 @@ class Game:
             if vineyard:
                 db_player.money -= cost
                 vineyard.health = min(100, vineyard.health + random.randint(5, 15))
-                self.db.commit()
-                self.db.refresh(db_player)
-                self.db.refresh(vineyard)
+                self._bump_state_version()
+                self._commit()
                 logger.info(f"Successfully tended vineyard '{vineyard_name}'. New health: {vineyard.health}")
                 return True
             logger.warning(f"Failed to tend vineyard '{vineyard_name}': Vineyard not found.")
@@ -161,9 +615,10 @@ class Game:
             logger.warning(f"Failed to tend vineyard '{vineyard_name}': Not enough money.")
         return False
 
+    @timed_game_method
     def harvest_grapes(self, vineyard_name: str) -> Optional[Grape]:
-        db_game_state = self.db.query(DBGameState).first()
-        db_player = self.db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
+        db_game_state = self._get_game_state_row()
+        db_player = db_game_state.player
 
         vineyard = self.db.query(DBVineyard).filter(DBVineyard.player_id == db_player.id, DBVineyard.name == vineyard_name).first()
         logger.info(f"Attempting to harvest grapes from '{vineyard_name}'. Grapes ready: {vineyard.grapes_ready}, Harvested this year: {vineyard.harvested_this_year}")
@@ -182,23 +637,23 @@ class Game:
                 quality=grape_quality,
                 player_id=db_player.id
             )
-            self.db.add(new_grapes)
+            db_player.grapes_inventory.append(new_grapes)
             vineyard.harvested_this_year = True
             vineyard.grapes_ready = False
             db_player.reputation += 5
-            self.db.commit()
-            self.db.refresh(new_grapes)
-            self.db.refresh(vineyard)
-            self.db.refresh(db_player)
-            logger.info(f"Successfully harvested {yield_kg}kg of {vineyard.varietal} grapes from '{vineyard_name}'. Quality: {grape_quality}")
-            return Grape.model_validate(new_grapes)
+            self._bump_state_version()
+            self.db.flush()
+            harvested_grapes = Grape.model_validate(new_grapes)
+            self._commit()
+            logger.info(f"Successfully harvested {yield_kg}kg of {harvested_grapes.varietal} grapes from '{vineyard_name}'. Quality: {grape_quality}")
+            return harvested_grapes
         logger.warning(f"Failed to harvest grapes from '{vineyard_name}': Grapes not ready or already harvested.")
         return None
 
+    @timed_game_method
     def buy_vessel(self, vessel_type_name: str) -> Optional[WineryVessel]:
-        db_game_state = self.db.query(DBGameState).first()
-        db_player = self.db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
-        db_winery = self.db.query(DBWinery).filter(DBWinery.player_id == db_player.id).first()
+        db_player = self._get_player()
+        db_winery = db_player.winery
 
         logger.info(f"Attempting to buy vessel of type '{vessel_type_name}'. Player money: ${db_player.money}")
         if vessel_type_name in VESSEL_TYPES:
@@ -206,22 +661,24 @@ class Game:
             cost = vessel_data["cost"]
             if db_player.money >= cost:
                 new_vessel = DBWineryVessel(type=vessel_type_name, capacity=vessel_data["capacity"], in_use=False, winery_id=db_winery.id)
-                self.db.add(new_vessel)
+                db_winery.vessels.append(new_vessel)
                 db_player.money -= cost
-                self.db.commit()
-                self.db.refresh(new_vessel)
-                self.db.refresh(db_player)
+                self._bump_state_version()
+                self.db.flush()
+                purchased_vessel = WineryVessel.model_validate(new_vessel)
+                self._commit()
                 logger.info(f"Successfully purchased vessel '{vessel_type_name}'. New money: ${db_player.money}")
-                return WineryVessel.model_validate(new_vessel)
+                return purchased_vessel
             logger.warning(f"Failed to buy vessel '{vessel_type_name}': Not enough money.")
         else:
             logger.warning(f"Failed to buy vessel: Invalid vessel type name '{vessel_type_name}'.")
         return None
 
+    @timed_game_method
     def process_grapes(self, grape_index: int, sort_choice: str, destem_crush_method: str) -> Optional[Must]:
-        db_game_state = self.db.query(DBGameState).first()
-        db_player = self.db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
-        db_winery = self.db.query(DBWinery).filter(DBWinery.player_id == db_player.id).first()
+        db_game_state = self._get_game_state_row()
+        db_player = db_game_state.player
+        db_winery = db_player.winery
 
         if 0 <= grape_index < len(db_player.grapes_inventory):
             selected_grapes = db_player.grapes_inventory[grape_index]
@@ -258,20 +715,23 @@ class Game:
                 destem_crush_method=destem_crush_method,
                 winery_id=db_winery.id
             )
-            self.db.add(new_must)
+            db_winery.must_in_production.append(new_must)
+            db_player.grapes_inventory.pop(grape_index)
             self.db.delete(selected_grapes) # Remove processed grapes
-            self.db.commit()
-            self.db.refresh(new_must)
-            self.db.refresh(db_player)
-            logger.info(f"Created must from {new_must.varietal} grapes. Quantity: {new_must.quantity_kg}kg.")
-            return Must.model_validate(new_must)
+            self._bump_state_version()
+            self.db.flush()
+            created_must = Must.model_validate(new_must)
+            self._commit()
+            logger.info(f"Created must from {created_must.varietal} grapes. Quantity: {created_must.quantity_kg}kg.")
+            return created_must
         logger.warning(f"Failed to process grapes: Invalid grape index {grape_index}.")
         return None
 
+    @timed_game_method
     def start_fermentation(self, must_index: int, vessel_index: int) -> Optional[WineInProduction]:
-        db_game_state = self.db.query(DBGameState).first()
-        db_player = self.db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
-        db_winery = self.db.query(DBWinery).filter(DBWinery.player_id == db_player.id).first()
+        db_game_state = self._get_game_state_row()
+        db_player = db_game_state.player
+        db_winery = db_player.winery
 
         if not (0 <= must_index < len(db_winery.must_in_production) and \
                 0 <= vessel_index < len(db_winery.vessels)):
@@ -298,22 +758,22 @@ class Game:
                 stage="fermenting",
                 winery_id=db_winery.id
             )
-            self.db.add(new_wine_in_prod)
+            db_winery.wines_fermenting.append(new_wine_in_prod)
             db_winery.must_in_production.pop(must_index)
             self.db.delete(must)
             db_player.reputation += 3
-            self.db.commit()
-            self.db.refresh(new_wine_in_prod)
-            self.db.refresh(vessel)
-            logger.info(f"Fermentation started for {new_wine_in_prod.varietal} in {vessel.type}.")
-            return WineInProduction.model_validate(new_wine_in_prod)
+            self._bump_state_version()
+            self.db.flush()
+            fermenting_wine = WineInProduction.model_validate(new_wine_in_prod)
+            self._commit()
+            logger.info(f"Fermentation started for {fermenting_wine.varietal} in {fermenting_wine.vessel_type}.")
+            return fermenting_wine
         logger.warning(f"Failed to start fermentation: Vessel {vessel.type} (index {vessel_index}) not available or unsuitable for fermentation, or capacity too low.")
         return None
 
+    @timed_game_method
     def perform_maceration_action(self, wine_prod_index: int, action_type: str) -> bool:
-        db_game_state = self.db.query(DBGameState).first()
-        db_player = self.db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
-        db_winery = self.db.query(DBWinery).filter(DBWinery.player_id == db_player.id).first()
+        db_winery = self._get_player().winery
 
         if 0 <= wine_prod_index < len(db_winery.wines_fermenting):
             wine_prod = db_winery.wines_fermenting[wine_prod_index]
@@ -321,8 +781,8 @@ class Game:
             if GRAPE_CHARACTERISTICS[wine_prod.varietal]["color"] == "red" and wine_prod.fermentation_progress < 100:
                 wine_prod.quality = min(100, wine_prod.quality + random.randint(1, 3))
                 wine_prod.maceration_actions_taken += 1
-                self.db.commit()
-                self.db.refresh(wine_prod)
+                self._bump_state_version()
+                self._commit()
                 logger.info(f"Maceration action '{action_type}' successful. New quality: {wine_prod.quality}.")
                 return True
             logger.warning(f"Maceration action '{action_type}' not applicable for white wine {wine_prod.varietal} or fermentation is complete.")
@@ -330,10 +790,9 @@ class Game:
             logger.warning(f"Failed to perform maceration action: Invalid wine in production index {wine_prod_index}.")
         return False
 
+    @timed_game_method
     def start_aging(self, wine_prod_index: int, vessel_index: int, aging_duration: int) -> Optional[WineInProduction]:
-        db_game_state = self.db.query(DBGameState).first()
-        db_player = self.db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
-        db_winery = self.db.query(DBWinery).filter(DBWinery.player_id == db_player.id).first()
+        db_winery = self._get_player().winery
 
         if not (0 <= wine_prod_index < len(db_winery.wines_fermenting) and \
                 0 <= vessel_index < len(db_winery.vessels)):
@@ -356,19 +815,21 @@ class Game:
             wine_prod.vessel_index = vessel_index
             wine_prod.stage = "aging"
             wine_prod.aging_duration = aging_duration
+            move_wine_to_stage_collection(db_winery, wine_prod)
 
-            self.db.commit()
-            self.db.refresh(wine_prod)
-            self.db.refresh(vessel)
-            logger.info(f"Aging started for {wine_prod.varietal} in {vessel.type} for {wine_prod.aging_duration} months.")
-            return WineInProduction.model_validate(wine_prod)
+            self._bump_state_version()
+            self.db.flush()
+            aging_wine = WineInProduction.model_validate(wine_prod)
+            self._commit()
+            logger.info(f"Aging started for {aging_wine.varietal} in {aging_wine.vessel_type} for {aging_wine.aging_duration} months.")
+            return aging_wine
         logger.warning(f"Failed to start aging: Wine not fermented, vessel not available or unsuitable, or capacity too low.")
         return None
 
+    @timed_game_method
     def bottle_wine(self, wine_prod_index: int, wine_name: str) -> Optional[Wine]:
-        db_game_state = self.db.query(DBGameState).first()
-        db_player = self.db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
-        db_winery = self.db.query(DBWinery).filter(DBWinery.player_id == db_player.id).first()
+        db_player = self._get_player()
+        db_winery = db_player.winery
 
         if 0 <= wine_prod_index < len(db_winery.wines_aging):
             selected_wine_prod = db_winery.wines_aging[wine_prod_index]
@@ -386,20 +847,52 @@ class Game:
                     bottles=bottles_produced,
                     player_id=db_player.id
                 )
-                self.db.add(new_bottled_wine)
+                db_player.bottled_wines.append(new_bottled_wine)
                 db_winery.vessels[selected_wine_prod.vessel_index].in_use = False
                 db_winery.wines_aging.pop(wine_prod_index)
                 db_player.reputation += 10
-                self.db.commit()
-                self.db.refresh(new_bottled_wine)
-                self.db.refresh(db_player)
+                self._bump_state_version()
+                self.db.flush()
+                bottled_wine = Wine.model_validate(new_bottled_wine)
+                self._queue_events([self._event("wine_bottled", self._get_game_state_row(), bottled_wine.name, bottled_wine.id)])
+                self._commit()
                 logger.info(f"Successfully bottled {bottles_produced} bottles of '{wine_name}'.")
-                return Wine.model_validate(new_bottled_wine)
+                return bottled_wine
             logger.warning(f"Failed to bottle wine '{wine_name}': Wine not ready for bottling (aging not complete).")
         else:
             logger.warning(f"Failed to bottle wine: Invalid wine in production index {wine_prod_index}.")
         return None
 
+    @timed_game_method
+    def execute_actions(self, commands: List[ActionCommand]) -> Tuple[Optional[ActionsResult], Optional[int]]:
+        """Runs the commands in order as a single transaction.
+
+        Either every command succeeds and the batch commits once, returning `(result, None)`, or the
+        first failing command rolls the whole batch back and `(None, failed_index)` is returned.
+        An invalid batch size returns `(None, None)`.
+        """
+        if not 1 <= len(commands) <= MAX_BATCH_COMMANDS:
+            logger.warning(f"Failed to execute actions: batch size {len(commands)} must be between 1 and {MAX_BATCH_COMMANDS}.")
+            return None, None
+        self.autocommit = False
+        results = []
+        try:
+            for index, command in enumerate(commands):
+                result = ACTION_HANDLERS[command.action](self, command.params)
+                if result is None or result is False:
+                    self.db.rollback()
+                    logger.warning(f"Batch rolled back: command {index} ({command.action}) failed.")
+                    return None, index
+                results.append(ActionResult(action=command.action, result=None if result is True else result))
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        finally:
+            self.autocommit = True
+        logger.info(f"Executed a batch of {len(results)} actions.")
+        return ActionsResult(results=results), None
+
     def get_available_vineyards_for_purchase(self) -> List[Dict[str, Any]]:
         logger.info("Retrieving available vineyards for purchase.")
         available_vineyards = []
@@ -415,3 +908,229 @@ class Game:
         for vessel_name, data in VESSEL_TYPES.items():
             available_vessel_types.append({"name": vessel_name, "capacity": data["capacity"], "cost": data["cost"], "type": data["type"]})
         return available_vessel_types
+
+
+# Batch command name -> the Game method call for its request model
+ACTION_HANDLERS = {
+    "buy_vineyard": lambda game, params: game.buy_vineyard(params.vineyard_data, params.vineyard_name),
+    "tend_vineyard": lambda game, params: game.tend_vineyard(params.vineyard_name),
+    "harvest_grapes": lambda game, params: game.harvest_grapes(params.vineyard_name),
+    "buy_vessel": lambda game, params: game.buy_vessel(params.vessel_type_name),
+    "process_grapes": lambda game, params: game.process_grapes(params.grape_index, params.sort_choice, params.destem_crush_method),
+    "start_fermentation": lambda game, params: game.start_fermentation(params.must_index, params.vessel_index),
+    "perform_maceration_action": lambda game, params: game.perform_maceration_action(params.wine_prod_index, params.action_type),
+    "start_aging": lambda game, params: game.start_aging(params.wine_prod_index, params.vessel_index, params.aging_duration),
+    "bottle_wine": lambda game, params: game.bottle_wine(params.wine_prod_index, params.wine_name),
+}
+
+class AsyncGame:
+    """Async facade over `Game` for use from the FastAPI handlers.
+
+    Each call runs the synchronous `Game` method through `AsyncSession.run_sync`, so the
+    rules (and lazy loads) stay in one place while the database I/O is awaited instead of
+    blocking the event loop.
+    """
+    def __init__(self, db: AsyncSession, player_id: Optional[int] = None, context: Optional[PlayerContext] = None):
+        self.db = db
+        self.player_id = player_id
+        self.context = context
+
+    async def _run(self, method_name: str, *args):
+        if self.context is not None and self.context.cached:
+            return await self.context.run(self.db, method_name, *args)
+        return await self.db.run_sync(lambda session: getattr(Game(session, self.player_id, self.context), method_name)(*args))
+
+    async def get_game_state(self) -> GameState:
+        return await self._run("get_game_state")
+
+    async def execute_actions(self, commands: List[ActionCommand]) -> Tuple[Optional[ActionsResult], Optional[int]]:
+        return await self._run("execute_actions", commands)
+
+    async def get_state_delta(self, since_version: int) -> GameStateDelta:
+        return await self._run("get_state_delta", since_version)
+
+    async def list_grapes_inventory(self, query: InventoryQuery) -> Optional[Tuple[List[Grape], Optional[str]]]:
+        return await self._run("list_grapes_inventory", query)
+
+    async def list_bottled_wines(self, query: InventoryQuery) -> Optional[Tuple[List[Wine], Optional[str]]]:
+        return await self._run("list_bottled_wines", query)
+
+    async def advance_month(self, bulk: bool = False) -> List[GameEvent]:
+        return await self._run("advance_month", bulk)
+
+    async def advance_months(self, months: int) -> Optional[AdvanceMonthsResult]:
+        return await self._run("advance_months", months)
+
+    async def advance_until_next_event(self, max_months: int = DEFAULT_EVENT_HORIZON_MONTHS) -> Optional[AdvanceMonthsResult]:
+        return await self._run("advance_until_next_event", max_months)
+
+    async def buy_vineyard(self, vineyard_data: Dict[str, Any], vineyard_name: str) -> Optional[Vineyard]:
+        return await self._run("buy_vineyard", vineyard_data, vineyard_name)
+
+    async def tend_vineyard(self, vineyard_name: str) -> bool:
+        return await self._run("tend_vineyard", vineyard_name)
+
+    async def harvest_grapes(self, vineyard_name: str) -> Optional[Grape]:
+        return await self._run("harvest_grapes", vineyard_name)
+
+    async def buy_vessel(self, vessel_type_name: str) -> Optional[WineryVessel]:
+        return await self._run("buy_vessel", vessel_type_name)
+
+    async def process_grapes(self, grape_index: int, sort_choice: str, destem_crush_method: str) -> Optional[Must]:
+        return await self._run("process_grapes", grape_index, sort_choice, destem_crush_method)
+
+    async def start_fermentation(self, must_index: int, vessel_index: int) -> Optional[WineInProduction]:
+        return await self._run("start_fermentation", must_index, vessel_index)
+
+    async def perform_maceration_action(self, wine_prod_index: int, action_type: str) -> bool:
+        return await self._run("perform_maceration_action", wine_prod_index, action_type)
+
+    async def start_aging(self, wine_prod_index: int, vessel_index: int, aging_duration: int) -> Optional[WineInProduction]:
+        return await self._run("start_aging", wine_prod_index, vessel_index, aging_duration)
+
+    async def bottle_wine(self, wine_prod_index: int, wine_name: str) -> Optional[Wine]:
+        return await self._run("bottle_wine", wine_prod_index, wine_name)
+
+    def get_available_vineyards_for_purchase(self) -> List[Dict[str, Any]]:
+        return Game(self.db.sync_session).get_available_vineyards_for_purchase()
+
+    def get_available_vessel_types_for_purchase(self) -> List[Dict[str, Any]]:
+        return Game(self.db.sync_session).get_available_vessel_types_for_purchase()
+
+# --- Storage adapter for the in-memory simulation core (simulation.py) ---
+
+# Fields the adapter never writes back: ids are assigned by the database, state_version by _bump_state_version
+SIMULATION_READ_ONLY_FIELDS = ("id", "state_version")
+
+def _entity_from_row(cls, row):
+    return cls(**{name: getattr(row, name) for name in SIMULATION_FIELDS[cls]})
+
+def _copy_entity_to_row(entity: SimEntity, row):
+    for name in SIMULATION_FIELDS[type(entity)]:
+        value = getattr(entity, name)
+        # Only changed values are set, so untouched rows stay clean and keep their version
+        if name not in SIMULATION_READ_ONLY_FIELDS and getattr(row, name) != value:
+            setattr(row, name, value)
+
+def _sync_collection(collection, entities: List[SimEntity], db_class, created: List[Tuple[SimEntity, Any]]):
+    rows_by_id = {row.id: row for row in collection}
+    kept_ids = set()
+    for entity in entities:
+        row = rows_by_id.get(entity.id) if entity.id is not None else None
+        if row is None:
+            row = db_class()
+            collection.append(row)
+            created.append((entity, row))
+        else:
+            kept_ids.add(entity.id)
+        _copy_entity_to_row(entity, row)
+    for row_id, row in rows_by_id.items():
+        if row_id not in kept_ids:
+            collection.remove(row) # The delete-orphan cascade deletes the row, leaving a tombstone
+
+def _sync_wines_in_production(db_winery: DBWinery, winery: SimWinery, created: List[Tuple[SimEntity, Any]]):
+    # Same as _sync_collection, except that a wine may have moved between the two stage collections
+    rows_by_id = {row.id: row for row in itertools.chain(db_winery.wines_fermenting, db_winery.wines_aging)}
+    kept_ids = set()
+    for entity in itertools.chain(winery.wines_fermenting, winery.wines_aging):
+        row = rows_by_id.get(entity.id) if entity.id is not None else None
+        if row is None:
+            row = DBWineInProduction()
+            _copy_entity_to_row(entity, row)
+            getattr(db_winery, f"wines_{entity.stage}").append(row)
+            created.append((entity, row))
+            continue
+        kept_ids.add(entity.id)
+        stage_changed = row.stage != entity.stage
+        _copy_entity_to_row(entity, row)
+        if stage_changed:
+            move_wine_to_stage_collection(db_winery, row)
+    for row_id, row in rows_by_id.items():
+        if row_id not in kept_ids:
+            getattr(db_winery, f"wines_{row.stage}").remove(row)
+
+def _simulation_from_rows(db_game_state: DBGameState) -> Simulation:
+    db_player = db_game_state.player
+    player = _entity_from_row(SimPlayer, db_player)
+    player.vineyards = [_entity_from_row(SimVineyard, row) for row in db_player.vineyards]
+    player.grapes_inventory = [_entity_from_row(SimGrape, row) for row in db_player.grapes_inventory]
+    player.bottled_wines = [_entity_from_row(SimWine, row) for row in db_player.bottled_wines]
+    if db_player.winery:
+        db_winery = db_player.winery
+        player.winery = _entity_from_row(SimWinery, db_winery)
+        player.winery.vessels = [_entity_from_row(SimVessel, row) for row in db_winery.vessels]
+        player.winery.must_in_production = [_entity_from_row(SimMust, row) for row in db_winery.must_in_production]
+        player.winery.wines_fermenting = [_entity_from_row(SimWineInProduction, row) for row in db_winery.wines_fermenting]
+        player.winery.wines_aging = [_entity_from_row(SimWineInProduction, row) for row in db_winery.wines_aging]
+    state = _entity_from_row(SimGameState, db_game_state)
+    state.player = player
+    return Simulation(state)
+
+def _write_simulation_to_rows(game: Game, db_game_state: DBGameState, simulation: Simulation) -> Tuple[List[Tuple[SimEntity, Any]], List[GameEvent]]:
+    """Copies the simulation onto the loaded rows as one new state version, flushes and queues its events.
+
+    Returns the entities that got their ids from this flush and the events whose subject_id was filled
+    in from them, so a failed commit can put them back. Nothing is written if nothing changed.
+    """
+    db = game.db
+    state = simulation.state
+    db_player = db_game_state.player
+    created: List[Tuple[SimEntity, Any]] = []
+    _copy_entity_to_row(state, db_game_state)
+    _copy_entity_to_row(state.player, db_player)
+    _sync_collection(db_player.vineyards, state.player.vineyards, DBVineyard, created)
+    _sync_collection(db_player.grapes_inventory, state.player.grapes_inventory, DBGrape, created)
+    _sync_collection(db_player.bottled_wines, state.player.bottled_wines, DBWine, created)
+    if db_player.winery and state.player.winery:
+        _copy_entity_to_row(state.player.winery, db_player.winery)
+        _sync_collection(db_player.winery.vessels, state.player.winery.vessels, DBWineryVessel, created)
+        _sync_collection(db_player.winery.must_in_production, state.player.winery.must_in_production, DBMust, created)
+        _sync_wines_in_production(db_player.winery, state.player.winery, created)
+    if not (db.new or db.dirty or db.deleted or simulation.pending_events):
+        return created, [] # Nothing changed since the last save
+
+    game._bump_state_version()
+    db.flush()
+    state.player.state_version = db_player.state_version
+    for entity, row in created:
+        entity.id = row.id
+    unsaved_subjects = [event for event, entity in simulation.pending_events if event.subject_id is None and entity is not None]
+    for event, entity in simulation.pending_events:
+        if event.subject_id is None and entity is not None:
+            event.subject_id = entity.id # Created and reported before it was ever saved
+    game._queue_events([event for event, _ in simulation.pending_events])
+    simulation.pending_events.clear()
+    return created, unsaved_subjects
+
+def load_simulation(db: Session, player_id: Optional[int] = None) -> Optional[Simulation]:
+    """Copies a player's save into an in-memory `Simulation`, with the same fixed query plan as `get_game_state`."""
+    db_game_state = Game(db, player_id)._load_game_state()
+    return _simulation_from_rows(db_game_state) if db_game_state else None
+
+def save_simulation(db: Session, simulation: Simulation, commit: bool = True) -> bool:
+    """Writes a `Simulation` back through the DB* models as one new state version.
+
+    Only rows whose values changed are updated; entities the simulation created are inserted and get
+    their ids, and rows it dropped are deleted. Pending events are queued for the player's subscribers
+    and published when the transaction commits. Returns False if the player's save no longer exists.
+    """
+    state = simulation.state
+    game = Game(db, state.player.id)
+    db_game_state = game._load_game_state()
+    if db_game_state is None:
+        return False
+    state_version, pending_events = state.player.state_version, list(simulation.pending_events)
+    created, unsaved_subjects = _write_simulation_to_rows(game, db_game_state, simulation)
+    if commit:
+        try:
+            db.commit()
+        except Exception:
+            # Leave the simulation as it was, so saving it can simply be retried
+            for entity, _ in created:
+                entity.id = None
+            for event in unsaved_subjects:
+                event.subject_id = None
+            state.player.state_version = state_version
+            simulation.pending_events[:] = pending_events
+            raise
+    return True
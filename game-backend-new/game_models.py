@@ -1,27 +1,33 @@
-from pydantic import BaseModel
-from typing import List, Dict, Any, Optional
-from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey
-from sqlalchemy.orm import relationship
-from sqlalchemy.types import TypeDecorator, VARCHAR
-import json
+from pydantic import BaseModel, Field
+from typing import List, Dict, Any, Optional, Literal, Union, Annotated
+from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, UniqueConstraint, Index
+from sqlalchemy.orm import relationship, backref, deferred
+from sqlalchemy.types import TypeDecorator, JSON
+from sqlalchemy.dialects.postgresql import JSONB
 
 from database import Base
 
-# Custom type for JSON storage
-class JSONEncodedDict(TypeDecorator):
-    impl = VARCHAR
+# The static calendar; it's the same for every save, so it isn't stored per game state
+MONTHS = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
 
-    def process_bind_param(self, value, dialect):
-        if value is not None:
-            return json.dumps(value)
-        return value
+# Custom type for JSON storage
+class JSONType(TypeDecorator):
+    """JSON column using the backend's native type: JSONB on PostgreSQL, JSON (stored as text on SQLite)
+    everywhere else."""
+    impl = JSON
+    cache_ok = True
 
-    def process_result_value(self, value, dialect):
-        if value is not None:
-            return json.loads(value)
-        return value
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(JSONB())
+        return dialect.type_descriptor(JSON())
 
 # SQLAlchemy ORM Models
+class VersionedEntity:
+    """Rows stamped with the player's state_version of their last change, so `/gamestate/delta` can
+    find everything changed since a version the client already has."""
+    version = Column(Integer, nullable=False, default=0, server_default="0", index=True)
+
 class DBGrapeCharacteristics(Base):
     __tablename__ = "grape_characteristics"
     id = Column(Integer, primary_key=True, index=True)
@@ -33,8 +39,9 @@ class DBRegionData(Base):
     __tablename__ = "region_data"
     id = Column(Integer, primary_key=True, index=True)
     climate = Column(String)
-    soil_types = Column(JSONEncodedDict) # Storing as JSON string
-    grape_varietals = Column(JSONEncodedDict) # Storing as JSON string
+    # Deferred: only fetched and decoded when the attribute is first accessed
+    soil_types = deferred(Column(JSONType))
+    grape_varietals = deferred(Column(JSONType))
     base_cost = Column(Integer)
 
 class DBVesselTypeData(Base):
@@ -44,19 +51,25 @@ class DBVesselTypeData(Base):
     cost = Column(Integer)
     type = Column(String)
 
-class DBGrape(Base):
+class DBGrape(VersionedEntity, Base):
     __tablename__ = "grapes"
+    # Keyset pagination of the inventory: one index per supported sort order, plus varietal filtering
+    __table_args__ = (
+        Index("ix_grapes_player_quality", "player_id", "quality", "id"),
+        Index("ix_grapes_player_vintage", "player_id", "vintage", "id"),
+        Index("ix_grapes_player_varietal_quality", "player_id", "varietal", "quality", "id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
-    player_id = Column(Integer, ForeignKey("players.id"))
+    player_id = Column(Integer, ForeignKey("players.id"), index=True)
     varietal = Column(String)
-    vintage = Column(Integer)
+    vintage = Column(Integer, nullable=False) # Sort keys for keyset pagination, which can't page over NULLs
     quantity_kg = Column(Float)
-    quality = Column(Integer)
+    quality = Column(Integer, nullable=False)
 
-class DBMust(Base):
+class DBMust(VersionedEntity, Base):
     __tablename__ = "musts"
     id = Column(Integer, primary_key=True, index=True)
-    winery_id = Column(Integer, ForeignKey("wineries.id"))
+    winery_id = Column(Integer, ForeignKey("wineries.id"), index=True)
     varietal = Column(String)
     vintage = Column(Integer)
     quantity_kg = Column(Float)
@@ -65,10 +78,10 @@ class DBMust(Base):
     destem_crush_method = Column(String)
     fermented = Column(Boolean, default=False)
 
-class DBWineInProduction(Base):
+class DBWineInProduction(VersionedEntity, Base):
     __tablename__ = "wines_in_production"
     id = Column(Integer, primary_key=True, index=True)
-    winery_id = Column(Integer, ForeignKey("wineries.id"))
+    winery_id = Column(Integer, ForeignKey("wineries.id"), index=True)
     varietal = Column(String)
     vintage = Column(Integer)
     quantity_liters = Column(Float)
@@ -81,22 +94,30 @@ class DBWineInProduction(Base):
     aging_duration = Column(Integer, default=0)
     maceration_actions_taken = Column(Integer, default=0)
 
-class DBWine(Base):
+class DBWine(VersionedEntity, Base):
     __tablename__ = "wines"
+    # Keyset pagination of the cellar: one index per supported sort order, plus varietal filtering
+    __table_args__ = (
+        Index("ix_wines_player_quality", "player_id", "quality", "id"),
+        Index("ix_wines_player_vintage", "player_id", "vintage", "id"),
+        Index("ix_wines_player_varietal_quality", "player_id", "varietal", "quality", "id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
-    player_id = Column(Integer, ForeignKey("players.id"))
+    player_id = Column(Integer, ForeignKey("players.id"), index=True)
     name = Column(String)
-    vintage = Column(Integer)
+    vintage = Column(Integer, nullable=False) # Sort keys, like DBGrape's
     varietal = Column(String)
     style = Column(String)
-    quality = Column(Integer)
+    quality = Column(Integer, nullable=False)
     bottles = Column(Integer)
 
-class DBVineyard(Base):
+class DBVineyard(VersionedEntity, Base):
     __tablename__ = "vineyards"
+    # Vineyard names are unique per player, not globally, so every player can own a "Home Block"
+    __table_args__ = (UniqueConstraint("player_id", "name", name="uq_vineyards_player_name"),)
     id = Column(Integer, primary_key=True, index=True)
-    player_id = Column(Integer, ForeignKey("players.id"))
-    name = Column(String, unique=True, index=True)
+    player_id = Column(Integer, ForeignKey("players.id"), index=True)
+    name = Column(String)
     varietal = Column(String)
     region = Column(String)
     size_acres = Column(Integer, default=5)
@@ -106,10 +127,10 @@ class DBVineyard(Base):
     grapes_ready = Column(Boolean, default=False)
     harvested_this_year = Column(Boolean, default=False)
 
-class DBWineryVessel(Base):
+class DBWineryVessel(VersionedEntity, Base):
     __tablename__ = "winery_vessels"
     id = Column(Integer, primary_key=True, index=True)
-    winery_id = Column(Integer, ForeignKey("wineries.id"))
+    winery_id = Column(Integer, ForeignKey("wineries.id"), index=True)
     type = Column(String)
     capacity = Column(Integer)
     in_use = Column(Boolean, default=False)
@@ -117,32 +138,50 @@ class DBWineryVessel(Base):
 class DBWinery(Base):
     __tablename__ = "wineries"
     id = Column(Integer, primary_key=True, index=True)
-    player_id = Column(Integer, ForeignKey("players.id"))
+    player_id = Column(Integer, ForeignKey("players.id"), index=True)
     name = Column(String, default="Main Winery")
-    vessels = relationship("DBWineryVessel", backref="winery", cascade="all, delete-orphan")
-    must_in_production = relationship("DBMust", backref="winery", cascade="all, delete-orphan")
-    wines_fermenting = relationship("DBWineInProduction", primaryjoin="and_(DBWineInProduction.winery_id==DBWinery.id, DBWineInProduction.stage=='fermenting')", backref="fermenting_winery", cascade="all, delete-orphan", overlaps="aging_winery,wines_aging")
-    wines_aging = relationship("DBWineInProduction", primaryjoin="and_(DBWineInProduction.winery_id==DBWinery.id, DBWineInProduction.stage=='aging')", backref="aging_winery", cascade="all, delete-orphan", overlaps="fermenting_winery,wines_fermenting")
+    # Collections are ordered by id: the API addresses vessels, musts and wines by list index
+    vessels = relationship("DBWineryVessel", backref="winery", cascade="all, delete-orphan", order_by="DBWineryVessel.id")
+    must_in_production = relationship("DBMust", backref="winery", cascade="all, delete-orphan", order_by="DBMust.id")
+    wines_fermenting = relationship("DBWineInProduction", primaryjoin="and_(DBWineInProduction.winery_id==DBWinery.id, DBWineInProduction.stage=='fermenting')", backref="fermenting_winery", cascade="all, delete-orphan", overlaps="aging_winery,wines_aging,wines_in_production", order_by="DBWineInProduction.id")
+    wines_aging = relationship("DBWineInProduction", primaryjoin="and_(DBWineInProduction.winery_id==DBWinery.id, DBWineInProduction.stage=='aging')", backref="aging_winery", cascade="all, delete-orphan", overlaps="fermenting_winery,wines_fermenting,wines_in_production", order_by="DBWineInProduction.id")
+    # Every stage in one collection, so eager loads fetch the table once and partition it in Python
+    wines_in_production = relationship("DBWineInProduction", viewonly=True, order_by="DBWineInProduction.id")
 
 class DBPlayer(Base):
     __tablename__ = "players"
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, default="Winemaker")
+    name = Column(String, default="Winemaker", index=True)
     money = Column(Float, default=100000)
     reputation = Column(Integer, default=50)
-    vineyards = relationship("DBVineyard", backref="player", cascade="all, delete-orphan")
+    # Bumped by every mutating Game method; clients use it for conditional GETs
+    state_version = Column(Integer, nullable=False, default=0, server_default="0")
+    vineyards = relationship("DBVineyard", backref="player", cascade="all, delete-orphan", order_by="DBVineyard.id")
     winery = relationship("DBWinery", uselist=False, backref="player", cascade="all, delete-orphan")
-    grapes_inventory = relationship("DBGrape", backref="player", cascade="all, delete-orphan")
-    bottled_wines = relationship("DBWine", backref="player", cascade="all, delete-orphan")
+    grapes_inventory = relationship("DBGrape", backref="player", cascade="all, delete-orphan", order_by="DBGrape.id")
+    bottled_wines = relationship("DBWine", backref="player", cascade="all, delete-orphan", order_by="DBWine.id")
 
 class DBGameState(Base):
     __tablename__ = "game_state"
     id = Column(Integer, primary_key=True, index=True)
-    player_id = Column(Integer, ForeignKey("players.id"))
-    player = relationship("DBPlayer", uselist=False, backref="game_state", cascade="all, delete-orphan", single_parent=True)
+    player_id = Column(Integer, ForeignKey("players.id"), unique=True, index=True) # One save per player
+    player = relationship("DBPlayer", uselist=False, backref=backref("game_state", uselist=False), cascade="all, delete-orphan", single_parent=True)
     current_year = Column(Integer)
     current_month_index = Column(Integer)
-    months = Column(JSONEncodedDict) # Storing as JSON string
+
+    @property
+    def months(self) -> List[str]:
+        return MONTHS
+
+class DBTombstone(Base):
+    """Records a deleted versioned row, so deltas can tell clients to drop it."""
+    __tablename__ = "tombstones"
+    __table_args__ = (Index("ix_tombstones_player_version", "player_id", "version"),)
+    id = Column(Integer, primary_key=True, index=True)
+    player_id = Column(Integer, ForeignKey("players.id"))
+    entity_type = Column(String)
+    entity_id = Column(Integer)
+    version = Column(Integer)
 
 # Pydantic Models (for API request/response validation)
 class GrapeCharacteristics(BaseModel):
@@ -246,6 +285,7 @@ class Player(BaseModel):
     name: str = "Winemaker"
     money: float = 100000
     reputation: int = 50
+    state_version: int = 0
     vineyards: List[Vineyard] = []
     winery: Optional[Winery] = None
     grapes_inventory: List[Grape] = []
@@ -262,6 +302,54 @@ class GameState(BaseModel):
 
     model_config = {"from_attributes": True}
 
+class GameEvent(BaseModel):
+    type: str # "grapes_ready", "fermentation_complete", "aging_complete" or "wine_bottled"
+    year: int
+    month: str
+    subject: str # Vineyard name or wine varietal
+    subject_id: Optional[int] = None
+
+class AdvanceMonthsResult(BaseModel):
+    game_state: GameState
+    events: List[GameEvent] = []
+    months_advanced: int = 0
+
+class InventoryQuery(BaseModel):
+    """Filters, sort order and keyset cursor for the grape inventory and cellar listings.
+
+    `sort` is `id`, `quality` or `vintage`, prefixed with `-` for descending order. `cursor` is the
+    opaque value returned in the previous page's X-Next-Cursor header.
+    """
+    varietal: Optional[str] = None
+    vintage: Optional[int] = None
+    min_quality: Optional[int] = None
+    sort: str = "id"
+    limit: int = 100
+    cursor: Optional[str] = None
+
+class DeletedEntity(BaseModel):
+    entity_type: str
+    id: int
+
+class GameStateDelta(BaseModel):
+    """Everything that changed after `since_version`. When the server can't compute that (unknown or
+    too old version), `full_resync` is set and `game_state` carries the complete state instead."""
+    since_version: int
+    state_version: int
+    full_resync: bool = False
+    game_state: Optional[GameState] = None
+    current_year: int
+    current_month_index: int
+    money: float
+    reputation: int
+    vineyards: List[Vineyard] = []
+    grapes: List[Grape] = []
+    musts: List[Must] = []
+    wines_in_production: List[WineInProduction] = []
+    wines: List[Wine] = []
+    winery_vessels: List[WineryVessel] = []
+    deleted: List[DeletedEntity] = []
+
 # Request Body Models
 class BuyVineyardRequest(BaseModel):
     vineyard_data: Dict[str, Any]
@@ -296,4 +384,63 @@ class StartAgingRequest(BaseModel):
 
 class BottleWineRequest(BaseModel):
     wine_prod_index: int
-    wine_name: str
\ No newline at end of file
+    wine_name: str
+
+class AdvanceMonthsRequest(BaseModel):
+    months: int
+
+# Batched actions: each command names a Game action and carries that action's request model
+class BuyVineyardCommand(BaseModel):
+    action: Literal["buy_vineyard"]
+    params: BuyVineyardRequest
+
+class TendVineyardCommand(BaseModel):
+    action: Literal["tend_vineyard"]
+    params: TendVineyardRequest
+
+class HarvestGrapesCommand(BaseModel):
+    action: Literal["harvest_grapes"]
+    params: HarvestGrapesRequest
+
+class BuyVesselCommand(BaseModel):
+    action: Literal["buy_vessel"]
+    params: BuyVesselRequest
+
+class ProcessGrapesCommand(BaseModel):
+    action: Literal["process_grapes"]
+    params: ProcessGrapesRequest
+
+class StartFermentationCommand(BaseModel):
+    action: Literal["start_fermentation"]
+    params: StartFermentationRequest
+
+class PerformMacerationActionCommand(BaseModel):
+    action: Literal["perform_maceration_action"]
+    params: PerformMacerationActionRequest
+
+class StartAgingCommand(BaseModel):
+    action: Literal["start_aging"]
+    params: StartAgingRequest
+
+class BottleWineCommand(BaseModel):
+    action: Literal["bottle_wine"]
+    params: BottleWineRequest
+
+ActionCommand = Annotated[
+    Union[
+        BuyVineyardCommand, TendVineyardCommand, HarvestGrapesCommand, BuyVesselCommand, ProcessGrapesCommand,
+        StartFermentationCommand, PerformMacerationActionCommand, StartAgingCommand, BottleWineCommand,
+    ],
+    Field(discriminator="action"),
+]
+
+class ActionsRequest(BaseModel):
+    commands: List[ActionCommand]
+
+class ActionResult(BaseModel):
+    action: str
+    # The created or updated entity for actions that return one; None for tend_vineyard and maceration
+    result: Optional[Union[Vineyard, Grape, WineryVessel, Must, WineInProduction, Wine]] = None
+
+class ActionsResult(BaseModel):
+    results: List[ActionResult] = []
@@ -1,19 +1,31 @@
+import asyncio
 import os
-from fastapi import FastAPI, HTTPException, Depends, Request, status, APIRouter
-from fastapi.responses import JSONResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, status, APIRouter, WebSocket, WebSocketDisconnect
+from starlette.requests import HTTPConnection
+from fastapi.responses import JSONResponse, FileResponse, Response
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-from contextlib import asynccontextmanager
-from game_logic import Game, REGIONS, GRAPE_CHARACTERISTICS, VESSEL_TYPES
+from sqlalchemy.ext.asyncio import AsyncSession
+from contextlib import asynccontextmanager, suppress
+from game_logic import Game, AsyncGame, PlayerContext, create_new_game, load_player_context, PLAYER_CONTEXT_LOADER_OPTIONS, REGIONS, GRAPE_CHARACTERISTICS, VESSEL_TYPES, DEFAULT_EVENT_HORIZON_MONTHS
 from game_models import (
     Player, Vineyard, Winery, Grape, Must, WineInProduction, Wine, GameState, WineryVessel,
     BuyVineyardRequest, TendVineyardRequest, HarvestGrapesRequest, BuyVesselRequest,
     ProcessGrapesRequest, StartFermentationRequest, PerformMacerationActionRequest,
-    StartAgingRequest, BottleWineRequest,
+    StartAgingRequest, BottleWineRequest, AdvanceMonthsRequest, AdvanceMonthsResult, GameStateDelta, ActionsRequest, ActionsResult, InventoryQuery,
     DBPlayer, DBVineyard, DBWinery, DBGrape, DBMust, DBWineInProduction, DBWine, DBWineryVessel, DBGameState
 )
-from database import SessionLocal, engine, Base
-from typing import List, Dict, Any, Optional
+from event_hub import hub
+from responses import fast_response
+from token_cache import token_cache
+from static_assets import StaticAssets
+from player_locks import player_locks
+from metrics import MetricsMiddleware, QueryStatsMiddleware, metrics_router, METRICS_ENABLED, QUERY_STATS_ENABLED
+from profiling import ProfilingMiddleware, profiling_router, PROFILING_ENABLED
+from diagnostics import diagnostics_router, DIAGNOSTICS_TOKEN
+from write_behind import write_behind_cache, recover_journal, WRITE_BEHIND_ENABLED
+from database import SessionLocal, AsyncSessionLocal, AsyncReadSessionLocal, engine, Base, add_missing_columns, migrate_per_player_unique_keys, create_missing_indexes, run_sqlite_maintenance, sqlite_maintenance_loop, SQLITE_MAINTENANCE_INTERVAL_SECONDS
+from typing import Annotated, AsyncIterator, List, Dict, Any, Optional
 import logging
 
 # For JWT authentication
@@ -29,46 +41,57 @@ logger = logging.getLogger(__name__)
 
 def initialize_database(db: Session):
     Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine, Base.metadata)
+    migrate_per_player_unique_keys(engine)
+    create_missing_indexes(engine, Base.metadata)
     logger.info("Database tables created or already exist.")
 
     game_state = db.query(DBGameState).first()
     if not game_state:
         logger.info("Initializing new game state.")
-        player = DBPlayer(name="Winemaker", money=100000, reputation=50)
-        db.add(player)
-        db.flush()
-
-        initial_vessels = [
-            DBWineryVessel(type="Stainless Steel Tank", capacity=5000, in_use=False),
-            DBWineryVessel(type="Open Top Fermenter", capacity=1000, in_use=False),
-            DBWineryVessel(type="Neutral Oak Barrel (225L)", capacity=225, in_use=False),
-            DBWineryVessel(type="Neutral Oak Barrel (225L)", capacity=225, in_use=False),
-            DBWineryVessel(type="Neutral Oak Barrel (225L)", capacity=225, in_use=False),
-        ]
-        winery = DBWinery(name="Main Winery", player_id=player.id, vessels=initial_vessels)
-        db.add(winery)
-        db.flush()
-        player.winery = winery
-
-        starting_vineyard = DBVineyard(name="Home Block", varietal="Pinot Noir", region="Willamette Valley", size_acres=5, player_id=player.id)
-        db.add(starting_vineyard)
-
-        months_list = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
-        game_state = DBGameState(player_id=player.id, current_year=2025, current_month_index=0, months=months_list)
-        db.add(game_state)
-        db.commit()
+        create_new_game(db, "Winemaker")
         logger.info("Game state initialized successfully.")
     else:
         logger.info("Game state already exists. Loading existing game.")
 
+def ensure_player_game(db: Session, player_name: str):
+    """Creates a save for players logging in for the first time."""
+    if db.query(DBPlayer.id).filter(DBPlayer.name == player_name).first() is None:
+        logger.info(f"Creating a new game for player {player_name}.")
+        create_new_game(db, player_name)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    db = SessionLocal()
-    initialize_database(db)
+    with SessionLocal() as db:
+        initialize_database(db)
+        recover_journal(db) # Changes a crashed write-behind process held in memory, even if the mode is now off
+    with engine.connect() as connection:
+        run_sqlite_maintenance(connection, analyze=True)
+    maintenance_task = None
+    if SQLITE_MAINTENANCE_INTERVAL_SECONDS > 0:
+        maintenance_task = asyncio.create_task(sqlite_maintenance_loop())
+    if WRITE_BEHIND_ENABLED:
+        write_behind_cache.start()
     yield
+    if WRITE_BEHIND_ENABLED:
+        await write_behind_cache.close()
+    if maintenance_task:
+        maintenance_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await maintenance_task
 
 app = FastAPI(lifespan=lifespan)
 api_router = APIRouter()
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(metrics_router)
+if QUERY_STATS_ENABLED:
+    app.add_middleware(QueryStatsMiddleware)
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
+    app.include_router(profiling_router)
+if DIAGNOSTICS_TOKEN:
+    app.include_router(diagnostics_router)
 
 # Dependency to get DB session
 def get_db():
@@ -78,6 +101,15 @@ def get_db():
     finally:
         db.close()
 
+# Requests that can't change game state are served from the read-only engine
+READ_ONLY_METHODS = ("GET", "HEAD")
+
+# Async dependency used by the API handlers (WebSocket connections have no method and only read)
+async def get_async_db(connection: HTTPConnection):
+    session_factory = AsyncReadSessionLocal if connection.scope.get("method", "GET") in READ_ONLY_METHODS else AsyncSessionLocal
+    async with session_factory() as db:
+        yield db
+
 # Custom exception handler for HTTPExceptions
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
@@ -104,29 +136,72 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+async def authenticate_token(token: str, db: AsyncSession) -> Optional[DBPlayer]:
+    """Returns the player a JWT was issued to, or None if the token is invalid or the player is gone.
+
+    Verified tokens are cached with the player id they resolved to, so repeat requests skip the
+    signature check and the lookup by name and only load the player by primary key.
+    """
+    player_id = token_cache.get(token)
+    if player_id is not None:
+        player = await db.get(DBPlayer, player_id, options=PLAYER_CONTEXT_LOADER_OPTIONS)
+        if player is None:
+            token_cache.invalidate_player(player_id)
+        return player
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        user = db.query(DBPlayer).filter(DBPlayer.name == username).first()
-        if user is None:
-            raise credentials_exception
-        return user
     except JWTError:
-        raise credentials_exception
+        return None
+    username: str = payload.get("sub")
+    if username is None:
+        return None
+    result = await db.execute(select(DBPlayer).options(*PLAYER_CONTEXT_LOADER_OPTIONS).filter(DBPlayer.name == username))
+    player = result.scalars().first()
+    if player is not None:
+        token_cache.put(token, player.id, payload.get("exp"))
+    return player
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    user = await authenticate_token(token, db)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return user
+
+def require_game_state(context: Optional[PlayerContext]) -> PlayerContext:
+    # A player whose save is gone (or was never created) gets the same answer on every path
+    if context is None or context.game_state is None:
+        raise HTTPException(status_code=404, detail="Game state not found.")
+    return context
+
+async def get_player_context(connection: HTTPConnection, current_user: DBPlayer = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)) -> AsyncIterator[PlayerContext]:
+    player_id = current_user.id
+    if connection.scope.get("method", "GET") in READ_ONLY_METHODS:
+        if WRITE_BEHIND_ENABLED and (context := write_behind_cache.cached_context(player_id)) is not None:
+            yield context # The database may lag behind what's held in memory
+            return
+        # get_current_user already loaded the player with its game state and winery into this session,
+        # so this is an identity map hit rather than another round of queries
+        yield require_game_state(await db.run_sync(lambda session: load_player_context(session, player_id)))
+        return
+    # Mutating requests hold the player's lock until the handler is done, so each one sees the state
+    # the previous one committed; other players' requests don't wait on it.
+    async with player_locks.hold(player_id):
+        if WRITE_BEHIND_ENABLED:
+            yield require_game_state(await write_behind_cache.context(player_id))
+            return
+        # What auth loaded may predate a commit made while this request waited for the lock
+        yield require_game_state(await db.run_sync(lambda session: load_player_context(session, player_id, refresh=True)))
 
 @api_router.post("/token")
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
     # In a real app, you would verify the username and password against your database
     # For this example, we'll use a hardcoded user
     if form_data.username == "Winemaker" and form_data.password == "password":
+        await db.run_sync(lambda session: ensure_player_game(session, form_data.username))
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = create_access_token(
             data={"sub": form_data.username}, expires_delta=access_token_expires
@@ -138,175 +213,263 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
         headers={"WWW-Authenticate": "Bearer"},
     )
 
+def state_etag(context: PlayerContext) -> str:
+    return f'W/"{context.player_id}.{context.state_version}"'
+
+def check_state_etag(request: Request, response: Response, context: PlayerContext) -> Optional[Response]:
+    """Sets the ETag for the player's current state version. Returns a 304 response when the client
+    already has that version, so the handler can skip loading and serializing the state entirely."""
+    etag = state_etag(context)
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")) or if_none_match.strip() == "*":
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache" # Always revalidate; the 304 path is cheap
+    return None
+
 @api_router.get("/gamestate", response_model=GameState)
-async def get_game_state(db: Session = Depends(get_db), current_user: DBPlayer = Depends(get_current_user)):
-    game_instance = Game(db)
-    logger.info(f"Game state requested for user {current_user.name}.")
-    return game_instance.get_game_state()
+async def get_game_state(request: Request, response: Response, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    if not_modified := check_state_etag(request, response, context):
+        return not_modified
+    game_instance = AsyncGame(db, context=context)
+    logger.info(f"Game state requested for user {context.player_name}.")
+    return fast_response(await game_instance.get_game_state(), response)
+
+@api_router.get("/gamestate/delta", response_model=GameStateDelta)
+async def get_game_state_delta(since_version: int, request: Request, response: Response, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    if not_modified := check_state_etag(request, response, context):
+        return not_modified
+    logger.info(f"Game state delta since version {since_version} requested for user {context.player_name}.")
+    return fast_response(await AsyncGame(db, context=context).get_state_delta(since_version), response)
 
 @api_router.post("/advance_month", response_model=GameState)
-async def advance_month(db: Session = Depends(get_db), current_user: DBPlayer = Depends(get_current_user)):
-    logger.info(f"User {current_user.name} advancing month.")
-    game_instance = Game(db)
-    game_instance.advance_month()
+async def advance_month(bulk: bool = False, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    logger.info(f"User {context.player_name} advancing month.")
+    game_instance = AsyncGame(db, context=context)
+    await game_instance.advance_month(bulk)
     logger.info("Month advanced.")
-    return game_instance.get_game_state()
+    return fast_response(await game_instance.get_game_state())
+
+@api_router.post("/advance_months", response_model=AdvanceMonthsResult)
+async def advance_months(request: AdvanceMonthsRequest, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    logger.info(f"User {context.player_name} advancing {request.months} months.")
+    game_instance = AsyncGame(db, context=context)
+    result = await game_instance.advance_months(request.months)
+    if result is None:
+        logger.warning(f"Failed to advance months: invalid month count {request.months}.")
+        raise HTTPException(status_code=400, detail="Invalid number of months.")
+    logger.info(f"Advanced {request.months} months with {len(result.events)} events.")
+    return fast_response(result)
+
+@api_router.post("/advance_until_event", response_model=AdvanceMonthsResult)
+async def advance_until_event(max_months: int = DEFAULT_EVENT_HORIZON_MONTHS, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    logger.info(f"User {context.player_name} advancing until the next event (horizon {max_months} months).")
+    game_instance = AsyncGame(db, context=context)
+    result = await game_instance.advance_until_next_event(max_months)
+    if result is None:
+        logger.warning(f"Failed to advance until next event: invalid horizon {max_months}.")
+        raise HTTPException(status_code=400, detail="Invalid number of months.")
+    logger.info(f"Advanced {result.months_advanced} months with {len(result.events)} events.")
+    return fast_response(result)
+
+@api_router.websocket("/events")
+async def player_events(websocket: WebSocket, token: str, db: AsyncSession = Depends(get_async_db)):
+    """Pushes the player's committed changes as JSON messages. Browsers can't set headers on a
+    WebSocket, so the JWT from /token is passed as the `token` query parameter."""
+    player = await authenticate_token(token, db)
+    if player is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    player_id = player.id
+    await db.close() # Nothing else is read; don't hold a pooled connection for the life of the socket
+    await websocket.accept()
+    queue = hub.subscribe(player_id)
+    logger.info(f"Player {player_id} subscribed to game events.")
+
+    async def forward_messages():
+        while True:
+            await websocket.send_json(await queue.get())
+
+    forwarder = asyncio.create_task(forward_messages())
+    try:
+        while True:
+            await websocket.receive_text() # Only used to notice the client going away
+    except WebSocketDisconnect:
+        pass
+    finally:
+        forwarder.cancel()
+        hub.unsubscribe(player_id, queue)
+        logger.info(f"Player {player_id} unsubscribed from game events.")
 
 @api_router.get("/player", response_model=Player)
-async def get_player(db: Session = Depends(get_db)):
-    game_instance = Game(db)
-    db_game_state = db.query(DBGameState).first()
-    db_player = db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
+async def get_player(request: Request, response: Response, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    if not_modified := check_state_etag(request, response, context):
+        return not_modified
     logger.info("Player info requested.")
-    return Player.model_validate(db_player)
+    return fast_response(await db.run_sync(lambda session: Player.model_validate(context.player)), response)
 
 @api_router.get("/vineyards", response_model=List[Vineyard])
-async def get_vineyards(db: Session = Depends(get_db)):
-    game_instance = Game(db)
-    db_game_state = db.query(DBGameState).first()
-    db_player = db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
+async def get_vineyards(request: Request, response: Response, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    if not_modified := check_state_etag(request, response, context):
+        return not_modified
     logger.info("Vineyards requested.")
-    return [Vineyard.model_validate(v) for v in db_player.vineyards]
+    return fast_response(await db.run_sync(lambda session: [Vineyard.model_validate(v) for v in context.player.vineyards]), response)
 
 @api_router.get("/winery", response_model=Winery)
-async def get_winery(db: Session = Depends(get_db)):
-    game_instance = Game(db)
-    db_game_state = db.query(DBGameState).first()
-    db_player = db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
-    db_winery = db.query(DBWinery).filter(DBWinery.player_id == db_player.id).first()
+async def get_winery(request: Request, response: Response, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    if not_modified := check_state_etag(request, response, context):
+        return not_modified
     logger.info("Winery info requested.")
-    return Winery.model_validate(db_winery)
+    return fast_response(await db.run_sync(lambda session: Winery.model_validate(context.winery)), response)
+
+def _inventory_page_response(response: Response, page):
+    if page is None:
+        raise HTTPException(status_code=400, detail="Invalid sort, limit or cursor.")
+    items, next_cursor = page
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return fast_response(items, response)
 
 @api_router.get("/grapes_inventory", response_model=List[Grape])
-async def get_grapes_inventory(db: Session = Depends(get_db)):
-    game_instance = Game(db)
-    db_game_state = db.query(DBGameState).first()
-    db_player = db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
+async def get_grapes_inventory(request: Request, response: Response, query: Annotated[InventoryQuery, Query()], db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    if not_modified := check_state_etag(request, response, context):
+        return not_modified
     logger.info("Grapes inventory requested.")
-    return [Grape.model_validate(g) for g in db_player.grapes_inventory]
+    return _inventory_page_response(response, await AsyncGame(db, context=context).list_grapes_inventory(query))
 
 @api_router.get("/bottled_wines", response_model=List[Wine])
-async def get_bottled_wines(db: Session = Depends(get_db)):
-    game_instance = Game(db)
-    db_game_state = db.query(DBGameState).first()
-    db_player = db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
+async def get_bottled_wines(request: Request, response: Response, query: Annotated[InventoryQuery, Query()], db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    if not_modified := check_state_etag(request, response, context):
+        return not_modified
     logger.info("Bottled wines requested.")
-    return [Wine.model_validate(w) for w in db_player.bottled_wines]
+    return _inventory_page_response(response, await AsyncGame(db, context=context).list_bottled_wines(query))
 
 @api_router.get("/available_vineyards_for_purchase", response_model=List[Dict[str, Any]])
-async def get_available_vineyards_for_purchase(db: Session = Depends(get_db)):
-    game_instance = Game(db)
+async def get_available_vineyards_for_purchase(db: AsyncSession = Depends(get_async_db)):
+    game_instance = AsyncGame(db)
     logger.info("Available vineyards for purchase requested.")
     return game_instance.get_available_vineyards_for_purchase()
 
 @api_router.post("/buy_vineyard", response_model=Vineyard)
-async def buy_vineyard(request: BuyVineyardRequest, db: Session = Depends(get_db), current_user: DBPlayer = Depends(get_current_user)):
-    logger.info(f"User {current_user.name} attempting to buy vineyard: {request.vineyard_name}.")
-    game_instance = Game(db)
-    new_vineyard = game_instance.buy_vineyard(request.vineyard_data, request.vineyard_name)
+async def buy_vineyard(request: BuyVineyardRequest, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    logger.info(f"User {context.player_name} attempting to buy vineyard: {request.vineyard_name}.")
+    game_instance = AsyncGame(db, context=context)
+    new_vineyard = await game_instance.buy_vineyard(request.vineyard_data, request.vineyard_name)
     if new_vineyard is None:
         logger.warning(f"Failed to buy vineyard: Not enough money or invalid vineyard data for {request.vineyard_name}.")
         raise HTTPException(status_code=400, detail="Not enough money or invalid vineyard data.")
-    logger.info(f"Vineyard {new_vineyard.name} purchased by {current_user.name}.")
-    return new_vineyard
+    logger.info(f"Vineyard {new_vineyard.name} purchased by {context.player_name}.")
+    return fast_response(new_vineyard)
 
 @api_router.post("/tend_vineyard")
-async def tend_vineyard(request: TendVineyardRequest, db: Session = Depends(get_db), current_user: DBPlayer = Depends(get_current_user)):
-    logger.info(f"User {current_user.name} attempting to tend vineyard: {request.vineyard_name}.")
-    game_instance = Game(db)
-    success = game_instance.tend_vineyard(request.vineyard_name)
+async def tend_vineyard(request: TendVineyardRequest, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    logger.info(f"User {context.player_name} attempting to tend vineyard: {request.vineyard_name}.")
+    game_instance = AsyncGame(db, context=context)
+    success = await game_instance.tend_vineyard(request.vineyard_name)
     if not success:
         logger.warning(f"Failed to tend vineyard: Not enough money or vineyard not found for {request.vineyard_name}.")
         raise HTTPException(status_code=400, detail="Not enough money or vineyard not found.")
-    logger.info(f"Successfully tended {request.vineyard_name} by {current_user.name}.")
+    logger.info(f"Successfully tended {request.vineyard_name} by {context.player_name}.")
     return {"message": f"Successfully tended {request.vineyard_name}."}
 
 @api_router.post("/harvest_grapes", response_model=Grape)
-async def harvest_grapes(request: HarvestGrapesRequest, db: Session = Depends(get_db), current_user: DBPlayer = Depends(get_current_user)):
-    logger.info(f"User {current_user.name} attempting to harvest grapes from: {request.vineyard_name}.")
-    game_instance = Game(db)
-    harvested_grapes = game_instance.harvest_grapes(request.vineyard_name)
+async def harvest_grapes(request: HarvestGrapesRequest, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    logger.info(f"User {context.player_name} attempting to harvest grapes from: {request.vineyard_name}.")
+    game_instance = AsyncGame(db, context=context)
+    harvested_grapes = await game_instance.harvest_grapes(request.vineyard_name)
     if not harvested_grapes:
         logger.warning(f"Failed to harvest grapes: Vineyard not found or grapes not ready for harvest for {request.vineyard_name}.")
         raise HTTPException(status_code=400, detail="Vineyard not found or grapes not ready for harvest.")
-    logger.info(f"Grapes harvested from {request.vineyard_name} by {current_user.name}.")
-    return harvested_grapes
+    logger.info(f"Grapes harvested from {request.vineyard_name} by {context.player_name}.")
+    return fast_response(harvested_grapes)
 
 @api_router.get("/available_vessel_types_for_purchase", response_model=List[Dict[str, Any]])
-async def get_available_vessel_types_for_purchase(db: Session = Depends(get_db)):
-    game_instance = Game(db)
+async def get_available_vessel_types_for_purchase(db: AsyncSession = Depends(get_async_db)):
+    game_instance = AsyncGame(db)
     logger.info("Available vessel types for purchase requested.")
     return game_instance.get_available_vessel_types_for_purchase()
 
 @api_router.post("/buy_vessel", response_model=Winery)
-async def buy_vessel(request: BuyVesselRequest, db: Session = Depends(get_db), current_user: DBPlayer = Depends(get_current_user)):
-    logger.info(f"User {current_user.name} attempting to buy vessel: {request.vessel_type_name}.")
-    game_instance = Game(db)
-    new_vessel = game_instance.buy_vessel(request.vessel_type_name)
+async def buy_vessel(request: BuyVesselRequest, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    logger.info(f"User {context.player_name} attempting to buy vessel: {request.vessel_type_name}.")
+    game_instance = AsyncGame(db, context=context)
+    new_vessel = await game_instance.buy_vessel(request.vessel_type_name)
     if not new_vessel:
         logger.warning(f"Failed to buy vessel: Not enough money or invalid vessel type for {request.vessel_type_name}.")
         raise HTTPException(status_code=400, detail="Not enough money or invalid vessel type.")
     
-    db_game_state = db.query(DBGameState).first()
-    db_player = db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
-    db_winery = db.query(DBWinery).filter(DBWinery.player_id == db_player.id).first()
-    logger.info(f"Vessel {new_vessel.type} purchased by {current_user.name}.")
-    return Winery.model_validate(db_winery)
+    logger.info(f"Vessel {new_vessel.type} purchased by {context.player_name}.")
+    return fast_response(await db.run_sync(lambda session: Winery.model_validate(context.winery)))
 
 @api_router.post("/process_grapes", response_model=Must)
-async def process_grapes(request: ProcessGrapesRequest, db: Session = Depends(get_db), current_user: DBPlayer = Depends(get_current_user)):
-    logger.info(f"User {current_user.name} attempting to process grapes (index {request.grape_index}).")
-    game_instance = Game(db)
-    processed_must = game_instance.process_grapes(request.grape_index, request.sort_choice, request.destem_crush_method)
+async def process_grapes(request: ProcessGrapesRequest, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    logger.info(f"User {context.player_name} attempting to process grapes (index {request.grape_index}).")
+    game_instance = AsyncGame(db, context=context)
+    processed_must = await game_instance.process_grapes(request.grape_index, request.sort_choice, request.destem_crush_method)
     if not processed_must:
         logger.warning(f"Failed to process grapes: Invalid grape index or processing failed for index {request.grape_index}.")
         raise HTTPException(status_code=400, detail="Invalid grape index or processing failed.")
-    logger.info(f"Grapes processed into must: {processed_must.varietal} by {current_user.name}.")
-    return processed_must
+    logger.info(f"Grapes processed into must: {processed_must.varietal} by {context.player_name}.")
+    return fast_response(processed_must)
 
 @api_router.post("/start_fermentation", response_model=WineInProduction)
-async def start_fermentation(request: StartFermentationRequest, db: Session = Depends(get_db), current_user: DBPlayer = Depends(get_current_user)):
-    logger.info(f"User {current_user.name} attempting to start fermentation for must index {request.must_index}.")
-    game_instance = Game(db)
-    wine_in_prod = game_instance.start_fermentation(request.must_index, request.vessel_index)
+async def start_fermentation(request: StartFermentationRequest, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    logger.info(f"User {context.player_name} attempting to start fermentation for must index {request.must_index}.")
+    game_instance = AsyncGame(db, context=context)
+    wine_in_prod = await game_instance.start_fermentation(request.must_index, request.vessel_index)
     if not wine_in_prod:
         logger.warning(f"Failed to start fermentation: Invalid must or vessel index, or vessel not available for must index {request.must_index}, vessel index {request.vessel_index}.")
         raise HTTPException(status_code=400, detail="Invalid must or vessel index, or vessel not available.")
-    logger.info(f"Fermentation started for {wine_in_prod.varietal} by {current_user.name}.")
-    return wine_in_prod
+    logger.info(f"Fermentation started for {wine_in_prod.varietal} by {context.player_name}.")
+    return fast_response(wine_in_prod)
 
 @api_router.post("/perform_maceration_action")
-async def perform_maceration_action(request: PerformMacerationActionRequest, db: Session = Depends(get_db), current_user: DBPlayer = Depends(get_current_user)):
-    logger.info(f"User {current_user.name} attempting to perform maceration action '{request.action_type}' for wine in production index {request.wine_prod_index}.")
-    game_instance = Game(db)
-    success = game_instance.perform_maceration_action(request.wine_prod_index, request.action_type)
+async def perform_maceration_action(request: PerformMacerationActionRequest, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    logger.info(f"User {context.player_name} attempting to perform maceration action '{request.action_type}' for wine in production index {request.wine_prod_index}.")
+    game_instance = AsyncGame(db, context=context)
+    success = await game_instance.perform_maceration_action(request.wine_prod_index, request.action_type)
     if not success:
         logger.warning(f"Failed to perform maceration action: Invalid wine in production index or action not applicable for index {request.wine_prod_index}, action {request.action_type}.")
         raise HTTPException(status_code=400, detail="Invalid wine in production index or action not applicable.")
-    logger.info(f"Maceration action '{request.action_type}' performed for wine in production index {request.wine_prod_index} by {current_user.name}.")
+    logger.info(f"Maceration action '{request.action_type}' performed for wine in production index {request.wine_prod_index} by {context.player_name}.")
     return {"message": f"Maceration action '{request.action_type}' performed."}
 
 @api_router.post("/start_aging", response_model=WineInProduction)
-async def start_aging(request: StartAgingRequest, db: Session = Depends(get_db), current_user: DBPlayer = Depends(get_current_user)):
-    logger.info(f"User {current_user.name} attempting to start aging for wine in production index {request.wine_prod_index}.")
-    game_instance = Game(db)
-    wine_in_prod = game_instance.start_aging(request.wine_prod_index, request.vessel_index, request.aging_duration)
+async def start_aging(request: StartAgingRequest, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    logger.info(f"User {context.player_name} attempting to start aging for wine in production index {request.wine_prod_index}.")
+    game_instance = AsyncGame(db, context=context)
+    wine_in_prod = await game_instance.start_aging(request.wine_prod_index, request.vessel_index, request.aging_duration)
     if not wine_in_prod:
         logger.warning(f"Failed to start aging: Invalid wine in production or vessel index, or vessel not available for index {request.wine_prod_index}, vessel index {request.vessel_index}.")
         raise HTTPException(status_code=400, detail="Invalid wine in production or vessel index, or vessel not available.")
-    logger.info(f"Aging started for {wine_in_prod.varietal} by {current_user.name}.")
-    return wine_in_prod
+    logger.info(f"Aging started for {wine_in_prod.varietal} by {context.player_name}.")
+    return fast_response(wine_in_prod)
 
 @api_router.post("/bottle_wine", response_model=Wine)
-async def bottle_wine(request: BottleWineRequest, db: Session = Depends(get_db), current_user: DBPlayer = Depends(get_current_user)):
-    logger.info(f"User {current_user.name} attempting to bottle wine '{request.wine_name}' from index {request.wine_prod_index}.")
-    game_instance = Game(db)
-    bottled_wine = game_instance.bottle_wine(request.wine_prod_index, request.wine_name)
+async def bottle_wine(request: BottleWineRequest, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    logger.info(f"User {context.player_name} attempting to bottle wine '{request.wine_name}' from index {request.wine_prod_index}.")
+    game_instance = AsyncGame(db, context=context)
+    bottled_wine = await game_instance.bottle_wine(request.wine_prod_index, request.wine_name)
     if not bottled_wine:
         logger.warning(f"Failed to bottle wine: Invalid wine in production index or wine not ready for bottling for index {request.wine_prod_index}.")
         raise HTTPException(status_code=400, detail="Invalid wine in production index or wine not ready for bottling.")
-    logger.info(f"Wine '{bottled_wine.name}' bottled by {current_user.name}.")
-    return bottled_wine
+    logger.info(f"Wine '{bottled_wine.name}' bottled by {context.player_name}.")
+    return fast_response(bottled_wine)
+
+@api_router.post("/actions", response_model=ActionsResult)
+async def execute_actions(request: ActionsRequest, db: AsyncSession = Depends(get_async_db), context: PlayerContext = Depends(get_player_context)):
+    logger.info(f"User {context.player_name} executing a batch of {len(request.commands)} actions.")
+    game_instance = AsyncGame(db, context=context)
+    result, failed_index = await game_instance.execute_actions(request.commands)
+    if result is None:
+        if failed_index is None:
+            logger.warning(f"Failed to execute actions: invalid batch size {len(request.commands)}.")
+            raise HTTPException(status_code=400, detail="Invalid number of commands.")
+        failed_action = request.commands[failed_index].action
+        logger.warning(f"Failed to execute actions: command {failed_index} ({failed_action}) failed, batch rolled back.")
+        raise HTTPException(status_code=400, detail=f"Command {failed_index} ({failed_action}) failed; no changes were applied.")
+    logger.info(f"Batch of {len(result.results)} actions executed by {context.player_name}.")
+    return fast_response(result)
 
 app.include_router(api_router, prefix="/api")
-app.mount("/", StaticFiles(directory="static", html=True), name="static")
+app.mount("/", StaticAssets(directory="static", html=True), name="static")
@@ -0,0 +1,291 @@
+import functools
+import hmac
+import logging
+import math
+import os
+import threading
+import time
+from typing import Dict, Sequence, Tuple
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import Response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from starlette.datastructures import MutableHeaders
+from starlette.routing import Mount
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from query_stats import game_method_scope, track_queries
+
+logger = logging.getLogger(__name__)
+
+# Metrics are kept in process and served from /metrics in the Prometheus text format, so any scraper
+# (or curl) can read them without a collector or client library. Off by default; the endpoint shows
+# routes, traffic and DB timings, so it also returns 404 unless METRICS_TOKEN is set and sent as
+# `Authorization: Bearer <token>` (Prometheus' `authorization` scrape setting).
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Per-request query reports come from QueryStatsMiddleware, which is independent of METRICS_ENABLED
+# so it can be switched on while debugging without exposing /metrics.
+# Opt-in: adds X-Query-Count, X-Query-Time-Ms and X-Query-Breakdown to every HTTP response
+QUERY_DEBUG_HEADERS = os.getenv("QUERY_DEBUG_HEADERS", "0") == "1"
+QUERY_STATS_ENABLED = os.getenv("QUERY_STATS_ENABLED", "0") == "1" or QUERY_DEBUG_HEADERS
+# Requests running more statements than this are logged with their breakdown at WARNING
+QUERY_BUDGET_PER_REQUEST = int(os.getenv("QUERY_BUDGET_PER_REQUEST", 50))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+POOL_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Metric:
+    """A metric family: one value (or histogram) per combination of label values."""
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            for suffix, labels, value in self._samples():
+                lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        for key, value in self._values.items():
+            yield "_total", list(zip(self.labelnames, key)), value
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        for key, value in self._values.items():
+            yield "", list(zip(self.labelnames, key)), value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts followed by the sum
+                state = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-1] += value
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return sum(state[:-1]) if state else 0
+
+    def _samples(self):
+        for key, state in self._values.items():
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, state):
+                cumulative += bucket_count
+                yield "_bucket", labels + [("le", _format_value(bound))], cumulative
+            yield "_sum", labels, state[-1]
+            yield "_count", labels, cumulative
+
+REGISTRY = []
+
+HTTP_REQUEST_DURATION = Histogram("http_request_duration_seconds", "Time spent handling HTTP requests, by route template.", ("method", "route"))
+HTTP_REQUESTS = Counter("http_requests", "HTTP requests handled, by route template and status code.", ("method", "route", "status"))
+HTTP_REQUESTS_IN_PROGRESS = Gauge("http_requests_in_progress", "HTTP requests currently being handled.")
+DB_POOL_CHECKOUT_WAIT = Histogram("db_pool_checkout_wait_seconds", "Time spent waiting for a connection from an engine's pool.", ("pool",), POOL_WAIT_BUCKETS)
+DB_QUERIES_PER_REQUEST = Histogram("db_queries_per_request", "SQL statements executed while handling a request.", ("method", "route"), QUERY_COUNT_BUCKETS)
+DB_COMMIT_DURATION = Histogram("db_commit_duration_seconds", "Time spent in Session.commit, including its final flush.")
+GAME_METHOD_DURATION = Histogram("game_method_duration_seconds", "Time spent in Game methods, including their queries.", ("method",))
+WRITE_BEHIND_ACTIONS_PER_CHECKPOINT = Histogram("write_behind_actions_per_checkpoint", "Player actions held in memory and written by one write-behind checkpoint.", buckets=QUERY_COUNT_BUCKETS)
+WRITE_BEHIND_CACHED_PLAYERS = Gauge("write_behind_cached_players", "Players whose state is held in memory by the write-behind cache.")
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+def route_label(scope: Scope) -> str:
+    """The route template rather than the raw path, so path parameters don't explode the label set.
+
+    Routes from included routers only know their path relative to the prefix, so the template is
+    rebuilt from the request path and the matched path parameters instead.
+    """
+    route = scope.get("route")
+    if route is None:
+        return "unmatched" # Not an API route, e.g. the static frontend mounted at "/"
+    if isinstance(route, Mount):
+        return route.name or route.path # e.g. every static file under one "static" label
+    params = {str(value): name for name, value in scope.get("path_params", {}).items()}
+    return "/".join(f"{{{params[segment]}}}" if segment in params else segment for segment in scope["path"].split("/"))
+
+class MetricsMiddleware:
+    """Records latency, status, in-flight count and the number of queries run for every HTTP request."""
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500 # Reported if the app fails before starting a response
+
+        async def send_with_status(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        with track_queries() as stats:
+            HTTP_REQUESTS_IN_PROGRESS.inc()
+            start = time.perf_counter()
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                duration = time.perf_counter() - start
+                HTTP_REQUESTS_IN_PROGRESS.dec()
+                method, route = scope["method"], route_label(scope)
+                HTTP_REQUEST_DURATION.observe(duration, method=method, route=route)
+                HTTP_REQUESTS.inc(method=method, route=route, status=status_code)
+                DB_QUERIES_PER_REQUEST.observe(stats.queries, method=method, route=route)
+
+class QueryStatsMiddleware:
+    """Checks every HTTP request against QUERY_BUDGET_PER_REQUEST and logs its query report (at DEBUG
+    when within budget), optionally returning it in X-Query-* headers."""
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with track_queries() as stats:
+            async def send_with_query_headers(message: Message):
+                if message["type"] == "http.response.start" and QUERY_DEBUG_HEADERS:
+                    headers = MutableHeaders(scope=message)
+                    headers["X-Query-Count"] = str(stats.queries)
+                    headers["X-Query-Time-Ms"] = f"{stats.seconds * 1000:.1f}"
+                    headers["X-Query-Breakdown"] = stats.breakdown()
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_query_headers)
+            finally:
+                method, route = scope["method"], route_label(scope)
+                if stats.queries > QUERY_BUDGET_PER_REQUEST:
+                    logger.warning(f"{method} {route} exceeded the query budget of {QUERY_BUDGET_PER_REQUEST}: {stats.report()}")
+                elif logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"{method} {route}: {stats.report()}")
+
+def require_metrics_token(authorization: str = Header("")):
+    scheme, _, token = authorization.partition(" ")
+    if not METRICS_TOKEN or scheme.lower() != "bearer" or not hmac.compare_digest(token, METRICS_TOKEN):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+metrics_router = APIRouter(dependencies=[Depends(require_metrics_token)])
+
+@metrics_router.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(render_metrics(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+def timed_game_method(func):
+    """Records how long a Game method takes under its own name, and attributes its queries to it."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with game_method_scope(func.__name__):
+                return func(*args, **kwargs)
+        finally:
+            GAME_METHOD_DURATION.observe(time.perf_counter() - start, method=func.__name__)
+    return wrapper
+
+class _TimedCheckoutMixin:
+    # _do_get is where a pool blocks when all its connections are checked out
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - start, pool=getattr(self, "logging_name", None) or "default")
+
+class TimedQueuePool(_TimedCheckoutMixin, QueuePool):
+    pass
+
+class TimedAsyncAdaptedQueuePool(_TimedCheckoutMixin, AsyncAdaptedQueuePool):
+    pass
+
+@event.listens_for(Session, "before_commit")
+def start_commit_timer(session):
+    session.info["commit_started"] = time.perf_counter()
+
+@event.listens_for(Session, "after_commit")
+def observe_commit_duration(session):
+    started = session.info.pop("commit_started", None)
+    if started is not None:
+        DB_COMMIT_DURATION.observe(time.perf_counter() - started)
+
+@event.listens_for(Session, "after_rollback")
+def discard_commit_timer(session):
+    session.info.pop("commit_started", None)
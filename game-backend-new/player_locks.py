@@ -0,0 +1,43 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable
+
+class _KeyedLockEntry:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+class KeyedLock:
+    """One asyncio lock per key, created on demand and dropped once nobody holds or waits for it.
+
+    asyncio.Lock wakes waiters in FIFO order, so requests for the same key run in arrival order while
+    requests for different keys never wait on each other.
+    """
+    def __init__(self):
+        self._entries: Dict[Hashable, _KeyedLockEntry] = {}
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _KeyedLockEntry()
+        entry.users += 1
+        try:
+            async with entry.lock:
+                yield
+        finally:
+            entry.users -= 1
+            if entry.users == 0:
+                del self._entries[key]
+
+    def locked(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry.lock.locked()
+
+    def __len__(self):
+        return len(self._entries)
+
+# Serializes each player's mutating requests within this process
+player_locks = KeyedLock()
@@ -0,0 +1,183 @@
+import asyncio
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import FileResponse, PlainTextResponse
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+# Opt-in request profiling. A request is profiled when it carries `X-Profile-Token` matching
+# PROFILING_TOKEN, or when it falls in the PROFILING_SAMPLE_RATE fraction of traffic. Both are off
+# by default; the index endpoints below also require the token.
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", 0))
+PROFILING_ENABLED = bool(PROFILING_TOKEN) or PROFILING_SAMPLE_RATE > 0
+# "cprofile" writes .pstats files; "sampler" writes collapsed stacks (flamegraph.pl / speedscope input)
+PROFILING_MODE = os.getenv("PROFILING_MODE", "cprofile")
+PROFILING_SAMPLE_INTERVAL_SECONDS = float(os.getenv("PROFILING_SAMPLE_INTERVAL_SECONDS", 0.001))
+PROFILES_DIR = os.getenv("PROFILES_DIR", "./data/profiles")
+# Oldest profiles are deleted beyond this many
+PROFILES_KEEP = int(os.getenv("PROFILES_KEEP", 200))
+PROFILE_TOKEN_HEADER = "x-profile-token"
+PROFILE_EXTENSIONS = (".pstats", ".collapsed")
+
+class StackSampler:
+    """Samples one thread's Python stack at a fixed interval and counts identical stacks.
+
+    Sampling the event loop thread also catches Game code running inside run_sync, since the greenlet
+    it runs in executes on that thread.
+    """
+    def __init__(self, thread_id: int, interval: float = PROFILING_SAMPLE_INTERVAL_SECONDS):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+def _should_profile(scope: Scope) -> bool:
+    if PROFILING_TOKEN:
+        for name, value in scope["headers"]:
+            if name == PROFILE_TOKEN_HEADER.encode() and hmac.compare_digest(value.decode("latin-1"), PROFILING_TOKEN):
+                return True
+    return PROFILING_SAMPLE_RATE > 0 and random.random() < PROFILING_SAMPLE_RATE
+
+def _profile_name(scope: Scope, duration: float, extension: str) -> str:
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", scope["path"]).strip("_") or "root"
+    return f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{scope['method']}-{slug}-{duration * 1000:.0f}ms{extension}"
+
+def _write_profile(name: str, profiler: Optional[cProfile.Profile], sampler: Optional[StackSampler]):
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    path = os.path.join(PROFILES_DIR, name)
+    if profiler is not None:
+        profiler.dump_stats(path)
+    else:
+        with open(path, "w") as f:
+            f.write(sampler.collapsed())
+    profiles = sorted(list_profiles(), key=lambda profile: profile["name"])
+    for stale in profiles[:max(0, len(profiles) - PROFILES_KEEP)]:
+        os.remove(os.path.join(PROFILES_DIR, stale["name"]))
+
+class ProfilingMiddleware:
+    """Profiles opted-in requests end to end (dependencies, handler and the Game call) and saves the
+    result under PROFILES_DIR. The file name is returned in `X-Profile-Id`.
+
+    Both profilers see everything the thread runs, including other requests interleaved on the event
+    loop, so only one request is profiled at a time; others that ask meanwhile run unprofiled.
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._busy = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or self._busy or not _should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        self._busy = True
+        extension = ".pstats" if PROFILING_MODE == "cprofile" else ".collapsed"
+        profiler, sampler = None, None
+        if extension == ".pstats":
+            profiler = cProfile.Profile()
+        else:
+            sampler = StackSampler(threading.get_ident())
+        start = time.perf_counter()
+        name = None
+
+        async def send_with_profile_id(message: Message):
+            nonlocal name
+            if message["type"] == "http.response.start":
+                # Named once the handler is done, so the duration covers the work rather than streaming the body
+                name = _profile_name(scope, time.perf_counter() - start, extension)
+                MutableHeaders(scope=message)["X-Profile-Id"] = name
+            await send(message)
+
+        if profiler is not None:
+            profiler.enable()
+        else:
+            sampler.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            else:
+                sampler.stop()
+            self._busy = False
+            name = name or _profile_name(scope, time.perf_counter() - start, extension)
+            try:
+                await asyncio.to_thread(_write_profile, name, profiler, sampler)
+                logger.info(f"Saved profile {name}.")
+            except OSError as e:
+                logger.error(f"Failed to save profile {name}: {e}")
+
+def list_profiles() -> List[Dict[str, Any]]:
+    if not os.path.isdir(PROFILES_DIR):
+        return []
+    profiles = []
+    for entry in os.scandir(PROFILES_DIR):
+        if entry.is_file() and entry.name.endswith(PROFILE_EXTENSIONS):
+            stat = entry.stat()
+            profiles.append({"name": entry.name, "size": stat.st_size, "created": datetime.fromtimestamp(stat.st_mtime).isoformat()})
+    return sorted(profiles, key=lambda profile: profile["name"], reverse=True)
+
+def require_profiling_token(x_profile_token: str = Header("")):
+    # Profiles expose code paths and timings, so the index is hidden unless the token is configured and sent
+    if not PROFILING_TOKEN or not hmac.compare_digest(x_profile_token, PROFILING_TOKEN):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+profiling_router = APIRouter(prefix="/debug/profiles", dependencies=[Depends(require_profiling_token)], include_in_schema=False)
+
+@profiling_router.get("")
+async def get_profiles():
+    return await asyncio.to_thread(list_profiles)
+
+@profiling_router.get("/{name}")
+async def get_profile(name: str, limit: int = 50):
+    """Collapsed stacks are served as is; pstats files as text sorted by cumulative time, unless
+    `limit=0` asks for the raw file (e.g. for snakeviz)."""
+    if os.path.basename(name) != name or not name.endswith(PROFILE_EXTENSIONS):
+        raise HTTPException(status_code=404, detail="Not Found")
+    path = os.path.join(PROFILES_DIR, name)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Not Found")
+    if name.endswith(".collapsed") or limit <= 0:
+        return FileResponse(path, media_type="text/plain" if name.endswith(".collapsed") else "application/octet-stream")
+    stream = io.StringIO()
+    pstats.Stats(path, stream=stream).sort_stats("cumulative").print_stats(limit)
+    return PlainTextResponse(stream.getvalue())
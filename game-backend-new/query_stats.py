@@ -0,0 +1,109 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Statements run outside any Game method (auth, context loading, handlers) are reported under this name
+OUTSIDE_GAME = "-"
+
+class QueryStats:
+    """Statements executed within a scope (an HTTP request or an `assert_max_queries` block), each
+    with its duration and the Game method that ran it. Nested scopes also record into their parent."""
+    __slots__ = ("statements", "parent")
+
+    def __init__(self, parent: Optional["QueryStats"] = None):
+        self.statements: List[Tuple[str, str, float]] = []
+        self.parent = parent
+
+    @property
+    def queries(self) -> int:
+        return len(self.statements)
+
+    @property
+    def seconds(self) -> float:
+        return sum(duration for _, _, duration in self.statements)
+
+    def by_game_method(self) -> Dict[str, Tuple[int, float]]:
+        breakdown: Dict[str, Tuple[int, float]] = {}
+        for method, _, duration in self.statements:
+            count, seconds = breakdown.get(method, (0, 0.0))
+            breakdown[method] = (count + 1, seconds + duration)
+        return breakdown
+
+    def breakdown(self) -> str:
+        return ", ".join(f"{method}={count}/{seconds * 1000:.1f}ms" for method, (count, seconds) in self.by_game_method().items())
+
+    def report(self, verbose: bool = False) -> str:
+        summary = f"{self.queries} queries in {self.seconds * 1000:.1f}ms"
+        if self.statements:
+            summary += f" ({self.breakdown()})"
+        if verbose:
+            summary += "".join(f"\n  [{method}] {duration * 1000:.2f}ms {' '.join(statement.split())}" for method, statement, duration in self.statements)
+        return summary
+
+# These are set per request or per block and are visible from run_sync and the threadpool, which copy
+# the context; the stats object itself is shared, so statements run there are recorded too.
+current_query_stats: ContextVar[Optional[QueryStats]] = ContextVar("current_query_stats", default=None)
+current_game_method: ContextVar[str] = ContextVar("current_game_method", default=OUTSIDE_GAME)
+# Game method name -> max statements per call, checked while `enforce_query_budgets` is active
+active_query_budgets: ContextVar[Optional[Dict[str, int]]] = ContextVar("active_query_budgets", default=None)
+
+@contextmanager
+def track_queries() -> Iterator[QueryStats]:
+    stats = QueryStats(parent=current_query_stats.get())
+    token = current_query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        current_query_stats.reset(token)
+
+@contextmanager
+def game_method_scope(name: str):
+    """Attributes the statements run inside to a Game method, and checks its budget if one is enforced."""
+    token = current_game_method.set(name)
+    budgets = active_query_budgets.get()
+    try:
+        if budgets is None or name not in budgets:
+            yield
+            return
+        with track_queries() as stats:
+            yield
+        if stats.queries > budgets[name]:
+            raise AssertionError(f"Game.{name} exceeded its budget of {budgets[name]} queries: {stats.report(verbose=True)}")
+    finally:
+        current_game_method.reset(token)
+
+@contextmanager
+def assert_max_queries(limit: int) -> Iterator[QueryStats]:
+    """Test helper: fails if the block runs more than `limit` statements, listing them."""
+    with track_queries() as stats:
+        yield stats
+    assert stats.queries <= limit, f"Expected at most {limit} queries, got {stats.report(verbose=True)}"
+
+@contextmanager
+def enforce_query_budgets(budgets: Dict[str, int]):
+    """Test helper: every call to a budgeted Game method inside the block fails if it runs more
+    statements than declared, so lazy-load regressions show up as test failures."""
+    token = active_query_budgets.set(budgets)
+    try:
+        yield
+    finally:
+        active_query_budgets.reset(token)
+
+# Listening on Engine covers every engine, including the ones in database.py
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_started"] = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    stats = current_query_stats.get()
+    if stats is None:
+        return
+    entry = (current_game_method.get(), statement, time.perf_counter() - conn.info.pop("query_started", time.perf_counter()))
+    while stats is not None:
+        stats.statements.append(entry)
+        stats = stats.parent
@@ -0,0 +1,39 @@
+import os
+from typing import Any, Optional
+
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError: # Optional: plain dicts and lists fall back to the stdlib encoder
+    orjson = None
+
+# Opt-in: when enabled, handlers send Game's return values through FastJSONResponse instead of
+# letting FastAPI revalidate them against response_model and encode them a second time.
+FAST_JSON_RESPONSES = os.getenv("FAST_JSON_RESPONSES", "0") == "1"
+
+class FastJSONResponse(JSONResponse):
+    """Serializes pydantic models with `model_dump_json` (pydantic-core, no revalidation) and other
+    content with orjson when it's installed."""
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, BaseModel):
+            return content.model_dump_json().encode()
+        if isinstance(content, list) and all(isinstance(item, BaseModel) for item in content):
+            return b"[" + b",".join(item.model_dump_json().encode() for item in content) + b"]"
+        if orjson is not None:
+            return orjson.dumps(content)
+        return super().render(content)
+
+def fast_response(content: Any, response: Optional[Response] = None) -> Any:
+    """Wraps trusted handler output in a FastJSONResponse when the fast path is enabled.
+
+    Returning a Response makes FastAPI skip response_model validation, so this must only be used
+    for objects that already are (lists of) the declared response model. Headers set on the
+    handler's injected `response` are carried over, since FastAPI only merges them into responses
+    it builds itself.
+    """
+    if not FAST_JSON_RESPONSES:
+        return content
+    headers = {name: value for name, value in response.headers.items() if name != "content-length"} if response else None
+    return FastJSONResponse(content, headers=headers)
@@ -0,0 +1,439 @@
+import math
+import random
+from typing import Any, Dict, List, Optional, Tuple
+
+from game_data import REGIONS, GRAPE_CHARACTERISTICS, VESSEL_TYPES, MAX_ADVANCE_MONTHS, DEFAULT_EVENT_HORIZON_MONTHS
+from game_models import MONTHS, GameEvent
+
+# In-memory simulation core: the game's rules applied to plain `__slots__` objects, with no session,
+# queries or commits. `Game`'s month advances (which touch the whole estate anyway), the offline
+# tools and write-behind mode run on it; `load_simulation` / `save_simulation` in game_logic move a
+# player's save between these objects and the DB* models.
+#
+# Single actions (buy, tend, harvest, ...) keep their targeted per-row paths in `Game`, which only
+# load the rows they touch; the rules and the order of random draws here match them, and
+# `Game._advance_month_bulk`, exactly, so a seeded run produces the same state either way (see
+# test_simulation_follows_the_same_rules_as_game). Entities carry the attribute names of the
+# pydantic models, so e.g. `GameState.model_validate(state)` works on them directly. New entities
+# have `id=None` until saved.
+
+class SimEntity:
+    __slots__ = ()
+    # Field -> default for fields the constructor may omit (mirrors the DB column defaults)
+    _defaults: Dict[str, Any] = {}
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            if name in values:
+                setattr(self, name, values.pop(name))
+            else:
+                default = self._defaults.get(name)
+                setattr(self, name, default() if callable(default) else default)
+        if values:
+            raise TypeError(f"Unknown {type(self).__name__} fields: {', '.join(values)}")
+
+    def __repr__(self):
+        return f"{type(self).__name__}(id={self.id!r})"
+
+class SimVineyard(SimEntity):
+    __slots__ = ("id", "name", "varietal", "region", "size_acres", "age_of_vines", "soil_type", "health", "grapes_ready", "harvested_this_year")
+    _defaults = {"size_acres": 5, "age_of_vines": 5, "soil_type": "mixed", "health": 80, "grapes_ready": False, "harvested_this_year": False}
+
+class SimGrape(SimEntity):
+    __slots__ = ("id", "varietal", "vintage", "quantity_kg", "quality")
+
+class SimMust(SimEntity):
+    __slots__ = ("id", "varietal", "vintage", "quantity_kg", "quality", "processing_method", "destem_crush_method", "fermented")
+    _defaults = {"fermented": False}
+
+class SimWineInProduction(SimEntity):
+    __slots__ = ("id", "varietal", "vintage", "quantity_liters", "quality", "vessel_type", "vessel_index", "stage",
+                 "fermentation_progress", "aging_progress", "aging_duration", "maceration_actions_taken")
+    _defaults = {"fermentation_progress": 0, "aging_progress": 0, "aging_duration": 0, "maceration_actions_taken": 0}
+
+class SimVessel(SimEntity):
+    __slots__ = ("id", "type", "capacity", "in_use")
+    _defaults = {"in_use": False}
+
+class SimWine(SimEntity):
+    __slots__ = ("id", "name", "vintage", "varietal", "style", "quality", "bottles")
+
+class SimWinery(SimEntity):
+    __slots__ = ("id", "name", "vessels", "must_in_production", "wines_fermenting", "wines_aging")
+    _defaults = {"name": "Main Winery", "vessels": list, "must_in_production": list, "wines_fermenting": list, "wines_aging": list}
+
+class SimPlayer(SimEntity):
+    __slots__ = ("id", "name", "money", "reputation", "state_version", "vineyards", "winery", "grapes_inventory", "bottled_wines")
+    _defaults = {"name": "Winemaker", "money": 100000, "reputation": 50, "state_version": 0, "vineyards": list, "grapes_inventory": list, "bottled_wines": list}
+
+class SimGameState(SimEntity):
+    __slots__ = ("id", "player", "current_year", "current_month_index")
+
+    @property
+    def months(self) -> List[str]:
+        return MONTHS
+
+# Entities held by each entity: attribute -> (entity class, whether it's a list)
+SIMULATION_CHILDREN = {
+    SimGameState: {"player": (SimPlayer, False)},
+    SimPlayer: {"vineyards": (SimVineyard, True), "winery": (SimWinery, False), "grapes_inventory": (SimGrape, True), "bottled_wines": (SimWine, True)},
+    SimWinery: {"vessels": (SimVessel, True), "must_in_production": (SimMust, True), "wines_fermenting": (SimWineInProduction, True), "wines_aging": (SimWineInProduction, True)},
+}
+
+# Scalar fields of each entity, i.e. what's copied to and from its DB row
+SIMULATION_FIELDS = {
+    cls: tuple(name for name in cls.__slots__ if name not in SIMULATION_CHILDREN.get(cls, {}))
+    for cls in (SimVineyard, SimGrape, SimMust, SimWineInProduction, SimVessel, SimWine, SimWinery, SimPlayer, SimGameState)
+}
+
+def entity_to_dict(entity: SimEntity) -> Dict[str, Any]:
+    """A JSON-serializable copy of an entity and everything it holds."""
+    data = {name: getattr(entity, name) for name in SIMULATION_FIELDS[type(entity)]}
+    for name, (_, many) in SIMULATION_CHILDREN.get(type(entity), {}).items():
+        child = getattr(entity, name)
+        if many:
+            data[name] = [entity_to_dict(item) for item in child]
+        else:
+            data[name] = entity_to_dict(child) if child is not None else None
+    return data
+
+def entity_from_dict(cls, data: Dict[str, Any]) -> SimEntity:
+    values = {name: data[name] for name in SIMULATION_FIELDS[cls] if name in data}
+    for name, (child_cls, many) in SIMULATION_CHILDREN.get(cls, {}).items():
+        child = data.get(name)
+        if many:
+            values[name] = [entity_from_dict(child_cls, item) for item in child or ()]
+        else:
+            values[name] = entity_from_dict(child_cls, child) if child is not None else None
+    return cls(**values)
+
+def _sort_by_id(entities: list):
+    # Unsaved entities (id None) are the newest, so they go last in the order they were created
+    entities.sort(key=lambda entity: (entity.id is None, entity.id or 0))
+
+class Simulation:
+    """The game's rules for one player's state held in memory.
+
+    Methods return the entities they create or change, or None/False when the action isn't allowed.
+    Events are returned by the advance methods and also collected in `pending_events`, together with
+    the entity they're about, until the storage adapter saves them.
+    """
+    def __init__(self, state: SimGameState):
+        self.state = state
+        self.pending_events: List[Tuple[GameEvent, Optional[SimEntity]]] = []
+        # Where the random draws come from; write_behind.py runs journaled actions on a seeded random.Random
+        self.rng = random
+
+    @property
+    def player(self) -> SimPlayer:
+        return self.state.player
+
+    @property
+    def winery(self) -> SimWinery:
+        return self.state.player.winery
+
+    def _event(self, event_type: str, subject: str, entity: Optional[SimEntity]) -> GameEvent:
+        event = GameEvent(
+            type=event_type,
+            year=self.state.current_year,
+            month=MONTHS[self.state.current_month_index],
+            subject=subject,
+            subject_id=entity.id if entity is not None else None,
+        )
+        self.pending_events.append((event, entity))
+        return event
+
+    def _tick(self) -> List[GameEvent]:
+        state, player = self.state, self.state.player
+        events = []
+        state.current_month_index += 1
+        if state.current_month_index >= len(MONTHS):
+            state.current_month_index = 0
+            state.current_year += 1
+            for vineyard in player.vineyards:
+                vineyard.harvested_this_year = False
+                vineyard.grapes_ready = False
+
+        current_month_num = state.current_month_index + 1
+        for vineyard in player.vineyards:
+            if self.rng.random() < 0.2:
+                vineyard.health = max(0, vineyard.health - self.rng.randint(1, 3))
+            ripening_month = GRAPE_CHARACTERISTICS[vineyard.varietal]["ripening_month"]
+            if current_month_num == ripening_month and not vineyard.harvested_this_year:
+                if not vineyard.grapes_ready:
+                    events.append(self._event("grapes_ready", vineyard.name, vineyard))
+                vineyard.grapes_ready = True
+
+        winery = player.winery
+        if winery:
+            for wine_prod in winery.wines_fermenting:
+                if wine_prod.fermentation_progress < 100:
+                    progress_gain = self.rng.randint(10, 25) + int(wine_prod.quality / 10)
+                    wine_prod.fermentation_progress = min(100, wine_prod.fermentation_progress + progress_gain)
+                    if wine_prod.fermentation_progress >= 100:
+                        events.append(self._event("fermentation_complete", wine_prod.varietal, wine_prod))
+            for wine_prod in winery.wines_aging:
+                if wine_prod.aging_progress < wine_prod.aging_duration:
+                    wine_prod.aging_progress += 1
+                    if wine_prod.aging_progress >= wine_prod.aging_duration:
+                        events.append(self._event("aging_complete", wine_prod.varietal, wine_prod))
+        return events
+
+    def advance_month(self) -> List[GameEvent]:
+        return self._tick()
+
+    def advance_months(self, months: int) -> Optional[List[GameEvent]]:
+        if not 1 <= months <= MAX_ADVANCE_MONTHS:
+            return None
+        events = []
+        for _ in range(months):
+            events.extend(self._tick())
+        return events
+
+    def _event_deadlines(self):
+        """Months until each pending ripening, fermentation or aging event.
+
+        Ripening and aging deadlines are exact. Fermentation gains are random, so its deadline is
+        the earliest month it could reach 100 assuming the maximum gain every month.
+        """
+        month_index = self.state.current_month_index
+        months_per_year = len(MONTHS)
+        for vineyard in self.player.vineyards:
+            ripening_index = GRAPE_CHARACTERISTICS[vineyard.varietal]["ripening_month"] - 1
+            months_ahead = (ripening_index - month_index) % months_per_year or months_per_year
+            if vineyard.harvested_this_year and month_index + months_ahead < months_per_year:
+                months_ahead += months_per_year # Already harvested: next ripening is after the new-year reset
+            yield months_ahead
+
+        winery = self.winery
+        if winery:
+            for wine_prod in winery.wines_fermenting:
+                if wine_prod.fermentation_progress < 100:
+                    max_gain = 25 + int(wine_prod.quality / 10)
+                    yield math.ceil((100 - wine_prod.fermentation_progress) / max_gain)
+            for wine_prod in winery.wines_aging:
+                if wine_prod.aging_progress < wine_prod.aging_duration:
+                    yield wine_prod.aging_duration - wine_prod.aging_progress
+
+    def next_event_in_months(self) -> Optional[int]:
+        # A linear scan rather than a priority queue: every step of `advance_until_next_event` also
+        # runs `_tick`, which visits every vineyard and wine anyway, and fermentation deadlines are
+        # re-estimated after each tick, so a heap would be rebuilt as often as it would be read.
+        return min(self._event_deadlines(), default=None)
+
+    def _skip_months(self, months: int):
+        state, player = self.state, self.state.player
+        months_per_year = len(MONTHS)
+        years, state.current_month_index = divmod(state.current_month_index + months, months_per_year)
+        if years:
+            state.current_year += years
+            for vineyard in player.vineyards:
+                vineyard.harvested_this_year = False
+                vineyard.grapes_ready = False
+
+        for vineyard in player.vineyards:
+            decay = sum(self.rng.randint(1, 3) for _ in range(months) if self.rng.random() < 0.2)
+            if decay:
+                vineyard.health = max(0, vineyard.health - decay)
+
+        winery = player.winery
+        if winery:
+            for wine_prod in winery.wines_fermenting:
+                if wine_prod.fermentation_progress < 100:
+                    progress_gain = sum(self.rng.randint(10, 25) for _ in range(months)) + months * int(wine_prod.quality / 10)
+                    wine_prod.fermentation_progress = min(100, wine_prod.fermentation_progress + progress_gain)
+            for wine_prod in winery.wines_aging:
+                if wine_prod.aging_progress < wine_prod.aging_duration:
+                    wine_prod.aging_progress = min(wine_prod.aging_duration, wine_prod.aging_progress + months)
+
+    def advance_until_next_event(self, max_months: int = DEFAULT_EVENT_HORIZON_MONTHS) -> Optional[Tuple[List[GameEvent], int]]:
+        """Returns the events of the month something happened in, and how many months were advanced."""
+        if not 1 <= max_months <= MAX_ADVANCE_MONTHS:
+            return None
+        events = []
+        months_advanced = 0
+        while not events and months_advanced < max_months:
+            next_event = self.next_event_in_months()
+            months_ahead = min(next_event if next_event is not None else max_months, max_months - months_advanced)
+            if months_ahead > 1:
+                self._skip_months(months_ahead - 1)
+                months_advanced += months_ahead - 1
+            events = self._tick()
+            months_advanced += 1
+        return events, months_advanced
+
+    def buy_vineyard(self, vineyard_data: Dict[str, Any], vineyard_name: str) -> Optional[SimVineyard]:
+        player = self.player
+        cost = vineyard_data["cost"]
+        if player.money < cost:
+            return None
+        vineyard = SimVineyard(
+            name=vineyard_name,
+            varietal=vineyard_data["varietal"],
+            region=vineyard_data["region"],
+            size_acres=self.rng.randint(3, 10),
+            age_of_vines=self.rng.randint(3, 20),
+            soil_type=self.rng.choice(REGIONS[vineyard_data["region"]]["soil_types"]),
+        )
+        player.vineyards.append(vineyard)
+        player.money -= cost
+        player.reputation += 2
+        return vineyard
+
+    def _find_vineyard(self, vineyard_name: str) -> Optional[SimVineyard]:
+        return next((vineyard for vineyard in self.player.vineyards if vineyard.name == vineyard_name), None)
+
+    def tend_vineyard(self, vineyard_name: str) -> bool:
+        player = self.player
+        cost = 500
+        if player.money < cost:
+            return False
+        vineyard = self._find_vineyard(vineyard_name)
+        if vineyard is None:
+            return False
+        player.money -= cost
+        vineyard.health = min(100, vineyard.health + self.rng.randint(5, 15))
+        return True
+
+    def harvest_grapes(self, vineyard_name: str) -> Optional[SimGrape]:
+        player = self.player
+        vineyard = self._find_vineyard(vineyard_name)
+        if not (vineyard and vineyard.grapes_ready and not vineyard.harvested_this_year):
+            return None
+        base_yield_per_acre = 400 # kg
+        yield_kg = int(base_yield_per_acre * vineyard.size_acres * (vineyard.health / 100.0) * self.rng.uniform(0.8, 1.2))
+        base_quality = GRAPE_CHARACTERISTICS[vineyard.varietal]["base_quality"]
+        grape_quality = int(base_quality * (vineyard.health / 100.0) + self.rng.randint(-5, 5))
+        grape_quality = max(1, min(100, grape_quality))
+
+        grapes = SimGrape(varietal=vineyard.varietal, vintage=self.state.current_year, quantity_kg=yield_kg, quality=grape_quality)
+        player.grapes_inventory.append(grapes)
+        vineyard.harvested_this_year = True
+        vineyard.grapes_ready = False
+        player.reputation += 5
+        return grapes
+
+    def buy_vessel(self, vessel_type_name: str) -> Optional[SimVessel]:
+        player = self.player
+        if vessel_type_name not in VESSEL_TYPES:
+            return None
+        vessel_data = VESSEL_TYPES[vessel_type_name]
+        if player.money < vessel_data["cost"]:
+            return None
+        vessel = SimVessel(type=vessel_type_name, capacity=vessel_data["capacity"], in_use=False)
+        player.winery.vessels.append(vessel)
+        player.money -= vessel_data["cost"]
+        return vessel
+
+    def process_grapes(self, grape_index: int, sort_choice: str, destem_crush_method: str) -> Optional[SimMust]:
+        player = self.player
+        if not 0 <= grape_index < len(player.grapes_inventory):
+            return None
+        grapes = player.grapes_inventory[grape_index]
+        processing_method = "Unsorted"
+        if sort_choice == "yes":
+            sort_cost = (grapes.quantity_kg / 100) * 100
+            if player.money >= sort_cost:
+                player.money -= sort_cost
+                grapes.quality = min(100, grapes.quality + self.rng.randint(2, 5))
+                processing_method = "Sorted"
+
+        if destem_crush_method == "Whole Cluster":
+            grapes.quality = max(1, grapes.quality + self.rng.randint(-2, 4))
+        elif destem_crush_method == "Partial Destem":
+            grapes.quality = max(1, grapes.quality + self.rng.randint(0, 2))
+        elif destem_crush_method == "Destemmed/Crushed":
+            grapes.quality = max(1, grapes.quality + self.rng.randint(-1, 1))
+
+        must = SimMust(
+            varietal=grapes.varietal,
+            vintage=self.state.current_year,
+            quantity_kg=grapes.quantity_kg,
+            quality=grapes.quality,
+            processing_method=processing_method,
+            destem_crush_method=destem_crush_method,
+        )
+        player.winery.must_in_production.append(must)
+        player.grapes_inventory.pop(grape_index)
+        return must
+
+    def start_fermentation(self, must_index: int, vessel_index: int) -> Optional[SimWineInProduction]:
+        player, winery = self.player, self.winery
+        if not (0 <= must_index < len(winery.must_in_production) and 0 <= vessel_index < len(winery.vessels)):
+            return None
+        must = winery.must_in_production[must_index]
+        vessel = winery.vessels[vessel_index]
+        if vessel.in_use or vessel.capacity < must.quantity_kg * 0.75 or "fermentation" not in VESSEL_TYPES[vessel.type]["type"]:
+            return None
+
+        vessel.in_use = True
+        wine_prod = SimWineInProduction(
+            varietal=must.varietal,
+            vintage=self.state.current_year,
+            quantity_liters=must.quantity_kg * 0.75,
+            quality=must.quality,
+            vessel_type=vessel.type,
+            vessel_index=vessel_index,
+            stage="fermenting",
+        )
+        winery.wines_fermenting.append(wine_prod)
+        winery.must_in_production.pop(must_index)
+        player.reputation += 3
+        return wine_prod
+
+    def perform_maceration_action(self, wine_prod_index: int, action_type: str) -> bool:
+        winery = self.winery
+        if not 0 <= wine_prod_index < len(winery.wines_fermenting):
+            return False
+        wine_prod = winery.wines_fermenting[wine_prod_index]
+        if GRAPE_CHARACTERISTICS[wine_prod.varietal]["color"] != "red" or wine_prod.fermentation_progress >= 100:
+            return False
+        wine_prod.quality = min(100, wine_prod.quality + self.rng.randint(1, 3))
+        wine_prod.maceration_actions_taken += 1
+        return True
+
+    def start_aging(self, wine_prod_index: int, vessel_index: int, aging_duration: int) -> Optional[SimWineInProduction]:
+        winery = self.winery
+        if not (0 <= wine_prod_index < len(winery.wines_fermenting) and 0 <= vessel_index < len(winery.vessels)):
+            return None
+        wine_prod = winery.wines_fermenting[wine_prod_index]
+        vessel = winery.vessels[vessel_index]
+        if not (wine_prod.fermentation_progress >= 100 and not vessel.in_use and
+                vessel.capacity >= wine_prod.quantity_liters and "aging" in VESSEL_TYPES[vessel.type]["type"]):
+            return None
+
+        # Free up the fermentation vessel
+        if wine_prod.vessel_index is not None and 0 <= wine_prod.vessel_index < len(winery.vessels):
+            winery.vessels[wine_prod.vessel_index].in_use = False
+        vessel.in_use = True
+        wine_prod.vessel_type = vessel.type
+        wine_prod.vessel_index = vessel_index
+        wine_prod.stage = "aging"
+        wine_prod.aging_duration = aging_duration
+        winery.wines_fermenting.remove(wine_prod)
+        winery.wines_aging.append(wine_prod)
+        _sort_by_id(winery.wines_aging)
+        return wine_prod
+
+    def bottle_wine(self, wine_prod_index: int, wine_name: str) -> Optional[SimWine]:
+        player, winery = self.player, self.winery
+        if not 0 <= wine_prod_index < len(winery.wines_aging):
+            return None
+        wine_prod = winery.wines_aging[wine_prod_index]
+        if wine_prod.aging_progress < wine_prod.aging_duration:
+            return None
+
+        wine = SimWine(
+            name=wine_name,
+            vintage=wine_prod.vintage,
+            varietal=wine_prod.varietal,
+            style=GRAPE_CHARACTERISTICS[wine_prod.varietal]["color"].capitalize(),
+            quality=wine_prod.quality,
+            bottles=int(wine_prod.quantity_liters / 0.75),
+        )
+        player.bottled_wines.append(wine)
+        winery.vessels[wine_prod.vessel_index].in_use = False
+        winery.wines_aging.pop(wine_prod_index)
+        player.reputation += 10
+        self._event("wine_bottled", wine.name, wine)
+        return wine
@@ -0,0 +1,177 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from starlette.datastructures import URL
+from starlette.responses import FileResponse, PlainTextResponse, RedirectResponse, Response
+from starlette.types import Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError: # Optional: without it only gzip variants are produced
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Files larger than this are streamed from disk instead of being held in memory
+MAX_IN_MEMORY_FILE_BYTES = int(os.getenv("STATIC_MAX_IN_MEMORY_FILE_BYTES", 2 * 1024 * 1024))
+# Content types worth compressing; fonts, images and the like already are
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "application/xml", "application/wasm")
+# Next.js puts content-hashed build output under _next/static, so those URLs never change content
+IMMUTABLE_PATH_MARKER = "_next/static/"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+# Preference order when the client accepts several encodings
+ENCODINGS = ("br", "gzip")
+
+@dataclass
+class StaticAsset:
+    path: str
+    media_type: str
+    etag: str
+    cache_control: str
+    # Encoding ("identity", "gzip", "br") -> body; empty for files served from disk
+    variants: Dict[str, bytes] = field(default_factory=dict)
+
+def _is_compressible(media_type: str) -> bool:
+    return media_type.startswith(COMPRESSIBLE_TYPES)
+
+def _read_prebuilt_variant(path: str) -> Optional[bytes]:
+    # Variants produced at build time (e.g. app.js.br next to app.js) win over compressing at startup
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            return f.read()
+    return None
+
+def load_asset(path: str, url_path: str) -> StaticAsset:
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if media_type.startswith("text/") or media_type == "application/javascript":
+        media_type += "; charset=utf-8"
+    cache_control = IMMUTABLE_CACHE_CONTROL if IMMUTABLE_PATH_MARKER in url_path else REVALIDATE_CACHE_CONTROL
+    size = os.path.getsize(path)
+    if size > MAX_IN_MEMORY_FILE_BYTES:
+        stat = os.stat(path)
+        return StaticAsset(path, media_type, f'"{stat.st_mtime_ns:x}-{size:x}"', cache_control)
+
+    with open(path, "rb") as f:
+        body = f.read()
+    asset = StaticAsset(path, media_type, f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"', cache_control, {"identity": body})
+    if _is_compressible(media_type):
+        compressed = {
+            "gzip": _read_prebuilt_variant(path + ".gz") or gzip.compress(body, compresslevel=9, mtime=0),
+            "br": _read_prebuilt_variant(path + ".br") or (brotli.compress(body) if brotli else None),
+        }
+        for encoding, variant in compressed.items():
+            if variant is not None and len(variant) < len(body):
+                asset.variants[encoding] = variant
+    return asset
+
+def negotiate_encoding(accept_encoding: str, available: List[str]) -> str:
+    """Picks the preferred encoding the client accepts (q > 0) among the asset's variants."""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in ENCODINGS:
+        if encoding in available and accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return "identity"
+
+def _etag_matches(etag: str, request_headers: Dict[str, str]) -> bool:
+    return etag in (tag.strip() for tag in request_headers.get("if-none-match", "").split(","))
+
+class StaticAssets:
+    """ASGI app serving a static export from memory, with precompressed variants.
+
+    Replaces `StaticFiles(directory=..., html=True)` for the frontend build: every file is read and
+    compressed once when the app starts, responses negotiate `Accept-Encoding`, carry an ETag (and
+    answer `If-None-Match` with 304), and content-hashed `_next/static` files are marked immutable.
+    """
+    def __init__(self, directory: str, html: bool = True):
+        self.directory = directory
+        self.html = html
+        self.assets: Dict[str, StaticAsset] = {}
+        if not os.path.isdir(directory):
+            logger.warning(f"Static directory '{directory}' does not exist; no frontend assets will be served.")
+            return
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.endswith((".gz", ".br")) and os.path.isfile(os.path.join(root, name[:-3])):
+                    continue # Prebuilt variant, picked up with its original
+                path = os.path.join(root, name)
+                url_path = os.path.relpath(path, directory).replace(os.sep, "/")
+                self.assets[url_path] = load_asset(path, url_path)
+        in_memory = sum(len(v) for asset in self.assets.values() for v in asset.variants.values())
+        logger.info(f"Loaded {len(self.assets)} static assets ({in_memory // 1024} KiB in memory).")
+
+    def lookup(self, url_path: str) -> Tuple[Optional[StaticAsset], int]:
+        """The asset for a URL path and the status to serve it with. 307 means the path names a
+        directory without its trailing slash, which `StaticFiles` redirects to the slash form."""
+        url_path = url_path.lstrip("/")
+        if url_path in self.assets:
+            return self.assets[url_path], 200
+        if self.html:
+            directory = url_path.rstrip("/")
+            index = f"{directory}/index.html".lstrip("/")
+            if index in self.assets:
+                # Relative links in the page only resolve against the slash form of a directory URL
+                return self.assets[index], 200 if url_path == "" or url_path.endswith("/") else 307
+            if directory and f"{directory}.html" in self.assets:
+                return self.assets[f"{directory}.html"], 200
+            if "404.html" in self.assets:
+                return self.assets["404.html"], 404
+        return None, 404
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["method"] not in ("GET", "HEAD"):
+            response = PlainTextResponse("Method Not Allowed", status_code=405)
+            await response(scope, receive, send)
+            return
+
+        asset, status_code = self.lookup(scope["path"])
+        if asset is None:
+            await PlainTextResponse("Not Found", status_code=404)(scope, receive, send)
+            return
+
+        if status_code == 307:
+            url = URL(scope=scope)
+            await RedirectResponse(url.replace(path=url.path + "/"), status_code=307)(scope, receive, send)
+            return
+
+        request_headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        if not asset.variants:
+            # Large files are streamed from disk as is, but revalidate against the same ETag
+            headers = {"ETag": asset.etag, "Cache-Control": asset.cache_control}
+            if status_code == 200 and _etag_matches(asset.etag, request_headers):
+                await Response(status_code=304, headers=headers)(scope, receive, send)
+                return
+            response = FileResponse(asset.path, status_code=status_code, media_type=asset.media_type, headers=headers)
+            await response(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(request_headers.get("accept-encoding", ""), list(asset.variants))
+        # Each encoding is a different representation, so it gets its own entity tag
+        etag = asset.etag if encoding == "identity" else f'{asset.etag[:-1]}-{encoding}"'
+        headers = {"ETag": etag, "Cache-Control": asset.cache_control, "Vary": "Accept-Encoding"}
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+
+        if status_code == 200 and _etag_matches(etag, request_headers):
+            await Response(status_code=304, headers=headers)(scope, receive, send)
+            return
+
+        body = asset.variants[encoding]
+        response = Response(body if scope["method"] == "GET" else b"", status_code=status_code, media_type=asset.media_type, headers=headers)
+        if scope["method"] == "HEAD":
+            response.headers["Content-Length"] = str(len(body))
+        await response(scope, receive, send)
@@ -1,8 +1,30 @@
+import asyncio
+import logging
+import os
+import shutil
+import time
 import pytest
 from fastapi.testclient import TestClient
-from main import app, get_db, api_router, initialize_database, get_current_user, lifespan
+from main import app, get_db, get_async_db, api_router, initialize_database, get_current_user, create_access_token, authenticate_token, lifespan
+import main
+from token_cache import TokenCache, token_cache
+from static_assets import StaticAssets, negotiate_encoding
+import static_assets
+from player_locks import KeyedLock
+import metrics
+import profiling
+import diagnostics
+from diagnostics import diagnostics_router
+import write_behind as write_behind_module
+from write_behind import WriteBehindCache, recover_journal
+from profiling import ProfilingMiddleware, profiling_router
+from metrics import MetricsMiddleware, QueryStatsMiddleware, metrics_router, Histogram, TimedQueuePool, DB_POOL_CHECKOUT_WAIT, REGISTRY
+import httpx
+from event_hub import hub
+import responses
+from starlette.websockets import WebSocketDisconnect
 from fastapi import FastAPI
-from game_logic import Game
+from game_logic import Game, encode_cursor
 from typing import Optional
 from game_models import (
     Player, Vineyard, Winery, Grape, Must, WineInProduction, Wine, GameState, WineryVessel,
@@ -13,6 +35,8 @@ from game_models import (
 )
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import NullPool
 
 # Setup a test database
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
@@ -20,6 +44,9 @@ engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# TestClient may run each request on a fresh event loop, so don't pool aiosqlite connections
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False)
 
 @pytest.fixture(name="db")
 def db_fixture():
@@ -33,17 +60,28 @@ def db_fixture():
 
 test_app = FastAPI(lifespan=lifespan)
 test_app.include_router(api_router, prefix="/api")
+test_app.add_middleware(MetricsMiddleware)
+test_app.add_middleware(QueryStatsMiddleware)
+test_app.include_router(metrics_router)
+test_app.add_middleware(ProfilingMiddleware)
+test_app.include_router(profiling_router)
+test_app.include_router(diagnostics_router)
 
 @pytest.fixture(name="client")
 def client_fixture(db: Session):
     def override_get_db():
         yield db
 
+    async def override_get_async_db():
+        async with TestingAsyncSessionLocal() as session:
+            yield session
+
     def override_get_current_user():
         return db.query(DBPlayer).first()
 
     initialize_database(db)
     test_app.dependency_overrides[get_db] = override_get_db
+    test_app.dependency_overrides[get_async_db] = override_get_async_db
     test_app.dependency_overrides[get_current_user] = override_get_current_user
     client = TestClient(test_app)
     yield client
@@ -63,6 +101,25 @@ def test_advance_month_endpoint(client, db: Session):
     db_game_state = db.query(DBGameState).first()
     assert db_game_state.current_month_index == 1 # Should advance by one month
 
+def test_advance_months_endpoint(client, db: Session):
+    response = client.post("/api/advance_months", json={"months": 3})
+    assert response.status_code == 200
+    assert "events" in response.json()
+    assert response.json()["game_state"]["current_month_index"] == 3
+    db_game_state = db.query(DBGameState).first()
+    assert db_game_state.current_month_index == 3
+
+def test_advance_months_endpoint_invalid_count(client):
+    response = client.post("/api/advance_months", json={"months": 0})
+    assert response.status_code == 400
+
+def test_advance_until_event_endpoint(client):
+    response = client.post("/api/advance_until_event")
+    assert response.status_code == 200
+    # The starting vineyard ripens in September
+    assert response.json()["months_advanced"] == 8
+    assert response.json()["events"][0]["type"] == "grapes_ready"
+
 def test_get_player(client):
     response = client.get("/api/player")
     assert response.status_code == 200
@@ -163,6 +220,7 @@ def test_start_fermentation_endpoint_success(client, db: Session):
 
     vessel = db_winery.vessels[0] # Use an existing vessel
     vessel_index = db_winery.vessels.index(vessel)
+    new_must_id = new_must.id # The handler deletes the row from its own session
 
     request_body = StartFermentationRequest(must_index=0, vessel_index=vessel_index)
     response = client.post("/api/start_fermentation", json=request_body.model_dump())
@@ -170,7 +228,7 @@ def test_start_fermentation_endpoint_success(client, db: Session):
     assert "varietal" in response.json()
     db.refresh(db_winery)
     db.refresh(vessel)
-    assert db.query(DBMust).filter(DBMust.id == new_must.id).first() is None
+    assert db.query(DBMust).filter(DBMust.id == new_must_id).first() is None
     assert len(db_winery.wines_fermenting) == 1
     assert vessel.in_use
 
@@ -228,6 +286,7 @@ def test_bottle_wine_endpoint_success(client, db: Session):
     db.refresh(db_winery)
 
     wine_prod_index = db_winery.wines_aging.index(wine_prod)
+    wine_prod_id = wine_prod.id # The handler deletes the row from its own session
     request_body = BottleWineRequest(wine_prod_index=wine_prod_index, wine_name="My Test Wine")
     response = client.post("/api/bottle_wine", json=request_body.model_dump())
     assert response.status_code == 200
@@ -237,4 +296,494 @@ def test_bottle_wine_endpoint_success(client, db: Session):
     db.refresh(vessel)
     assert len(db_player.bottled_wines) == 1
     assert not vessel.in_use
-    assert not db.query(DBWineInProduction).filter(DBWineInProduction.id == wine_prod.id).first()
+    assert not db.query(DBWineInProduction).filter(DBWineInProduction.id == wine_prod_id).first()
+
+def test_get_state_conditional_requests(client):
+    response = client.get("/api/gamestate")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = client.get("/api/gamestate", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert client.get("/api/vineyards", headers={"If-None-Match": etag}).status_code == 304
+
+    client.post("/api/tend_vineyard", json={"vineyard_name": "Home Block"})
+    response = client.get("/api/gamestate", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()["player"]["state_version"] > 0
+
+def test_get_game_state_delta(client):
+    client.post("/api/tend_vineyard", json={"vineyard_name": "Home Block"})
+    response = client.get("/api/gamestate/delta", params={"since_version": 0})
+    assert response.status_code == 200
+    assert response.json()["full_resync"] is False
+    assert [v["name"] for v in response.json()["vineyards"]] == ["Home Block"]
+    state_version = response.json()["state_version"]
+
+    response = client.get("/api/gamestate/delta", params={"since_version": state_version})
+    assert response.json()["vineyards"] == []
+
+def test_player_events_websocket(client, db: Session):
+    player = db.query(DBPlayer).first()
+    token = create_access_token({"sub": player.name})
+    with client.websocket_connect(f"/api/events?token={token}") as websocket:
+        for _ in range(100): # Subscription happens just after the handshake
+            if hub.subscriber_count(player.id):
+                break
+            time.sleep(0.01)
+        client.post("/api/tend_vineyard", json={"vineyard_name": "Home Block"})
+        message = websocket.receive_json()
+        assert message["type"] == "state_changed"
+        assert message["money"] == player.money - 500
+
+def test_player_events_websocket_rejects_invalid_token(client):
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect("/api/events?token=not-a-token") as websocket:
+            websocket.receive_json()
+
+def test_actions_endpoint_runs_harvest_turn(client, db: Session):
+    db_vineyard = db.query(DBVineyard).first()
+    db_vineyard.grapes_ready = True
+    db.commit()
+    commands = [
+        {"action": "harvest_grapes", "params": HarvestGrapesRequest(vineyard_name=db_vineyard.name).model_dump()},
+        {"action": "process_grapes", "params": ProcessGrapesRequest(grape_index=0, sort_choice="no", destem_crush_method="Destemmed/Crushed").model_dump()},
+        {"action": "start_fermentation", "params": {"must_index": 0, "vessel_index": 0}},
+        {"action": "perform_maceration_action", "params": {"wine_prod_index": 0, "action_type": "Punch Down"}},
+    ]
+    response = client.post("/api/actions", json={"commands": commands})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [r["action"] for r in results] == [c["action"] for c in commands]
+    assert results[0]["result"]["varietal"] == db_vineyard.varietal
+    assert results[3]["result"] is None
+    assert db.query(DBWineInProduction).filter(DBWineInProduction.stage == "fermenting").count() == 1
+
+def test_actions_endpoint_is_all_or_nothing(client, db: Session):
+    db_player = db.query(DBPlayer).first()
+    initial_money = db_player.money
+    commands = [
+        {"action": "tend_vineyard", "params": {"vineyard_name": "Home Block"}},
+        {"action": "harvest_grapes", "params": {"vineyard_name": "Home Block"}}, # Not ripe yet
+    ]
+    response = client.post("/api/actions", json={"commands": commands})
+    assert response.status_code == 400
+    assert "Command 1 (harvest_grapes)" in response.text
+    db.refresh(db_player)
+    assert db_player.money == initial_money
+
+    response = client.post("/api/actions", json={"commands": [{"action": "advance_month", "params": {}}]})
+    assert response.status_code == 422
+
+def test_fast_json_responses_match_default_path(client, monkeypatch):
+    client.post("/api/buy_vessel", json={"vessel_type_name": "Concrete Egg"})
+    default_state = client.get("/api/gamestate").json()
+    default_vineyards = client.get("/api/vineyards").json()
+
+    monkeypatch.setattr(responses, "FAST_JSON_RESPONSES", True)
+    response = client.get("/api/gamestate")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert "ETag" in response.headers
+    assert response.json() == default_state
+    assert client.get("/api/vineyards").json() == default_vineyards
+    assert client.post("/api/advance_month").json()["current_month_index"] == default_state["current_month_index"] + 1
+
+def test_grapes_inventory_pagination(client, db: Session):
+    db_player = db.query(DBPlayer).first()
+    for quality in (50, 80, 65):
+        db.add(DBGrape(varietal="Pinot Noir", vintage=2025, quantity_kg=100, quality=quality, player_id=db_player.id))
+    db.commit()
+
+    response = client.get("/api/grapes_inventory", params={"sort": "-quality", "limit": 2})
+    assert response.status_code == 200
+    assert [g["quality"] for g in response.json()] == [80, 65]
+    response = client.get("/api/grapes_inventory", params={"sort": "-quality", "limit": 2, "cursor": response.headers["X-Next-Cursor"]})
+    assert [g["quality"] for g in response.json()] == [50]
+    assert "X-Next-Cursor" not in response.headers
+
+def test_grapes_inventory_rejects_malformed_cursors(client):
+    for values in ([{"a": 1}, [2]], [80, "2"], [80, True], [80, 2, 3], {"a": 1}, [None, 2]):
+        cursor = encode_cursor(values)
+        assert client.get("/api/grapes_inventory", params={"sort": "quality", "cursor": cursor}).status_code == 400
+    assert client.get("/api/grapes_inventory", params={"cursor": "not-a-cursor"}).status_code == 400
+
+    assert client.get("/api/grapes_inventory", params={"limit": 0}).status_code == 400
+
+def test_authenticate_token_uses_cache(client, db: Session, monkeypatch):
+    token_cache.clear()
+    player = db.query(DBPlayer).first()
+    token = create_access_token({"sub": player.name})
+
+    async def authenticate():
+        async with TestingAsyncSessionLocal() as session:
+            authenticated = await authenticate_token(token, session)
+            return authenticated.id if authenticated else None
+
+    assert asyncio.run(authenticate()) == player.id
+    # Cached: the signature isn't verified again
+    monkeypatch.setattr(main.jwt, "decode", lambda *args, **kwargs: pytest.fail("token decoded twice"))
+    assert asyncio.run(authenticate()) == player.id
+
+    # Renaming the player invalidates its cached tokens, and the old name no longer resolves
+    monkeypatch.undo()
+    player.name = "Renamed Winemaker"
+    db.commit()
+    assert token_cache.get(token) is None
+    assert asyncio.run(authenticate()) is None
+
+def test_token_cache_expiry_and_eviction():
+    cache = TokenCache(max_size=2, ttl_seconds=60)
+    cache.put("expired", 1, exp=time.time() - 1)
+    assert cache.get("expired") is None
+    cache.put("a", 1, exp=None)
+    cache.put("b", 2, exp=None)
+    cache.get("a")
+    cache.put("c", 3, exp=None) # Evicts the least recently used token, "b"
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+    cache.invalidate_player(1)
+    assert cache.get("a") is None
+
+def test_static_assets_negotiate_encoding_and_cache_headers(tmp_path):
+    chunk_dir = tmp_path / "_next" / "static" / "chunks"
+    chunk_dir.mkdir(parents=True)
+    (chunk_dir / "main-0123abcd.js").write_text("console.log('terroir');\n" * 200)
+    (tmp_path / "index.html").write_text("<html><body>" + "Terroir & Time " * 100 + "</body></html>")
+    (tmp_path / "404.html").write_text("<html>Not here</html>")
+    static_client = TestClient(StaticAssets(str(tmp_path)))
+
+    response = static_client.get("/_next/static/chunks/main-0123abcd.js", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "immutable" in response.headers["Cache-Control"]
+    assert response.text == "console.log('terroir');\n" * 200 # httpx decodes the gzip body
+
+    response = static_client.get("/", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Cache-Control"] == "no-cache"
+    assert static_client.get("/", headers={"Accept-Encoding": "identity", "If-None-Match": response.headers["ETag"]}).status_code == 304
+
+    response = static_client.get("/missing")
+    assert response.status_code == 404
+    assert "Not here" in response.text
+    assert static_client.post("/").status_code == 405
+
+def test_static_assets_serve_directories_like_static_files(tmp_path, monkeypatch):
+    (tmp_path / "out").mkdir()
+    (tmp_path / "out" / "index.html").write_text("<html>Cellar</html>")
+    (tmp_path / "movie.mp4").write_bytes(b"\0" * 2048)
+    monkeypatch.setattr(static_assets, "MAX_IN_MEMORY_FILE_BYTES", 1024)
+    static_client = TestClient(StaticAssets(str(tmp_path)))
+
+    response = static_client.get("/out/")
+    assert response.status_code == 200
+    assert response.text == "<html>Cellar</html>"
+    response = static_client.get("/out?tab=aging", follow_redirects=False)
+    assert response.status_code == 307
+    assert response.headers["Location"].endswith("/out/?tab=aging")
+
+    # Files streamed from disk revalidate too
+    response = static_client.get("/movie.mp4")
+    assert response.status_code == 200
+    assert static_client.get("/movie.mp4", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+def test_negotiate_encoding():
+    assert negotiate_encoding("gzip, br", ["identity", "gzip", "br"]) == "br"
+    assert negotiate_encoding("gzip;q=1.0, br;q=0", ["identity", "gzip", "br"]) == "gzip"
+    assert negotiate_encoding("br", ["identity", "gzip"]) == "identity"
+    assert negotiate_encoding("", ["identity", "gzip"]) == "identity"
+
+def test_concurrent_actions_for_a_player_are_serialized(client, db: Session):
+    db_winery = db.query(DBWinery).first()
+    for _ in range(2):
+        db.add(DBMust(varietal="Pinot Noir", vintage=2025, quantity_kg=500, quality=70, processing_method="Sorted", destem_crush_method="Destemmed/Crushed", winery_id=db_winery.id))
+    db_winery.vessels[0].in_use = False
+    db.commit()
+
+    async def ferment_both_in_one_vessel():
+        transport = httpx.ASGITransport(app=test_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as async_client:
+            return await asyncio.gather(*(
+                async_client.post("/api/start_fermentation", json={"must_index": must_index, "vessel_index": 0})
+                for must_index in (1, 0)
+            ))
+
+    responses = asyncio.run(ferment_both_in_one_vessel())
+    # The second request sees the vessel the first one filled
+    assert sorted(r.status_code for r in responses) == [200, 400]
+
+def test_keyed_lock_serializes_per_key_only():
+    locks = KeyedLock()
+    order = []
+
+    async def worker(key, name):
+        async with locks.hold(key):
+            order.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            order.append(f"{name} end")
+
+    async def run():
+        await asyncio.gather(worker(1, "a"), worker(1, "b"), worker(2, "c"))
+
+    asyncio.run(run())
+    assert order.index("a end") < order.index("b start")
+    assert order.index("c start") < order.index("a end") # Another key runs alongside
+    assert len(locks) == 0
+
+def test_metrics_endpoint_requires_the_token(client, monkeypatch):
+    assert client.get("/metrics").status_code == 404 # No token configured
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "scrape-secret")
+    assert client.get("/metrics").status_code == 404
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 404
+    assert client.get("/metrics", headers={"Authorization": "Bearer scrape-secret"}).status_code == 200
+
+def test_metrics_endpoint_reports_routes_queries_and_game_methods(client, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "scrape-secret")
+    assert client.post("/api/advance_month").status_code == 200
+    assert client.get("/api/gamestate").status_code == 200
+
+    response = client.get("/metrics", headers={"Authorization": "Bearer scrape-secret"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    body = response.text
+    assert 'http_request_duration_seconds_bucket{method="POST",route="/api/advance_month",le="+Inf"}' in body
+    assert 'http_requests_total{method="GET",route="/api/gamestate",status="200"}' in body
+    assert 'db_queries_per_request_count{method="GET",route="/api/gamestate"}' in body
+    assert 'game_method_duration_seconds_count{method="advance_month"}' in body
+    assert 'db_commit_duration_seconds_count ' in body
+    # Only the /metrics request itself is in flight while rendering
+    assert "http_requests_in_progress 1" in body
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("test_latency_seconds", "Test histogram.", ("route",), buckets=(0.1, 1.0))
+    REGISTRY.remove(histogram)
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value, route="/x")
+    lines = histogram.render().splitlines()
+    assert lines[:2] == ["# HELP test_latency_seconds Test histogram.", "# TYPE test_latency_seconds histogram"]
+    assert 'test_latency_seconds_bucket{route="/x",le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{route="/x",le="1"} 3' in lines
+    assert 'test_latency_seconds_bucket{route="/x",le="+Inf"} 4' in lines
+    assert 'test_latency_seconds_sum{route="/x"} 4.25' in lines
+    assert 'test_latency_seconds_count{route="/x"} 4' in lines
+
+def test_timed_pool_records_checkout_wait():
+    timed_engine = create_engine("sqlite://", poolclass=TimedQueuePool, pool_logging_name="test_pool")
+    before = DB_POOL_CHECKOUT_WAIT.count(pool="test_pool")
+    with timed_engine.connect():
+        pass
+    assert DB_POOL_CHECKOUT_WAIT.count(pool="test_pool") == before + 1
+    timed_engine.dispose()
+
+def test_query_debug_headers_report_the_request_budget(client, monkeypatch):
+    monkeypatch.setattr(metrics, "QUERY_DEBUG_HEADERS", True)
+    response = client.get("/api/gamestate")
+    assert response.status_code == 200
+    # Statements run by the sync Game inside run_sync are attributed to the request and the method
+    assert int(response.headers["X-Query-Count"]) > 0
+    assert float(response.headers["X-Query-Time-Ms"]) >= 0
+    assert "get_game_state=" in response.headers["X-Query-Breakdown"]
+
+    monkeypatch.setattr(metrics, "QUERY_DEBUG_HEADERS", False)
+    assert "X-Query-Count" not in client.get("/api/gamestate").headers
+
+def test_requests_over_the_query_budget_are_logged(client, monkeypatch, caplog):
+    monkeypatch.setattr(metrics, "QUERY_BUDGET_PER_REQUEST", 0)
+    with caplog.at_level(logging.WARNING, logger="metrics"):
+        assert client.get("/api/gamestate").status_code == 200
+    assert "GET /api/gamestate exceeded the query budget of 0" in caplog.text
+
+@pytest.fixture(name="profiles_dir")
+def profiles_dir_fixture(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_TOKEN", "profile-secret")
+    monkeypatch.setattr(profiling, "PROFILES_DIR", str(tmp_path))
+    return tmp_path
+
+def test_profiling_requires_the_token(client, profiles_dir):
+    response = client.post("/api/advance_month", headers={"X-Profile-Token": "wrong"})
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+    assert list(profiles_dir.iterdir()) == []
+    assert client.get("/debug/profiles").status_code == 404
+    assert client.get("/debug/profiles", headers={"X-Profile-Token": "wrong"}).status_code == 404
+
+def test_profiled_request_is_saved_and_listed(client, profiles_dir):
+    auth = {"X-Profile-Token": "profile-secret"}
+    response = client.post("/api/advance_month", headers=auth)
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+    assert profile_id.endswith(".pstats") and "-POST-api_advance_month-" in profile_id
+    assert (profiles_dir / profile_id).is_file()
+
+    index = client.get("/debug/profiles", headers=auth)
+    assert [profile["name"] for profile in index.json()] == [profile_id]
+    report = client.get(f"/debug/profiles/{profile_id}", headers=auth)
+    assert report.status_code == 200
+    assert "advance_month" in report.text # The Game call is inside the profile
+    assert client.get("/debug/profiles/..%2Fgame.db", headers=auth).status_code == 404
+
+def test_sampled_profiles_write_collapsed_stacks(client, profiles_dir, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_TOKEN", "")
+    monkeypatch.setattr(profiling, "PROFILING_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(profiling, "PROFILING_MODE", "sampler")
+    monkeypatch.setattr(profiling, "PROFILES_KEEP", 2)
+    for _ in range(3):
+        assert client.post("/api/advance_month").headers["X-Profile-Id"].endswith(".collapsed")
+    profiles = sorted(profiles_dir.iterdir())
+    assert len(profiles) == 2 # The oldest one was pruned
+    for line in profiles[-1].read_text().splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0 and stack
+
+def test_memory_diagnostics_require_the_token(client, monkeypatch):
+    assert client.get("/debug/memory").status_code == 404
+    monkeypatch.setattr(diagnostics, "DIAGNOSTICS_TOKEN", "memory-secret")
+    assert client.get("/debug/memory", headers={"X-Diagnostics-Token": "wrong"}).status_code == 404
+    assert client.get("/debug/memory", headers={"X-Diagnostics-Token": "memory-secret"}).status_code == 200
+
+def test_memory_status_without_resource_module(client, monkeypatch):
+    monkeypatch.setattr(diagnostics, "DIAGNOSTICS_TOKEN", "memory-secret")
+    monkeypatch.setattr(diagnostics, "resource", None) # As on Windows
+    status = client.get("/debug/memory", headers={"X-Diagnostics-Token": "memory-secret"}).json()
+    assert status["max_rss_kb"] is None
+    assert "gc_counts" in status
+
+def test_tracemalloc_snapshots_diff_allocation_sites(client, monkeypatch):
+    monkeypatch.setattr(diagnostics, "DIAGNOSTICS_TOKEN", "memory-secret")
+    auth = {"X-Diagnostics-Token": "memory-secret"}
+    assert client.post("/debug/memory/snapshots", headers=auth).status_code == 400 # Not tracing yet
+    try:
+        assert client.post("/debug/memory/tracemalloc/start?frames=5", headers=auth).json()["tracing"] is True
+        first = client.post("/debug/memory/snapshots", headers=auth).json()["id"]
+        retained = [bytearray(1024) for _ in range(1000)]
+        second = client.post("/debug/memory/snapshots", headers=auth).json()["id"]
+
+        diff = client.get(f"/debug/memory/snapshots/{first}/diff/{second}?limit=5", headers=auth).json()
+        top = diff[0]
+        assert top["size_diff"] >= 1000 * 1024
+        assert top["site"][0].startswith(__file__)
+        assert client.get(f"/debug/memory/snapshots/{first}/diff/999", headers=auth).status_code == 404
+        assert client.get(f"/debug/memory/snapshots/{first}/diff/{second}?key_type=bogus", headers=auth).status_code == 400
+        del retained
+    finally:
+        status = client.post("/debug/memory/tracemalloc/stop", headers=auth).json()
+    assert status["tracing"] is False
+    assert status["snapshots"] == []
+
+def test_orm_instance_counts_include_live_entities(client, db: Session, monkeypatch):
+    monkeypatch.setattr(diagnostics, "DIAGNOSTICS_TOKEN", "memory-secret")
+    vineyards = db.query(DBVineyard).all() # Held here, and in the session's identity map
+    counts = client.get("/debug/memory/orm", headers={"X-Diagnostics-Token": "memory-secret"}).json()
+    assert counts["instances"]["DBVineyard"] >= len(vineyards) > 0
+    assert "DBWineInProduction" in counts["instances"]
+    assert counts["sessions"] >= 1
+    assert counts["identity_map_entries"] >= len(vineyards)
+
+@pytest.fixture(name="write_behind")
+def write_behind_fixture(client, tmp_path, monkeypatch):
+    cache = WriteBehindCache(session_factory=TestingAsyncSessionLocal, journal_path=str(tmp_path / "write_behind.journal"))
+    monkeypatch.setattr(main, "WRITE_BEHIND_ENABLED", True)
+    monkeypatch.setattr(main, "write_behind_cache", cache)
+    return cache
+
+def test_write_behind_checkpoints_many_actions_as_one_version(client, db: Session, write_behind):
+    version = db.query(DBPlayer).first().state_version
+    for _ in range(3):
+        assert client.post("/api/advance_month").status_code == 200
+    assert client.post("/api/tend_vineyard", json={"vineyard_name": "Home Block"}).status_code == 200
+    assert client.post("/api/buy_vessel", json={"vessel_type_name": "Amphora (500L)"}).json()["vessels"][-1]["type"] == "Amphora (500L)"
+
+    # Nothing was written yet; reads are served from memory, with ETags that follow every action
+    db.expire_all()
+    assert db.query(DBGameState).first().current_month_index == 0
+    response = client.get("/api/gamestate")
+    assert response.json()["current_month_index"] == 3
+    etag = response.headers["ETag"]
+    assert client.get("/api/winery", headers={"If-None-Match": etag}).status_code == 304
+    client.post("/api/advance_month")
+    assert client.get("/api/gamestate", headers={"If-None-Match": etag}).status_code == 200
+
+    assert asyncio.run(write_behind.flush(force=True)) == 1
+    db.expire_all()
+    player = db.query(DBPlayer).first()
+    assert player.state_version == version + 1
+    assert player.game_state.current_month_index == 4
+    assert [vessel.type for vessel in player.winery.vessels][-1] == "Amphora (500L)"
+    assert write_behind.journal.read() == [] # Checkpointed records are dropped from the journal
+
+def test_write_behind_checkpoints_before_database_reads(client, db: Session, write_behind):
+    client.post("/api/advance_months", json={"months": 8})
+    grapes = client.post("/api/harvest_grapes", json={"vineyard_name": "Home Block"}).json()
+    assert grapes["id"] is None # Only assigned by the checkpoint
+    asyncio.run(write_behind.flush()) # Not due yet, so this only writes the journal
+    assert len(write_behind.journal.read()) == 2
+
+    response = client.get("/api/grapes_inventory") # Paged with SQL, so the player is checkpointed first
+    assert response.status_code == 200
+    assert [grape["id"] for grape in response.json()] == [db.query(DBGrape.id).scalar()]
+    assert response.json()[0]["quantity_kg"] == grapes["quantity_kg"]
+    assert write_behind.journal.read() == [] # Every checkpoint compacts the journal, not only flush()
+
+def test_write_behind_rolls_back_a_failed_action(client, db: Session, write_behind, monkeypatch):
+    client.post("/api/advance_month")
+    client.post("/api/tend_vineyard", json={"vineyard_name": "Home Block"})
+    before = client.get("/api/gamestate").json()
+
+    def buy_and_fail(simulation, vessel_type_name):
+        simulation.player.money -= 500
+        simulation.player.vineyards[0].health = 0
+        raise RuntimeError("failed half-way")
+    monkeypatch.setitem(write_behind_module.SIMULATED_METHODS, "buy_vessel", buy_and_fail)
+    with pytest.raises(RuntimeError):
+        client.post("/api/buy_vessel", json={"vessel_type_name": "Amphora (500L)"})
+
+    # The unsaved actions before it are kept, with the same random draws; nothing of the failed one is
+    after = client.get("/api/gamestate").json()
+    assert after == before
+    assert asyncio.run(write_behind.flush(force=True)) == 1
+    db.expire_all()
+    player = db.query(DBPlayer).first()
+    assert player.money == before["player"]["money"]
+    assert player.vineyards[0].health == before["player"]["vineyards"][0]["health"]
+
+def test_player_without_a_save_gets_404(client, db: Session, write_behind):
+    db.query(DBGameState).delete()
+    db.commit()
+    response = client.post("/api/advance_month") # Nothing to load into memory
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Game state not found."
+    assert client.get("/api/gamestate").status_code == 404 # Same answer from the database path
+
+def test_write_behind_journal_recovers_unsaved_actions(client, db: Session, write_behind):
+    client.post("/api/advance_month")
+    client.post("/api/buy_vessel", json={"vessel_type_name": "Amphora (500L)"})
+    client.post("/api/tend_vineyard", json={"vineyard_name": "Home Block"})
+    health = client.get("/api/vineyards").json()[0]["health"]
+    asyncio.run(write_behind.flush()) # Nobody is due for a checkpoint yet; the buffered records are written
+    records = write_behind.journal.read()
+    assert [record["method"] for record in records] == ["advance_month", "buy_vessel", "tend_vineyard"]
+    assert "state" not in records[0] # Commands, not snapshots of the state
+    # The process dies before any checkpoint, mid-way through journaling another action
+    write_behind.journal.close()
+    path = write_behind.journal.path
+    with open(path, "a") as f:
+        f.write('{"player_id": 1, "state_version": 0, "gener')
+    shutil.copy(path, f"{path}.crashed")
+    version = db.query(DBPlayer).first().state_version
+
+    assert recover_journal(db, path) == 1
+    assert not os.path.exists(path)
+    db.expire_all()
+    player = db.query(DBPlayer).first()
+    assert player.state_version == version + 1
+    assert player.game_state.current_month_index == 1
+    assert len(player.winery.vessels) == 6
+    assert player.vineyards[0].health == health # Replayed with the same random draws
+
+    # Replaying the same journal again is a no-op: the save has moved past the version it builds on
+    shutil.copy(f"{path}.crashed", path)
+    assert recover_journal(db, path) == 0
+    db.expire_all()
+    assert len(db.query(DBPlayer).first().winery.vessels) == 6
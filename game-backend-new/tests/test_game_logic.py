@@ -1,12 +1,22 @@
+import asyncio
+import random
 import pytest
-from game_logic import Game, REGIONS, GRAPE_CHARACTERISTICS, VESSEL_TYPES
+from game_logic import Game, AsyncGame, PlayerContext, create_new_game, encode_cursor, load_player_context, load_simulation, save_simulation, MONTHS, REGIONS, GRAPE_CHARACTERISTICS, VESSEL_TYPES, QUERY_BUDGETS
+from simulation import Simulation, SimVineyard
 from game_models import (
     Player, Vineyard, Winery, Grape, Must, WineInProduction, Wine, GameState, WineryVessel,
-    DBPlayer, DBVineyard, DBWinery, DBGrape, DBMust, DBWineInProduction, DBWine, DBWineryVessel, DBGameState, Base
+    DBPlayer, DBVineyard, DBWinery, DBGrape, DBMust, DBWineInProduction, DBWine, DBWineryVessel, DBGameState, DBRegionData, InventoryQuery, Base
 )
-from database import SessionLocal, engine
+from database import (
+    SessionLocal, AsyncSessionLocal, AsyncReadSessionLocal, async_engine, engine, SQLITE_PRAGMAS, run_sqlite_maintenance,
+    add_missing_columns, migrate_per_player_unique_keys, create_missing_indexes
+)
+from sqlalchemy import create_engine, event, func, select, update
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import Session
 from main import initialize_database
+from event_hub import hub
+from query_stats import QueryStats, assert_max_queries, enforce_query_budgets, track_queries, OUTSIDE_GAME
 
 @pytest.fixture(scope="module")
 def db_session():
@@ -23,6 +33,11 @@ def game_instance(db_session: Session):
     initialize_database(db_session)
     return Game(db_session)
 
+@pytest.fixture(autouse=True)
+def query_budgets():
+    with enforce_query_budgets(QUERY_BUDGETS):
+        yield
+
 def test_game_initialization(game_instance, db_session: Session):
     db_player = db_session.query(DBPlayer).first()
     db_winery = db_session.query(DBWinery).first()
@@ -43,6 +58,24 @@ def test_advance_month_within_year(game_instance, db_session: Session):
     new_month = db_session.query(DBGameState).first().current_month_index
     assert new_month == initial_month + 1
 
+def test_async_advance_month_within_year(game_instance, db_session: Session):
+    db_game_state = db_session.query(DBGameState).first()
+    initial_month = db_game_state.current_month_index
+
+    async def advance():
+        try:
+            async with AsyncSessionLocal() as session:
+                async_game = AsyncGame(session)
+                await async_game.advance_month()
+                return await async_game.get_game_state()
+        finally:
+            await async_engine.dispose()
+
+    game_state = asyncio.run(advance())
+    db_session.refresh(db_game_state)
+    assert game_state.current_month_index == initial_month + 1
+    assert db_game_state.current_month_index == initial_month + 1
+
 def test_advance_month_new_year(game_instance, db_session: Session):
     db_game_state = db_session.query(DBGameState).first()
     db_game_state.current_month_index = 11  # Set to December
@@ -239,3 +272,535 @@ def test_get_available_vessel_types_for_purchase(game_instance):
     assert len(available) > 0
     assert "name" in available[0]
     assert "cost" in available[0]
+
+def count_queries(fn):
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        fn()
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return len(statements)
+
+def test_get_game_state_query_count_is_fixed(game_instance, db_session: Session):
+    def load_game_state():
+        session = SessionLocal()
+        try:
+            Game(session).get_game_state()
+        finally:
+            session.close()
+
+    baseline = count_queries(load_game_state)
+    db_player = db_session.query(DBPlayer).first()
+    db_winery = db_session.query(DBWinery).first()
+    for i in range(5):
+        db_session.add(DBVineyard(name=f"Query Count Block {i}", varietal="Syrah", region="Northern Rhône", player_id=db_player.id))
+        db_session.add(DBGrape(varietal="Syrah", vintage=2025, quantity_kg=100, quality=70, player_id=db_player.id))
+        db_session.add(DBWineInProduction(varietal="Syrah", vintage=2025, quantity_liters=100, quality=70, vessel_type="Concrete Egg", vessel_index=0, stage="fermenting" if i % 2 else "aging", winery_id=db_winery.id))
+    db_session.commit()
+
+    assert count_queries(load_game_state) == baseline
+    assert baseline <= 7
+
+def test_get_game_state_partitions_wines_in_production(game_instance, db_session: Session):
+    game_state = game_instance.get_game_state()
+    winery = game_state.player.winery
+    assert all(w.stage == "fermenting" for w in winery.wines_fermenting)
+    assert all(w.stage == "aging" for w in winery.wines_aging)
+    in_production = db_session.query(DBWineInProduction).filter(DBWineInProduction.winery_id == winery.id).count()
+    assert len(winery.wines_fermenting) + len(winery.wines_aging) == in_production
+
+def snapshot_monthly_state(session: Session):
+    session.expire_all()
+    game_state = session.query(DBGameState).first()
+    vineyards = [(v.id, v.health, v.grapes_ready, v.harvested_this_year) for v in session.query(DBVineyard).order_by(DBVineyard.id)]
+    wines = [(w.id, w.fermentation_progress, w.aging_progress) for w in session.query(DBWineInProduction).order_by(DBWineInProduction.id)]
+    return (game_state.current_year, game_state.current_month_index), vineyards, wines
+
+def restore_monthly_state(session: Session, snapshot):
+    (year, month_index), vineyards, wines = snapshot
+    game_state = session.query(DBGameState).first()
+    game_state.current_year, game_state.current_month_index = year, month_index
+    for vineyard_id, health, grapes_ready, harvested_this_year in vineyards:
+        vineyard = session.get(DBVineyard, vineyard_id)
+        vineyard.health, vineyard.grapes_ready, vineyard.harvested_this_year = health, grapes_ready, harvested_this_year
+    for wine_id, fermentation_progress, aging_progress in wines:
+        wine = session.get(DBWineInProduction, wine_id)
+        wine.fermentation_progress, wine.aging_progress = fermentation_progress, aging_progress
+    session.commit()
+
+@pytest.mark.parametrize("update_returning", [True, False]) # False: SQLite older than 3.35
+@pytest.mark.parametrize("month_index", [7, 11])
+def test_bulk_advance_month_matches_orm_path(game_instance, db_session: Session, month_index, update_returning, monkeypatch):
+    monkeypatch.setattr(engine.dialect, "update_returning", update_returning)
+    db_winery = db_session.query(DBWinery).first()
+    db_session.add(DBWineInProduction(varietal="Syrah", vintage=2025, quantity_liters=100, quality=75, vessel_type="Concrete Egg", vessel_index=0, stage="fermenting", fermentation_progress=90, winery_id=db_winery.id))
+    db_session.add(DBWineInProduction(varietal="Syrah", vintage=2025, quantity_liters=100, quality=75, vessel_type="Concrete Egg", vessel_index=0, stage="aging", aging_progress=2, aging_duration=3, winery_id=db_winery.id))
+    db_session.query(DBGameState).first().current_month_index = month_index
+    db_session.commit()
+    initial = snapshot_monthly_state(db_session)
+
+    results = []
+    events = []
+    for bulk in (False, True):
+        restore_monthly_state(db_session, initial)
+        session = SessionLocal()
+        try:
+            random.seed(1234)
+            month_events = Game(session).advance_month(bulk=bulk)
+        finally:
+            session.close()
+        results.append(snapshot_monthly_state(db_session))
+        events.append(sorted((e.type, e.subject_id) for e in month_events))
+
+    assert results[0] == results[1]
+    assert events[0] == events[1]
+    assert results[1] != initial
+
+def test_bulk_advance_month_statement_count_is_fixed(game_instance, db_session: Session):
+    def advance():
+        session = SessionLocal()
+        try:
+            Game(session).advance_month(bulk=True)
+        finally:
+            session.close()
+
+    baseline = count_queries(advance)
+    db_player = db_session.query(DBPlayer).first()
+    for i in range(20):
+        db_session.add(DBVineyard(name=f"Bulk Block {i}", varietal="Chardonnay", region="Jura", player_id=db_player.id))
+    db_session.commit()
+    # Decay draws may or may not produce an executemany, everything else is one statement per rule
+    assert count_queries(advance) <= baseline + 1
+
+def test_advance_months_to_harvest(game_instance, db_session: Session):
+    db_game_state = db_session.query(DBGameState).first()
+    db_game_state.current_month_index = 0
+    db_vineyard = db_session.query(DBVineyard).filter(DBVineyard.name == "Home Block").first()
+    db_vineyard.grapes_ready = False
+    db_vineyard.harvested_this_year = False
+    db_session.commit()
+
+    result = game_instance.advance_months(8)
+    db_session.refresh(db_game_state)
+
+    assert result is not None
+    assert result.game_state.current_month_index == 8
+    assert db_game_state.current_month_index == 8
+    assert ("grapes_ready", db_vineyard.id) in [(e.type, e.subject_id) for e in result.events]
+    assert all(e.month == "September" for e in result.events if e.type == "grapes_ready")
+
+def test_advance_months_invalid_count(game_instance):
+    assert game_instance.advance_months(0) is None
+
+def settle_production_and_vineyards(db_session: Session):
+    """Puts every pending deadline out of the way except vineyard ripening."""
+    db_session.query(DBGameState).first().current_month_index = 0
+    for vineyard in db_session.query(DBVineyard):
+        vineyard.grapes_ready = False
+        vineyard.harvested_this_year = False
+    for wine_prod in db_session.query(DBWineInProduction):
+        wine_prod.fermentation_progress = 100
+        wine_prod.aging_progress = wine_prod.aging_duration
+    db_session.commit()
+
+def test_advance_until_next_event_jumps_to_ripening(game_instance, db_session: Session):
+    settle_production_and_vineyards(db_session)
+    assert game_instance.next_event_in_months() == 8
+
+    result = game_instance.advance_until_next_event()
+
+    assert result is not None
+    assert result.months_advanced == 8
+    assert result.game_state.current_month_index == 8
+    assert result.events and all(e.type == "grapes_ready" for e in result.events)
+    home_block = db_session.query(DBVineyard).filter(DBVineyard.name == "Home Block").first()
+    db_session.refresh(home_block)
+    assert home_block.grapes_ready
+
+def test_advance_until_next_event_stops_at_fermentation(game_instance, db_session: Session):
+    settle_production_and_vineyards(db_session)
+    db_winery = db_session.query(DBWinery).first()
+    wine_prod = DBWineInProduction(varietal="Syrah", vintage=2025, quantity_liters=100, quality=50, vessel_type="Concrete Egg", vessel_index=0, stage="fermenting", fermentation_progress=0, winery_id=db_winery.id)
+    db_session.add(wine_prod)
+    db_session.commit()
+    # At most 25 + 5 points per month, so 100 can't be reached before the 4th month
+    assert game_instance.next_event_in_months() == 4
+
+    result = game_instance.advance_until_next_event()
+
+    assert result is not None
+    assert 4 <= result.months_advanced <= 7
+    assert [(e.type, e.subject_id) for e in result.events] == [("fermentation_complete", wine_prod.id)]
+    db_session.refresh(wine_prod)
+    assert wine_prod.fermentation_progress == 100
+
+def test_advance_until_next_event_respects_horizon(game_instance, db_session: Session):
+    settle_production_and_vineyards(db_session)
+    result = game_instance.advance_until_next_event(max_months=3)
+    assert result.months_advanced == 3
+    assert result.events == []
+
+def test_month_advances_without_a_save_raise(game_instance, db_session: Session):
+    game = Game(db_session, player_id=-1)
+    for advance in (game.advance_month, lambda: game.advance_month(bulk=True), lambda: game.advance_months(2), game.next_event_in_months, game.advance_until_next_event):
+        with pytest.raises(ValueError, match="Game state not found"):
+            advance()
+
+def test_games_are_isolated_per_player(game_instance, db_session: Session):
+    first_state = db_session.query(DBGameState).first()
+    first_month = first_state.current_month_index
+    second_state = create_new_game(db_session, "Second Winemaker")
+    second_player_id = second_state.player_id
+    second_game = Game(db_session, second_player_id)
+
+    second_game.advance_month()
+    assert second_game.tend_vineyard("Home Block") is True
+
+    db_session.refresh(first_state)
+    db_session.refresh(second_state)
+    assert first_state.current_month_index == first_month
+    assert second_state.current_month_index == 1
+    assert second_game.get_game_state().player.id == second_player_id
+    second_home_block = db_session.query(DBVineyard).filter(DBVineyard.player_id == second_player_id, DBVineyard.name == "Home Block").one()
+    assert second_game.get_game_state().player.money == 100000 - 500
+    assert second_home_block.health > 80
+
+def test_player_context_is_loaded_in_one_query(game_instance, db_session: Session):
+    player_id = db_session.query(DBPlayer.id).filter(DBPlayer.name == "Winemaker").scalar()
+    session = Session(bind=engine, expire_on_commit=False)
+    try:
+        contexts = []
+        assert count_queries(lambda: contexts.append(load_player_context(session, player_id))) == 1
+        context = contexts[0]
+        assert context.player_name == "Winemaker"
+        assert context.game_state.player_id == player_id
+        assert context.winery.player_id == player_id
+        # A second lookup in the same session is served from the identity map
+        assert count_queries(lambda: load_player_context(session, player_id)) == 0
+    finally:
+        session.close()
+
+def test_actions_reuse_player_context(game_instance, db_session: Session):
+    player_id = db_session.query(DBPlayer.id).filter(DBPlayer.name == "Winemaker").scalar()
+    session = Session(bind=engine, expire_on_commit=False)
+    try:
+        context = load_player_context(session, player_id)
+        game = Game(session, context=context)
+        context.player.vineyards
+        context.winery.vessels
+        context.player.money = 1000000
+        session.commit()
+
+        # Beyond the vineyard lookup, only the writes themselves reach the database
+        assert count_queries(lambda: game.tend_vineyard("Home Block")) <= 3
+        assert count_queries(lambda: game.buy_vessel("Stainless Steel Tank")) <= 2
+        assert context.winery.vessels[-1].type == "Stainless Steel Tank"
+    finally:
+        session.close()
+
+def test_region_data_json_columns_round_trip(game_instance, db_session: Session):
+    region = DBRegionData(climate="Cool", soil_types=["Limestone", "Clay"], grape_varietals=["Pinot Noir"], base_cost=40000)
+    db_session.add(region)
+    db_session.commit()
+    db_session.expire_all()
+
+    loaded = db_session.get(DBRegionData, region.id)
+    assert "soil_types" not in loaded.__dict__ # Deferred until accessed
+    assert loaded.soil_types == ["Limestone", "Clay"]
+    assert loaded.grape_varietals == ["Pinot Noir"]
+
+def test_months_are_not_stored_per_game_state(game_instance, db_session: Session):
+    assert "months" not in DBGameState.__table__.c
+    assert game_instance.get_game_state().months == MONTHS
+
+def test_sqlite_profile_is_applied_on_connect(game_instance):
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar().lower() == "wal"
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1 # NORMAL
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == SQLITE_PRAGMAS["busy_timeout"]
+        assert connection.exec_driver_sql("PRAGMA temp_store").scalar() == 2 # MEMORY
+
+    async def async_journal_mode():
+        async with async_engine.connect() as connection:
+            return (await connection.exec_driver_sql("PRAGMA journal_mode")).scalar()
+    assert asyncio.run(async_journal_mode()).lower() == "wal"
+
+def test_sqlite_maintenance_runs(game_instance):
+    with engine.connect() as connection:
+        run_sqlite_maintenance(connection, analyze=True)
+        run_sqlite_maintenance(connection)
+        assert connection.exec_driver_sql("SELECT count(*) FROM sqlite_master WHERE name = 'sqlite_stat1'").scalar() == 1
+
+def test_existing_database_is_migrated_to_per_player_unique_keys(game_instance, tmp_path):
+    old_engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with old_engine.begin() as connection: # The schema as it was when vineyard names were unique globally
+        connection.exec_driver_sql("CREATE TABLE vineyards (id INTEGER PRIMARY KEY, name VARCHAR, player_id INTEGER)")
+        connection.exec_driver_sql("CREATE UNIQUE INDEX ix_vineyards_name ON vineyards (name)")
+        connection.exec_driver_sql("CREATE TABLE game_state (id INTEGER PRIMARY KEY, player_id INTEGER)")
+        connection.exec_driver_sql("INSERT INTO vineyards (id, name, player_id) VALUES (1, 'Home Block', 1), (2, 'Home Block (1)', 2)")
+        connection.exec_driver_sql("INSERT INTO game_state (id, player_id) VALUES (1, 1), (2, 1), (3, 2)")
+
+    Base.metadata.create_all(bind=old_engine)
+    add_missing_columns(old_engine, Base.metadata)
+    migrate_per_player_unique_keys(old_engine)
+    create_missing_indexes(old_engine, Base.metadata)
+    migrate_per_player_unique_keys(old_engine) # Nothing left to do on a migrated database
+
+    with old_engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO vineyards (name, player_id) VALUES ('Home Block', 2)")
+        assert connection.exec_driver_sql("SELECT id FROM game_state ORDER BY id").scalars().all() == [1, 3]
+    with pytest.raises(IntegrityError), old_engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO vineyards (name, player_id) VALUES ('Home Block', 1)")
+    with pytest.raises(IntegrityError), old_engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO game_state (player_id) VALUES (2)")
+    old_engine.dispose()
+
+def test_read_only_session_reads_but_refuses_writes(game_instance, db_session: Session):
+    player_count = db_session.query(DBPlayer).count()
+
+    async def read_then_write():
+        async with AsyncReadSessionLocal() as session:
+            count = (await session.execute(select(func.count(DBPlayer.id)))).scalar()
+            with pytest.raises(OperationalError):
+                await session.execute(update(DBPlayer).values(money=0))
+            return count
+    assert asyncio.run(read_then_write()) == player_count
+
+def test_mutating_methods_bump_state_version(game_instance, db_session: Session):
+    db_player = db_session.query(DBPlayer).filter(DBPlayer.name == "Winemaker").one()
+    db_player.money = 1000000
+    db_session.commit()
+
+    def version():
+        db_session.refresh(db_player)
+        return db_player.state_version
+
+    before = version()
+    game_instance.advance_month()
+    assert version() == before + 1
+    game_instance.advance_month(bulk=True)
+    assert version() == before + 2
+    game_instance.buy_vessel("Stainless Steel Tank")
+    assert version() == before + 3
+    # Failed actions don't change the state, so they don't bump the version
+    assert game_instance.tend_vineyard("No Such Vineyard") is False
+    assert version() == before + 3
+
+def test_state_delta_tracks_changes_and_deletions(game_instance, db_session: Session):
+    db_game_state = create_new_game(db_session, "Delta Winemaker")
+    game = Game(db_session, db_game_state.player_id)
+    home_block = db_session.query(DBVineyard).filter(DBVineyard.player_id == db_game_state.player_id).one()
+    home_block.grapes_ready = True
+    db_session.commit()
+
+    assert game.get_state_delta(0).vineyards == []
+    grapes = game.harvest_grapes("Home Block")
+    harvested_version = game.get_state_delta(0).state_version
+    delta = game.get_state_delta(0)
+    assert [g.id for g in delta.grapes] == [grapes.id]
+    assert [v.name for v in delta.vineyards] == ["Home Block"]
+
+    must = game.process_grapes(0, "no", "Destemmed/Crushed")
+    delta = game.get_state_delta(harvested_version)
+    assert delta.state_version == harvested_version + 1
+    assert [m.id for m in delta.musts] == [must.id]
+    assert delta.grapes == [] and delta.vineyards == []
+    assert [(d.entity_type, d.id) for d in delta.deleted] == [("grapes", grapes.id)]
+
+    # The bulk path stamps the rows it updates too
+    db_game_state.current_month_index = 11
+    db_session.commit()
+    game.advance_month(bulk=True)
+    delta = game.get_state_delta(harvested_version + 1)
+    assert [v.name for v in delta.vineyards] == ["Home Block"]
+    assert delta.current_month_index == 0
+
+def test_state_delta_falls_back_to_full_resync(game_instance):
+    state_version = game_instance.get_state_delta(0).state_version
+    delta = game_instance.get_state_delta(state_version + 5)
+    assert delta.full_resync is True
+    assert delta.game_state.player.state_version == state_version
+
+def test_committed_changes_are_published(game_instance, db_session: Session):
+    player_id = db_session.query(DBPlayer.id).filter(DBPlayer.name == "Winemaker").scalar()
+
+    async def advance_and_collect():
+        queue = hub.subscribe(player_id)
+        try:
+            game_instance.advance_month()
+            assert game_instance.tend_vineyard("No Such Vineyard") is False
+            return [queue.get_nowait() for _ in range(queue.qsize())]
+        finally:
+            hub.unsubscribe(player_id, queue)
+
+    messages = asyncio.run(advance_and_collect())
+    # Only the committed advance is published, not the failed action
+    assert [m["type"] for m in messages][:1] == ["state_changed"]
+    assert sum(m["type"] == "state_changed" for m in messages) == 1
+
+def test_bottled_wines_keyset_pagination(game_instance, db_session: Session):
+    db_game_state = create_new_game(db_session, "Cellar Winemaker")
+    player_id = db_game_state.player_id
+    for i in range(7):
+        db_session.add(DBWine(name=f"Cuvée {i}", vintage=2020 + i % 2, varietal="Syrah" if i % 3 else "Viognier", style="Red", quality=60 + i % 4, bottles=100, player_id=player_id))
+    db_session.commit()
+    game = Game(db_session, player_id)
+
+    def all_pages(**params):
+        names, cursor = [], None
+        while True:
+            page, cursor = game.list_bottled_wines(InventoryQuery(limit=2, cursor=cursor, **params))
+            names.extend(w.name for w in page)
+            if cursor is None:
+                return names
+
+    by_quality = sorted(db_session.query(DBWine).filter(DBWine.player_id == player_id), key=lambda w: (-w.quality, -w.id))
+    assert all_pages(sort="-quality") == [w.name for w in by_quality]
+    assert all_pages() == [f"Cuvée {i}" for i in range(7)]
+    assert all_pages(varietal="Syrah", min_quality=62) == [w.name for w in sorted(by_quality, key=lambda w: w.id) if w.varietal == "Syrah" and w.quality >= 62]
+    assert all_pages(vintage=2021, sort="vintage") == ["Cuvée 1", "Cuvée 3", "Cuvée 5"]
+
+    assert game.list_bottled_wines(InventoryQuery(sort="bottles")) is None
+    assert game.list_bottled_wines(InventoryQuery(cursor="not-a-cursor")) is None
+
+def test_keyset_pagination_rejects_null_sort_values(game_instance, db_session: Session):
+    for sort in ("quality", "-vintage"):
+        assert game_instance.list_bottled_wines(InventoryQuery(sort=sort, cursor=encode_cursor([None, 1]))) is None
+    db_player = db_session.query(DBPlayer).first()
+    db_session.add(DBWine(name="Unrated", vintage=2024, varietal="Syrah", style="Red", quality=None, bottles=10, player_id=db_player.id))
+    with pytest.raises(IntegrityError):
+        db_session.flush() # A NULL sort value could never be paged past
+    db_session.rollback()
+
+def test_queries_are_attributed_to_game_methods(game_instance, db_session: Session):
+    with track_queries() as stats:
+        db_session.query(DBPlayer.id).first()
+        game_instance.get_game_state()
+    breakdown = stats.by_game_method()
+    assert breakdown[OUTSIDE_GAME][0] == 1
+    assert breakdown["get_game_state"][0] == stats.queries - 1
+    assert "get_game_state=" in stats.report()
+
+def test_assert_max_queries_lists_the_statements(game_instance, db_session: Session):
+    with assert_max_queries(1) as stats:
+        db_session.query(DBPlayer.id).first()
+    assert stats.queries == 1
+
+    with pytest.raises(AssertionError, match="Expected at most 0 queries") as excinfo:
+        with assert_max_queries(0):
+            db_session.query(DBPlayer.id).first()
+    assert "SELECT players.id" in str(excinfo.value)
+
+def test_query_budget_fails_a_game_method_that_exceeds_it(game_instance):
+    with enforce_query_budgets({"get_game_state": 1}):
+        with pytest.raises(AssertionError, match="Game.get_game_state exceeded its budget of 1 queries"):
+            game_instance.get_game_state()
+
+def test_advance_month_stays_within_budget_for_a_large_estate(game_instance, db_session: Session):
+    db_player = db_session.query(DBPlayer).first()
+    db_winery = db_session.query(DBWinery).first()
+    for i in range(20):
+        db_session.add(DBVineyard(name=f"Budget Block {i}", varietal="Syrah", region="Northern Rhône", player_id=db_player.id))
+        db_session.add(DBGrape(varietal="Syrah", vintage=2025, quantity_kg=100, quality=70, player_id=db_player.id))
+        db_session.add(DBWineInProduction(varietal="Syrah", vintage=2025, quantity_liters=100, quality=70, vessel_type="Concrete Egg", vessel_index=0, stage="fermenting" if i % 2 else "aging", winery_id=db_winery.id))
+    db_session.commit()
+
+    session = SessionLocal()
+    try:
+        # The autouse fixture enforces QUERY_BUDGETS["advance_month"] here
+        Game(session).advance_month()
+        Game(session).get_game_state()
+    finally:
+        session.close()
+
+def play_a_vintage(game):
+    """The same sequence of actions for a Game and a Simulation: from harvest to bottling."""
+    game.advance_months(8) # Pinot Noir ripens in September
+    game.harvest_grapes("Home Block")
+    game.buy_vineyard({"region": "Jura", "varietal": "Savagnin", "cost": 40000}, "Sim Block")
+    game.tend_vineyard("Sim Block")
+    game.process_grapes(0, "yes", "Whole Cluster")
+    game.buy_vessel("Stainless Steel Tank")
+    game.start_fermentation(0, 0)
+    game.perform_maceration_action(0, "Punch Down")
+    game.advance_until_next_event(12)
+    game.advance_months(6)
+    game.start_aging(0, 5, 2)
+    game.advance_months(2)
+    game.bottle_wine(0, "Sim Cuvée")
+    game.advance_months(6)
+
+def comparable_state(game_state: GameState) -> dict:
+    # Ids of rows created along the way and the state version are assigned by the database
+    state = game_state.model_dump(exclude={"id"})
+    state["player"].pop("id")
+    state["player"].pop("state_version")
+    for key in ("vineyards", "grapes_inventory", "bottled_wines"):
+        for entity in state["player"][key]:
+            entity.pop("id")
+    for key in ("vessels", "must_in_production", "wines_fermenting", "wines_aging"):
+        for entity in state["player"]["winery"][key]:
+            entity.pop("id")
+    state["player"]["winery"].pop("id")
+    return state
+
+def test_simulation_follows_the_same_rules_as_game(db_session: Session):
+    create_new_game(db_session, "Simulated Winemaker")
+    player_id = db_session.query(DBPlayer.id).filter(DBPlayer.name == "Simulated Winemaker").scalar()
+    session = SessionLocal()
+    try:
+        simulation = load_simulation(session, player_id)
+        random.seed(2024)
+        play_a_vintage(Game(session, player_id))
+        game_state = Game(session, player_id).get_game_state()
+        random.seed(2024)
+        play_a_vintage(simulation)
+    finally:
+        session.close()
+
+    assert game_state.player.bottled_wines[0].name == "Sim Cuvée" # The sequence got all the way through
+    assert comparable_state(GameState.model_validate(simulation.state)) == comparable_state(game_state)
+
+def test_save_simulation_writes_one_state_version(db_session: Session):
+    create_new_game(db_session, "Saved Winemaker")
+    player_id = db_session.query(DBPlayer.id).filter(DBPlayer.name == "Saved Winemaker").scalar()
+    session = SessionLocal()
+    try:
+        simulation = load_simulation(session, player_id)
+        version = simulation.player.state_version
+        home_block_id = simulation.player.vineyards[0].id
+        untouched_vessel_version = session.get(DBWineryVessel, simulation.winery.vessels[0].id).version
+
+        simulation.advance_months(8)
+        grapes = simulation.harvest_grapes("Home Block")
+        assert grapes.id is None
+        assert save_simulation(session, simulation) is True
+        assert simulation.player.state_version == version + 1
+        assert grapes.id is not None
+
+        must = simulation.process_grapes(0, "no", "Destemmed/Crushed") # Drops the lot it was made from
+        simulation.player.vineyards.append(SimVineyard(name="Planted Block", varietal="Syrah", region="Northern Rhône"))
+        assert save_simulation(session, simulation) is True
+        assert simulation.player.state_version == version + 2
+        assert must.id is not None and simulation.player.vineyards[1].id is not None
+        assert not hasattr(must, "__dict__") # Entities are slotted
+
+        session.expire_all()
+        reloaded = Game(session, player_id).get_game_state()
+        assert comparable_state(reloaded) == comparable_state(GameState.model_validate(simulation.state))
+        assert reloaded.player.grapes_inventory == []
+        assert [m.id for m in reloaded.player.winery.must_in_production] == [must.id]
+        # Only what changed was written and stamped with the version of the save that changed it
+        assert session.get(DBVineyard, home_block_id).version == version + 1
+        assert session.get(DBWineryVessel, simulation.winery.vessels[0].id).version == untouched_vessel_version
+        delta = Game(session, player_id).get_state_delta(version + 1)
+        assert [(d.entity_type, d.id) for d in delta.deleted] == [("grapes", grapes.id)]
+
+        # Saving again without changes doesn't create a version
+        assert save_simulation(session, simulation) is True
+        assert session.get(DBPlayer, player_id).state_version == version + 2
+    finally:
+        session.close()
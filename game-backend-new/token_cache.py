@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from sqlalchemy import event, inspect
+
+from game_models import DBPlayer
+
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+# Upper bound on how long a verified token is trusted without re-checking, even if `exp` is later
+TOKEN_CACHE_TTL_SECONDS = int(os.getenv("TOKEN_CACHE_TTL_SECONDS", 300))
+
+class TokenCache:
+    """Bounded LRU of verified JWTs, mapping each token to the player id it resolved to.
+
+    Entries expire at the token's own `exp` or after the TTL, whichever comes first, and are dropped
+    when their player is renamed or deleted (see the mapper listeners below).
+    """
+    def __init__(self, max_size: int = TOKEN_CACHE_SIZE, ttl_seconds: int = TOKEN_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[int]:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            player_id, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return player_id
+
+    def put(self, token: str, player_id: int, exp: Optional[float]):
+        expires_at = time.time() + self.ttl_seconds
+        if exp is not None:
+            expires_at = min(expires_at, exp)
+        with self._lock:
+            self._entries[token] = (player_id, expires_at)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_player(self, player_id: int):
+        with self._lock:
+            for token in [token for token, (cached_id, _) in self._entries.items() if cached_id == player_id]:
+                del self._entries[token]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+token_cache = TokenCache()
+
+# Tokens name their player by `sub`, so a rename or delete must stop old tokens resolving to the row
+@event.listens_for(DBPlayer, "after_update")
+def invalidate_renamed_player(mapper, connection, target):
+    if inspect(target).attrs.name.history.has_changes():
+        token_cache.invalidate_player(target.id)
+
+@event.listens_for(DBPlayer, "after_delete")
+def invalidate_deleted_player(mapper, connection, target):
+    token_cache.invalidate_player(target.id)
@@ -0,0 +1,464 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import suppress
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from database import AsyncSessionLocal
+from game_data import DEFAULT_EVENT_HORIZON_MONTHS
+from game_logic import Game, PlayerContext, load_simulation, save_simulation
+from game_models import AdvanceMonthsResult, GameState, Grape, Must, Vineyard, Wine, WineInProduction, WineryVessel, DBPlayer
+from metrics import WRITE_BEHIND_ACTIONS_PER_CHECKPOINT, WRITE_BEHIND_CACHED_PLAYERS
+from player_locks import player_locks
+from simulation import Simulation, SimGameState, entity_from_dict, entity_to_dict
+
+logger = logging.getLogger(__name__)
+
+# Write-behind persistence, off by default. While a player is active their state is held in memory
+# and their actions run on the in-memory simulation (simulation.py) instead of committing one by one.
+# A player's changes are checkpointed to the database in a single transaction once they pause for
+# WRITE_BEHIND_IDLE_SECONDS, at the latest WRITE_BEHIND_FLUSH_INTERVAL_SECONDS after the oldest
+# unsaved change, and on shutdown. Every action is also recorded in a journal that is replayed at
+# startup. The flush loop writes and fsyncs it, so a crash loses at most the actions of the last
+# flush-loop period (about a second with the defaults).
+# Only one worker process may serve players in this mode, since the memory is the source of truth.
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "0") == "1"
+WRITE_BEHIND_FLUSH_INTERVAL_SECONDS = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL_SECONDS", 10))
+WRITE_BEHIND_IDLE_SECONDS = float(os.getenv("WRITE_BEHIND_IDLE_SECONDS", 2))
+# Players with more unsaved actions than this are checkpointed right away
+WRITE_BEHIND_MAX_PENDING_ACTIONS = int(os.getenv("WRITE_BEHIND_MAX_PENDING_ACTIONS", 100))
+# Clean players without requests for this long are dropped from memory
+WRITE_BEHIND_EVICT_SECONDS = float(os.getenv("WRITE_BEHIND_EVICT_SECONDS", 600))
+WRITE_BEHIND_JOURNAL_PATH = os.getenv("WRITE_BEHIND_JOURNAL_PATH", "./data/write_behind.journal")
+
+class Journal:
+    """Append-only log of the actions of players with unsaved changes.
+
+    Each line is a JSON command: the Simulation method, its arguments and the seed its random draws
+    came from, plus the state_version of the checkpoint it builds on and the player's generation after
+    it. Replaying a player's commands on that save reproduces their in-memory state. Records are
+    buffered in memory and written by the flush loop in a worker thread, so the event loop never
+    serializes or writes more than the command itself; checkpoints rewrite the file with the records
+    of the players still unsaved.
+    """
+    def __init__(self, path: str = WRITE_BEHIND_JOURNAL_PATH):
+        self.path = path
+        self._file = None
+        self._buffer: List[str] = []
+        self._lock = threading.Lock() # The file is only touched from worker threads, one at a time
+
+    @staticmethod
+    def record(player_id: int, state_version: int, generation: int, seed: int, method_name: str, args: tuple) -> str:
+        return json.dumps({
+            "player_id": player_id, "state_version": state_version, "generation": generation,
+            "seed": seed, "method": method_name, "args": args,
+        }, separators=(",", ":")) + "\n"
+
+    def append(self, line: str):
+        self._buffer.append(line)
+
+    def take_buffer(self) -> List[str]:
+        lines, self._buffer = self._buffer, []
+        return lines
+
+    def requeue(self, lines: List[str]):
+        """Puts lines that failed to be written back in front of the buffer."""
+        self._buffer[:0] = lines
+
+    def write(self, lines: List[str]):
+        """Appends `lines` and fsyncs them. Blocking; runs in a worker thread."""
+        if not lines:
+            return
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.writelines(lines)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def rewrite(self, lines: List[str]):
+        """Replaces the journal with `lines`, e.g. the records of the players still unsaved. Blocking."""
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            temporary_path = f"{self.path}.tmp"
+            with open(temporary_path, "w", encoding="utf-8") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self._close_file()
+            os.replace(temporary_path, self.path)
+
+    def read(self) -> List[Dict[str, Any]]:
+        """All records, in the order they were written. A torn line left by a crash mid-write is skipped."""
+        records: List[Dict[str, Any]] = []
+        try:
+            f = open(self.path, encoding="utf-8")
+        except FileNotFoundError:
+            return records
+        with f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping unreadable line {line_number} of journal {self.path}.")
+        return records
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        with self._lock:
+            self._close_file()
+
+    def remove(self):
+        self.close()
+        self._buffer.clear()
+        for path in (self.path, f"{self.path}.tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+
+def recover_journal(db: Session, path: str = WRITE_BEHIND_JOURNAL_PATH) -> int:
+    """Saves what a crashed process journaled but never checkpointed. Runs at startup, before serving.
+
+    A player's commands are replayed on their save and only apply if it's still at the version they
+    build on; otherwise a later checkpoint already contains them. Returns the number of players recovered.
+    """
+    journal = Journal(path)
+    records: Dict[int, List[Dict[str, Any]]] = {}
+    for record in journal.read():
+        records.setdefault(record["player_id"], []).append(record)
+    recovered = 0
+    for player_id, commands in records.items():
+        simulation = load_simulation(db, player_id)
+        if simulation is None or not replay_commands(simulation, commands):
+            logger.info(f"Skipping journaled actions of player {player_id}: already checkpointed or the save is gone.")
+            continue
+        if save_simulation(db, simulation):
+            recovered += 1
+    if records:
+        logger.warning(f"Recovered unsaved changes of {recovered} player(s) from journal {path}.")
+    journal.remove()
+    return recovered
+
+def _advance_months(simulation: Simulation, months: int) -> Optional[AdvanceMonthsResult]:
+    events = simulation.advance_months(months)
+    if events is None:
+        return None
+    return AdvanceMonthsResult(game_state=GameState.model_validate(simulation.state), events=events, months_advanced=months)
+
+def _advance_until_next_event(simulation: Simulation, max_months: int = DEFAULT_EVENT_HORIZON_MONTHS) -> Optional[AdvanceMonthsResult]:
+    result = simulation.advance_until_next_event(max_months)
+    if result is None:
+        return None
+    events, months_advanced = result
+    return AdvanceMonthsResult(game_state=GameState.model_validate(simulation.state), events=events, months_advanced=months_advanced)
+
+def _returning(model, method_name: str) -> Callable:
+    def run(simulation: Simulation, *args):
+        entity = getattr(simulation, method_name)(*args)
+        return model.model_validate(entity) if entity is not None else None
+    return run
+
+# Game methods served by the simulation, returning what the Game method would
+SIMULATED_METHODS: Dict[str, Callable] = {
+    "get_game_state": lambda simulation: GameState.model_validate(simulation.state),
+    "next_event_in_months": lambda simulation: simulation.next_event_in_months(),
+    "advance_month": lambda simulation, bulk=False: simulation.advance_month(), # `bulk` only changes Game's SQL
+    "advance_months": _advance_months,
+    "advance_until_next_event": _advance_until_next_event,
+    "buy_vineyard": _returning(Vineyard, "buy_vineyard"),
+    "tend_vineyard": lambda simulation, vineyard_name: simulation.tend_vineyard(vineyard_name),
+    "harvest_grapes": _returning(Grape, "harvest_grapes"),
+    "buy_vessel": _returning(WineryVessel, "buy_vessel"),
+    "process_grapes": _returning(Must, "process_grapes"),
+    "start_fermentation": _returning(WineInProduction, "start_fermentation"),
+    "perform_maceration_action": lambda simulation, *args: simulation.perform_maceration_action(*args),
+    "start_aging": _returning(WineInProduction, "start_aging"),
+    "bottle_wine": _returning(Wine, "bottle_wine"),
+}
+SIMULATED_READS = ("get_game_state", "next_event_in_months")
+
+def run_journaled_command(simulation: Simulation, seed: int, method_name: str, *args):
+    """Runs a simulated action with its random draws taken from `seed`, so the journal can replay it."""
+    simulation.rng = random.Random(seed)
+    try:
+        return SIMULATED_METHODS[method_name](simulation, *args)
+    finally:
+        simulation.rng = random
+
+def replay_commands(simulation: Simulation, commands: List[Dict[str, Any]]) -> int:
+    """Replays the journaled commands that build on the simulation's state_version; returns how many."""
+    generation = 0
+    replayed = 0
+    for command in commands:
+        # A record written twice (around a journal rewrite) is replayed once
+        if command["state_version"] != simulation.player.state_version or command["generation"] <= generation:
+            continue
+        run_journaled_command(simulation, command["seed"], command["method"], *command["args"])
+        generation = command["generation"]
+        replayed += 1
+    return replayed
+
+class CachedPlayer:
+    __slots__ = ("simulation", "checkpoint", "generation", "saved_generation", "dirty_since", "last_used", "journal")
+
+    def __init__(self, simulation: Simulation):
+        self.simulation = simulation
+        self.checkpoint = entity_to_dict(simulation.state) # The state as saved, to rebuild from
+        self.generation = 0 # Bumped by every action that changes the state
+        self.saved_generation = 0
+        self.dirty_since: Optional[float] = None # When the oldest unsaved change was made
+        self.last_used = time.monotonic()
+        self.journal: List[str] = [] # Journal records since the last checkpoint
+
+    @property
+    def dirty(self) -> bool:
+        return self.generation != self.saved_generation
+
+class CachedPlayerContext(PlayerContext):
+    """A `PlayerContext` over a player's in-memory state.
+
+    The simulation entities carry the attributes of the DB models, so handlers read them the same
+    way; `AsyncGame` hands its calls to `run` instead of opening a Game on the session.
+    """
+    cached = True
+
+    def __init__(self, cache: "WriteBehindCache", entry: CachedPlayer, locked: bool):
+        self.cache = cache
+        self.entry = entry
+        self.locked = locked # Whether the request holds the player's lock, i.e. may change the state
+        self.db = None
+        self.player = entry.simulation.player
+        self.player_id = self.player.id
+        self.player_name = self.player.name
+        # The ETag has to change with every action, not only with every checkpoint
+        self.state_version = f"{self.player.state_version}.{entry.generation}"
+
+    @property
+    def game_state(self) -> SimGameState:
+        return self.entry.simulation.state
+
+    async def run(self, db: AsyncSession, method_name: str, *args):
+        return await self.cache.run(self, db, method_name, *args)
+
+class WriteBehindCache:
+    """The in-memory players of write-behind mode, their journal and checkpoints.
+
+    A player's simulation is only changed or saved while holding their lock in `player_locks`, so a
+    checkpoint never sees half an action.
+    """
+    def __init__(self, session_factory: Callable[[], AsyncSession] = AsyncSessionLocal, journal_path: str = WRITE_BEHIND_JOURNAL_PATH):
+        self.session_factory = session_factory
+        self.journal = Journal(journal_path)
+        self._players: Dict[int, CachedPlayer] = {}
+        self._task: Optional[asyncio.Task] = None
+        # Journal writes run in worker threads; this keeps them in the order their records were taken
+        self._journal_lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._players)
+
+    def __contains__(self, player_id: int):
+        return player_id in self._players
+
+    def cached_context(self, player_id: int) -> Optional[CachedPlayerContext]:
+        """For read-only requests: the player's in-memory state, if they're held in memory."""
+        entry = self._players.get(player_id)
+        if entry is None:
+            return None
+        entry.last_used = time.monotonic()
+        return CachedPlayerContext(self, entry, locked=False)
+
+    async def context(self, player_id: int) -> Optional[CachedPlayerContext]:
+        """For requests holding the player's lock: loads the player into memory if they aren't yet."""
+        entry = self._players.get(player_id)
+        if entry is None:
+            async with self.session_factory() as session:
+                simulation = await session.run_sync(lambda sync_session: load_simulation(sync_session, player_id))
+            if simulation is None:
+                return None
+            entry = self._players[player_id] = CachedPlayer(simulation)
+            WRITE_BEHIND_CACHED_PLAYERS.set(len(self._players))
+        entry.last_used = time.monotonic()
+        return CachedPlayerContext(self, entry, locked=True)
+
+    async def run(self, context: CachedPlayerContext, db: AsyncSession, method_name: str, *args):
+        method = SIMULATED_METHODS.get(method_name)
+        if method is None:
+            return await self._run_on_database(context, db, method_name, *args)
+        entry = context.entry
+        if method_name in SIMULATED_READS:
+            return method(entry.simulation, *args)
+        seed = random.getrandbits(32)
+        try:
+            result = run_journaled_command(entry.simulation, seed, method_name, *args)
+        except Exception:
+            self._rebuild(entry)
+            raise
+        if result is not None and result is not False:
+            self._changed(context.player_id, entry, seed, method_name, args)
+            if entry.generation - entry.saved_generation >= WRITE_BEHIND_MAX_PENDING_ACTIONS:
+                await self._checkpoint(context.player_id, entry)
+        return result
+
+    def _changed(self, player_id: int, entry: CachedPlayer, seed: int, method_name: str, args: tuple):
+        entry.generation += 1
+        if entry.dirty_since is None:
+            entry.dirty_since = time.monotonic()
+        record = Journal.record(player_id, entry.simulation.player.state_version, entry.generation, seed, method_name, args)
+        entry.journal.append(record)
+        self.journal.append(record)
+
+    def _rebuild(self, entry: CachedPlayer):
+        """Throws away a half-applied action: the state of the last checkpoint with the journaled
+        actions since replayed on it. Cheaper than copying the state before every action just in case."""
+        simulation = Simulation(entity_from_dict(SimGameState, entry.checkpoint))
+        replay_commands(simulation, [json.loads(line) for line in entry.journal])
+        entry.simulation = simulation
+
+    async def _run_on_database(self, context: CachedPlayerContext, db: AsyncSession, method_name: str, *args):
+        """Game methods that need SQL (deltas, paged inventories, action batches) run on the database
+        once the player's unsaved changes are checkpointed."""
+        player_id = context.player_id
+        if context.locked:
+            saved = await self._checkpoint(player_id, context.entry)
+        else:
+            async with player_locks.hold(player_id):
+                saved = await self._checkpoint(player_id, context.entry)
+        if not saved:
+            raise RuntimeError(f"Could not checkpoint player {player_id} before Game.{method_name}.")
+
+        def run_game_method(session: Session):
+            session.expire_all() # Rows loaded before the checkpoint, e.g. by auth, are stale
+            return getattr(Game(session, player_id), method_name)(*args)
+
+        result = await db.run_sync(run_game_method)
+        if context.locked:
+            # Game may have changed the save behind the simulation's back; the next request reloads it
+            self._drop(player_id)
+        return result
+
+    def _drop(self, player_id: int):
+        self._players.pop(player_id, None)
+        WRITE_BEHIND_CACHED_PLAYERS.set(len(self._players))
+
+    async def _checkpoint(self, player_id: int, entry: CachedPlayer, compact: bool = True) -> bool:
+        """Saves the player's unsaved changes as one state version and drops their records from the
+        journal, unless `compact` is False because the caller compacts once for several players.
+        The caller holds the player's lock."""
+        if not entry.dirty or self._players.get(player_id) is not entry:
+            return True
+        actions = entry.generation - entry.saved_generation
+        try:
+            async with self.session_factory() as session:
+                saved = await session.run_sync(lambda sync_session: save_simulation(sync_session, entry.simulation))
+        except SQLAlchemyError as e:
+            logger.error(f"Failed to checkpoint player {player_id}, keeping {actions} actions in memory: {e}")
+            return False
+        if not saved:
+            logger.warning(f"Dropping the in-memory state of player {player_id}: their save no longer exists.")
+            self._drop(player_id)
+            if compact:
+                await self._compact_journal()
+            return True
+        entry.saved_generation = entry.generation
+        entry.dirty_since = None
+        entry.journal.clear()
+        entry.checkpoint = entity_to_dict(entry.simulation.state)
+        WRITE_BEHIND_ACTIONS_PER_CHECKPOINT.observe(actions)
+        logger.debug(f"Checkpointed {actions} actions of player {player_id} as state version {entry.simulation.player.state_version}.")
+        if compact:
+            await self._compact_journal()
+        return True
+
+    async def flush(self, force: bool = False) -> int:
+        """Checkpoints the players that went idle or whose oldest unsaved change is due (every dirty
+        player if `force`), and drops clean players idle for WRITE_BEHIND_EVICT_SECONDS.
+
+        Returns the number of players checkpointed.
+        """
+        checkpointed = 0
+        for player_id, entry in list(self._players.items()):
+            now = time.monotonic()
+            if entry.dirty:
+                due = force or now - entry.last_used >= WRITE_BEHIND_IDLE_SECONDS or now - entry.dirty_since >= WRITE_BEHIND_FLUSH_INTERVAL_SECONDS
+                if due:
+                    async with player_locks.hold(player_id):
+                        if entry.dirty and await self._checkpoint(player_id, entry, compact=False):
+                            checkpointed += 1
+            elif now - entry.last_used >= WRITE_BEHIND_EVICT_SECONDS:
+                async with player_locks.hold(player_id):
+                    if not entry.dirty and self._players.get(player_id) is entry: # A request may have come in meanwhile
+                        self._drop(player_id)
+        if checkpointed:
+            # One rewrite for all the players just saved
+            await self._compact_journal()
+        else:
+            await self._write_journal()
+        return checkpointed
+
+    async def _write_journal(self):
+        async with self._journal_lock:
+            lines = self.journal.take_buffer()
+            try:
+                await asyncio.to_thread(self.journal.write, lines)
+            except OSError as e:
+                # Still checkpointed with the other changes; only crash recovery waits for the next attempt
+                self.journal.requeue(lines)
+                logger.error(f"Failed to write {len(lines)} journal records: {e}")
+
+    async def _compact_journal(self):
+        """Rewrites the journal with the records of the players still unsaved."""
+        async with self._journal_lock:
+            # Taken together, with no await in between: the buffered lines are all among the kept records
+            lines = [line for entry in self._players.values() for line in entry.journal]
+            buffered = self.journal.take_buffer()
+            try:
+                await asyncio.to_thread(self.journal.rewrite, lines)
+            except OSError as e:
+                self.journal.requeue(buffered)
+                logger.error(f"Failed to rewrite the journal: {e}")
+
+    async def _flush_loop(self):
+        # Checking twice per period keeps checkpoints within half a period of being due
+        interval = min(WRITE_BEHIND_FLUSH_INTERVAL_SECONDS, WRITE_BEHIND_IDLE_SECONDS) / 2
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Write-behind flush failed: {e}")
+
+    def start(self):
+        """Starts the flush loop; called from the app lifespan."""
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Stops the flush loop and checkpoints everyone; called from the app lifespan on shutdown."""
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush(force=True)
+        unsaved = [player_id for player_id, entry in self._players.items() if entry.dirty]
+        if unsaved:
+            self.journal.close()
+            logger.error(f"Players {unsaved} could not be checkpointed; their changes stay in the journal for the next start.")
+        else:
+            self.journal.remove()
+        self._players.clear()
+        WRITE_BEHIND_CACHED_PLAYERS.set(0)
+
+write_behind_cache = WriteBehindCache()
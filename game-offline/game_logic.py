@@ -4,6 +4,7 @@ from sqlalchemy.orm import Session
 from game_models import (
     GrapeCharacteristics, RegionData, VesselTypeData,
     Grape, Must, WineInProduction, Wine, Vineyard, WineryVessel, Winery, Player, GameState,
+    GameEvent, AdvanceMonthsResult,
     DBGrapeCharacteristics, DBRegionData, DBVesselTypeData,
     DBGrape, DBMust, DBWineInProduction, DBWine, DBVineyard, DBWineryVessel, DBWinery, DBPlayer, DBGameState
 )
@@ -45,6 +46,9 @@ GRAPE_CHARACTERISTICS = {
     "Viognier": {"color": "white", "ripening_month": 9, "base_quality": 70},
 }
 
+# Upper bound for a single fast-forward request
+MAX_ADVANCE_MONTHS = 120
+
 VESSEL_TYPES = {
     "Stainless Steel Tank": {"capacity": 5000, "cost": 10000, "type": "fermentation/aging"},
     "Open Top Fermenter": {"capacity": 1000, "cost": 2000, "type": "fermentation"},
@@ -65,10 +69,18 @@ class Game:
             raise Exception("Game state not found. This should not happen after initialization.")
         return GameState.model_validate(db_game_state)
 
-    def advance_month(self):
-        db_game_state = self.db.query(DBGameState).first()
-        db_player = self.db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
-
+    def _event(self, event_type: str, db_game_state: DBGameState, subject: str, subject_id: Optional[int]) -> GameEvent:
+        return GameEvent(
+            type=event_type,
+            year=db_game_state.current_year,
+            month=db_game_state.months[db_game_state.current_month_index],
+            subject=subject,
+            subject_id=subject_id,
+        )
+
+    def _tick(self, db_game_state: DBGameState, db_player: DBPlayer) -> List[GameEvent]:
+        """Applies one month of rules to the loaded aggregate, in memory. The caller commits."""
+        events = []
         db_game_state.current_month_index += 1
         if db_game_state.current_month_index >= len(db_game_state.months):
             db_game_state.current_month_index = 0
@@ -90,11 +102,13 @@ class Game:
             # Check for grape ripening
             ripening_month = GRAPE_CHARACTERISTICS[vineyard.varietal]["ripening_month"]
             if current_month_num == ripening_month and not vineyard.harvested_this_year:
+                if not vineyard.grapes_ready:
+                    events.append(self._event("grapes_ready", db_game_state, vineyard.name, vineyard.id))
                 vineyard.grapes_ready = True
                 logger.info(f"Grapes in {vineyard.name} ({vineyard.varietal}) are now ready for harvest.")
 
         # Monthly updates for winery production
-        db_winery = self.db.query(DBWinery).filter(DBWinery.player_id == db_player.id).first()
+        db_winery = db_player.winery
         if db_winery:
             for wine_prod in list(db_winery.wines_fermenting): # Iterate over a copy to allow modification
                 if wine_prod.fermentation_progress < 100:
@@ -102,16 +116,44 @@ class Game:
                     progress_gain = random.randint(10, 25) + int(wine_prod.quality / 10)
                     wine_prod.fermentation_progress = min(100, wine_prod.fermentation_progress + progress_gain)
                     logger.debug(f"Fermentation progress for {wine_prod.varietal}: {wine_prod.fermentation_progress}%")
+                    if wine_prod.fermentation_progress >= 100:
+                        events.append(self._event("fermentation_complete", db_game_state, wine_prod.varietal, wine_prod.id))
 
             for wine_prod in list(db_winery.wines_aging): # Iterate over a copy
                 if wine_prod.aging_progress < wine_prod.aging_duration:
                     wine_prod.aging_progress += 1
                     logger.debug(f"Aging progress for {wine_prod.varietal}: {wine_prod.aging_progress}/{wine_prod.aging_duration} months.")
+                    if wine_prod.aging_progress >= wine_prod.aging_duration:
+                        events.append(self._event("aging_complete", db_game_state, wine_prod.varietal, wine_prod.id))
+        return events
+
+    def advance_month(self) -> List[GameEvent]:
+        db_game_state = self.db.query(DBGameState).first()
+        db_player = self.db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
 
+        events = self._tick(db_game_state, db_player)
         self.db.commit()
         self.db.refresh(db_game_state)
         self.db.refresh(db_player)
         logger.info(f"Advanced to {db_game_state.months[db_game_state.current_month_index]}, {db_game_state.current_year}.")
+        return events
+
+    def advance_months(self, months: int) -> Optional[AdvanceMonthsResult]:
+        """Fast-forwards `months` months in memory and commits once at the end."""
+        if not 1 <= months <= MAX_ADVANCE_MONTHS:
+            logger.warning(f"Failed to advance {months} months: must be between 1 and {MAX_ADVANCE_MONTHS}.")
+            return None
+
+        db_game_state = self.db.query(DBGameState).first()
+        db_player = self.db.query(DBPlayer).filter(DBPlayer.id == db_game_state.player_id).first()
+        events = []
+        for _ in range(months):
+            events.extend(self._tick(db_game_state, db_player))
+        self.db.flush()
+        result = AdvanceMonthsResult(game_state=GameState.model_validate(db_game_state), events=events)
+        self.db.commit()
+        logger.info(f"Advanced {months} months to {result.game_state.months[result.game_state.current_month_index]}, {result.game_state.current_year}. {len(events)} events.")
+        return result
 
     def buy_vineyard(self, vineyard_data: Dict[str, Any], vineyard_name: str) -> Optional[Vineyard]:
         db_game_state = self.db.query(DBGameState).first()
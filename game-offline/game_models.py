@@ -262,6 +262,17 @@ class GameState(BaseModel):
 
     model_config = {"from_attributes": True}
 
+class GameEvent(BaseModel):
+    type: str # "grapes_ready", "fermentation_complete" or "aging_complete"
+    year: int
+    month: str
+    subject: str # Vineyard name or wine varietal
+    subject_id: Optional[int] = None
+
+class AdvanceMonthsResult(BaseModel):
+    game_state: GameState
+    events: List[GameEvent] = []
+
 # Request Body Models
 class BuyVineyardRequest(BaseModel):
     vineyard_data: Dict[str, Any]
@@ -185,6 +185,29 @@ def handle_buy_vessel(game: Game):
     except ValueError:
         print("Invalid input.")
 
+def handle_fast_forward(game: Game):
+    """Handles advancing several months at once."""
+    try:
+        months = int(input("How many months do you want to advance? "))
+    except ValueError:
+        print("Invalid input.")
+        return
+
+    result = game.advance_months(months)
+    if result is None:
+        print("Could not advance. Please choose a number of months between 1 and 120.")
+        return
+
+    if not result.events:
+        print(f"{months} months passed quietly.")
+    for event in result.events:
+        if event.type == "grapes_ready":
+            print(f"{event.month} {event.year}: Grapes in {event.subject} are ready for harvest.")
+        elif event.type == "fermentation_complete":
+            print(f"{event.month} {event.year}: Fermentation of {event.subject} is complete.")
+        elif event.type == "aging_complete":
+            print(f"{event.month} {event.year}: Aging of {event.subject} is complete.")
+
 def main():
     """The main game loop."""
     db = SessionLocal()
@@ -206,7 +229,8 @@ def main():
         print("3. Tend to a vineyard")
         print("4. Harvest grapes")
         print("5. Manage winery")
-        print("6. Exit game")
+        print("6. Fast-forward several months")
+        print("7. Exit game")
 
         choice = input("> ")
 
@@ -221,6 +245,8 @@ def main():
         elif choice == '5':
             handle_winery_management(game, current_state.player)
         elif choice == '6':
+            handle_fast_forward(game)
+        elif choice == '7':
             print("Thank you for playing Terroir & Time!")
             break
         else: